@@ -39,10 +39,103 @@ measurement is committed, it's changed by the id actually required by the REST A
 '''
 import datetime
 import sys
-import requests
 import os
 import subprocess
+import time
+from pyspeedtin.compression import CommitStats, choose_request_encoding, get_codec
 from pyspeedtin.local_cache import LocalCache
+from pyspeedtin import run_context as run_context_module
+from pyspeedtin.run_context import RunContext, RunContexts, prune_run_contexts
+from pyspeedtin.serializers import get_serializer
+from pyspeedtin.transport import DEFAULT_POOL_MAXSIZE, RetryPolicy, create_session
+from pyspeedtin.upload_pool import UploadPool
+
+
+# The key of the sync state of the benchmarks in the 'sync_state' bucket.
+_BENCHMARKS_SYNC_KEY = {'resource': 'benchmarks'}
+
+# The key of the content coding accepted by the server in requests in the 'sync_state' bucket.
+_REQUEST_ENCODING_SYNC_KEY = {'resource': 'request_encoding'}
+
+# The maximum size of the name of a benchmark (in the server).
+MAX_BENCHMARK_NAME_SIZE = 50
+
+# The maximum number of run contexts kept in memory (see: PySpeedTinApi._get_run_context).
+MAX_CACHED_RUN_CONTEXTS = 64
+
+_hostname = None
+
+
+def _check_benchmark_name(name):
+    if len(name) > MAX_BENCHMARK_NAME_SIZE:
+        raise ValueError('The maximum benchmark name size is %s chars. The one passed has: %s chars (%s)' % (
+            MAX_BENCHMARK_NAME_SIZE, len(name), name))
+
+
+def _get_hostname():
+    # Note: computed only once per process.
+    global _hostname
+    if _hostname is None:
+        import socket
+        _hostname = socket.gethostname()
+    return _hostname
+
+
+class _BenchmarkIds(object):
+    '''
+    Provides the benchmark id to be used in the REST API for a measurement (which may reference
+    the benchmark by its name).
+
+    The ids are gotten from the local cache and the benchmarks from the server are requested
+    at most once (when some name is not found in the local cache).
+    '''
+
+    def __init__(self, local_cache, has_server_benchmarks=False):
+        '''
+        :param bool has_server_benchmarks:
+            True if the benchmarks from the server were already merged in the local cache in this
+            commit (so, they're not requested again).
+        '''
+        self._name_to_id = {}
+        self._has_server_benchmarks = has_server_benchmarks
+        with local_cache.load('benchmark', read_only=True) as benchmark_data:
+            for handle in benchmark_data:
+                if handle.has_rest_data():
+                    self._name_to_id[handle.data['name']] = int(handle.rest_data['id'])
+
+    def needs_server_benchmarks(self, benchmark_id):
+        try:
+            int(benchmark_id)
+        except ValueError:
+            # The benchmark_id is actually the name of the benchmark, so, we have
+            # to get its id from the name.
+            return not self._has_server_benchmarks and benchmark_id not in self._name_to_id
+        return False
+
+    @property
+    def known_benchmarks(self):
+        return len(self._name_to_id)
+
+    def add_server_benchmarks(self, benchmarks):
+        '''
+        :param list|NoneType benchmarks:
+            The benchmarks gotten from the server (None if they didn't change since they were
+            last saved in the local cache).
+        '''
+        self._has_server_benchmarks = True
+        for benchmark in benchmarks or ():
+            if benchmark['name'] not in self._name_to_id:
+                self._name_to_id[benchmark['name']] = int(benchmark['id'])
+
+    def get_id(self, benchmark_id):
+        try:
+            int(benchmark_id)
+        except ValueError:
+            try:
+                return self._name_to_id[benchmark_id]
+            except KeyError:
+                raise ValueError('Unable to find benchmark with the name: %s' % (benchmark_id))
+        return benchmark_id
 
 
 class PySpeedTinApi(object):
@@ -54,7 +147,17 @@ class PySpeedTinApi(object):
     need to query the server to get the benchmark id from the benchmark name.
     '''
 
-    def __init__(self, authorization_key=None, project_id=None, clear_previous=False):
+    def __init__(
+        self,
+        authorization_key=None,
+        project_id=None,
+        clear_previous=False,
+        cache_backend=None,
+        pool_maxsize=DEFAULT_POOL_MAXSIZE,
+        sharded_spool=False,
+        spool_compression=None,
+        compress_requests=True,
+    ):
         '''
         :param str project_id:
             This is the id of the project (available in the Dashboard/Projects, next to the project
@@ -63,6 +166,29 @@ class PySpeedTinApi(object):
         :param str authorization_key:
             The key which is used to authorize with the backend (available in the Dashboard/User
             Settings).
+
+        :param str cache_backend:
+            The backend used to save the local cache: 'journal' (default: one file per bucket) or
+            'sqlite' (a sqlite database -- contents previously saved with the 'journal' backend
+            are migrated to it).
+
+        :param int pool_maxsize:
+            The maximum number of connections kept alive to the server (should be at least the
+            max_workers used in commit()).
+
+        :param bool sharded_spool:
+            If True, add_measurement() appends to a shard file of this process instead of the
+            shared 'measurement' bucket (so, many processes adding measurements at the same time
+            don't contend on it). The shards are merged in commit() (see: pyspeedtin.shard_spool).
+            Not used with the 'sqlite' cache_backend (which doesn't need it).
+
+        :param str spool_compression:
+            The compression of the shards of the sharded spool: 'gzip' or 'zstd' (if the
+            zstandard library is installed). By default they're not compressed.
+
+        :param bool compress_requests:
+            If True, the bodies of the requests are compressed when the server accepts it (which
+            is checked only once -- the result is kept in the local cache).
         '''
         if authorization_key is None:
             try:
@@ -84,29 +210,202 @@ class PySpeedTinApi(object):
 
 
         self.base_url = 'https://www.speedtin.com'
-        self.post = requests.post
-        self.get = requests.get
-        self._local_cache = LocalCache(os.path.join(self._data_dir(), str(project_id)))
+
+        # The session (and the HTTP stack) is only created when some request is actually done
+        # (see: post/get).
+        self._pool_maxsize = pool_maxsize
+        self._session = None
+        self._post = None
+        self._get = None
+
+        # Requests failing with connection errors or 429/5xx are retried with this policy.
+        self.retry_policy = RetryPolicy()
+
+        self.compress_requests = compress_requests
+
+        # The content coding used in the requests of the current commit (None: not compressed).
+        self._request_encoding = None
+
+        # The bytes uploaded in the current commit.
+        self._commit_stats = None
+
+        # Coroutine functions used instead of post/get in commit_async() (if not set, post/get are
+        # called in the default executor of the loop).
+        self.async_post = None
+        self.async_get = None
+
+        # When committing, the local cache is updated whenever this number of items is saved to
+        # the server (so, if the process is killed, at most this number of items would be sent
+        # again in a new commit).
+        self.checkpoint_interval = 1
+        self._local_cache = LocalCache(
+            os.path.join(self._data_dir(), str(project_id)), backend=cache_backend)
+
+        # The fields of a measurement (other than the value and tags) -> tuple(RunContext, time
+        # it was registered in the local cache) (see: pyspeedtin.run_context).
+        self._run_contexts = {}
+
+        self._background_flusher = None
+        self._latency_recorder = None
+        self._measurement_spool = None
+        if sharded_spool:
+            self._measurement_spool = self._local_cache.create_spool('measurement', spool_compression)
 
         if clear_previous:
             self._local_cache.clear('measurement')
+            if self._measurement_spool is not None:
+                self._measurement_spool.discard_orphans()
+            prune_run_contexts(self._local_cache)
         else:
-            # Print that we have remaining data from a previous call
-            found = []
-            with self._local_cache.load('measurement') as measurement_data:
-                for handle in measurement_data:
-                    found.append(handle.data)
-
+            # Print that we have remaining data from a previous call (just the count: reading
+            # all the data could take a while if there are many measurements).
+            found = self._local_cache.count('measurement')
             if found:
-                sys.stderr.write('Warning: PySpeedTinApi:\nIn a previous call the following measurements where not properly saved:\n')
-                for data in found:
-                    sys.stderr.write(str(data))
-                    sys.stderr.write('\n')
-                sys.stderr.write('\nWhen committing, those values will also be saved...\n')
+                sys.stderr.write('Warning: PySpeedTinApi:\nIn a previous call %s measurement(s) were not properly saved.\n' % (found,))
+                sys.stderr.write('When committing, those values will also be saved...\n')
                 sys.stderr.write(
                     'To prevent this from happening, pass "clear_previous=True" in the \n'
                     'PySpeedTinApi constructor or manually erase the contents at:\n%s\n\n' % (self._data_dir()))
 
+    def close(self):
+        '''
+        Stops the latency recorder and the background flush (committing what's pending) and
+        closes the connections kept alive to the server.
+        '''
+        recorder = self._latency_recorder
+        if recorder is not None:
+            self._latency_recorder = None
+            recorder.close()
+
+        flusher = self._background_flusher
+        if flusher is not None:
+            self._background_flusher = None
+            flusher.close()
+
+        session = self._session
+        if session is not None:
+            self._session = None
+            session.close()
+
+    def _get_session(self):
+        session = self._session
+        if session is None:
+            session = self._session = create_session(self._pool_maxsize)
+        return session
+
+    @property
+    def post(self):
+        '''
+        The function used to post to the server (by default the post of a requests.Session).
+
+        Note: if the server accepts compressed requests, the compressed body is passed in `data`
+        instead of `json`.
+        '''
+        post = self._post
+        if post is None:
+            post = self._get_session().post
+        return post
+
+    @post.setter
+    def post(self, post):
+        self._post = post
+
+    @property
+    def get(self):
+        '''
+        The function used to get from the server (by default the get of a requests.Session).
+        '''
+        get = self._get
+        if get is None:
+            get = self._get_session().get
+        return get
+
+    @get.setter
+    def get(self, get):
+        self._get = get
+
+    def start_background_flush(self, max_items=100, max_interval=5.0, max_pending=10000, max_workers=1):
+        '''
+        Makes add_measurement() just queue the measurement in memory, to be committed in a
+        background thread whenever `max_items` measurements are queued or `max_interval` seconds
+        elapse (see: pyspeedtin.background_flusher).
+
+        Use flush() to wait until the measurements added so far are committed and close() to
+        stop it (it's also stopped when the process exits).
+
+        :param int max_pending:
+            add_measurement() blocks while this number of measurements is still not committed
+            (including the ones in the local cache whose commit failed).
+
+        :return BackgroundFlusher:
+        '''
+        from pyspeedtin.background_flusher import BackgroundFlusher
+        if self._background_flusher is not None:
+            raise RuntimeError('The background flush was already started.')
+        self._background_flusher = BackgroundFlusher(
+            self, max_items, max_interval, max_pending, max_workers)
+        return self._background_flusher
+
+    def start_latency_recorder(self, interval=60.0, percentiles=(50, 95, 99), **kwargs):
+        '''
+        Starts recording the latencies of timed()/section() (see: pyspeedtin.latency). Every
+        `interval` seconds the percentiles of each name are added as measurements of the
+        benchmarks '<name> p<percentile>'.
+
+        :param kwargs:
+            Passed to add_measurement() (i.e.: version, branch, ...).
+
+        :return LatencyRecorder:
+        '''
+        from pyspeedtin.latency import LatencyRecorder
+        if self._latency_recorder is not None:
+            raise RuntimeError('The latency recorder was already started.')
+        self._latency_recorder = LatencyRecorder(self, interval, percentiles, **kwargs)
+        return self._latency_recorder
+
+    def timed(self, name):
+        '''
+        Decorator to record the latency of each call of a function (the latency recorder is
+        started with the defaults if it wasn't started yet).
+
+        i.e.:
+
+            @api.timed('handle_request')
+            def handle_request():
+                ...
+        '''
+        return self._get_latency_recorder().timed(name)
+
+    def section(self, name):
+        '''
+        Context manager to record the latency of the code in it (the latency recorder is started
+        with the defaults if it wasn't started yet).
+
+        i.e.:
+
+            with api.section('load_users'):
+                ...
+        '''
+        return self._get_latency_recorder().section(name)
+
+    def _get_latency_recorder(self):
+        recorder = self._latency_recorder
+        if recorder is None:
+            recorder = self.start_latency_recorder()
+        return recorder
+
+    def flush(self, timeout=None):
+        '''
+        Waits until the measurements added so far are committed by the background flush.
+
+        :return bool:
+            True if everything was committed in the given timeout.
+        '''
+        flusher = self._background_flusher
+        if flusher is None:
+            return True
+        return flusher.flush(timeout)
+
     def date_to_str(self, date):
         return date.strftime('%Y-%m-%d %H:%M:%S.%f')
 
@@ -119,88 +418,306 @@ class PySpeedTinApi(object):
     def _data_dir(self):
         return os.path.join(os.path.expanduser('~'), '.speedtin')
 
-    def commit(self):
+    def commit(self, max_workers=1):
+        '''
+        :param int max_workers:
+            The number of threads used to post the benchmarks/measurements to the server (by
+            default they're posted one after the other). Each item is only marked as saved in the
+            local cache after the server confirms it was created.
+
+        :return CommitStats:
+            The bytes uploaded (and saved by the compression).
+        '''
         sys.stdout.write('Commit results...\n')
         assert not self.base_url.endswith('/'), 'The base url must not end with a slash.'
-        self._commit_benchmarks()
-        self._commit_measurements()
+        self._commit_stats = stats = CommitStats()
+        try:
+            self._merge_spool(stats)
+            with UploadPool(max_workers) as pool:
+                self._request_encoding = self._get_request_encoding()
+                has_server_benchmarks = self._commit_benchmarks(pool)
+                if self._needs_request_encoding_probe():
+                    # Note: the benchmarks from the server are also merged in the local cache.
+                    self._get_server_benchmarks()
+                    has_server_benchmarks = True
+                self._request_encoding = self._get_request_encoding()
+                self._commit_measurements(pool, has_server_benchmarks)
+            prune_run_contexts(self._local_cache)
+        finally:
+            self._commit_stats = None
+        sys.stdout.write('%s\n' % (stats,))
+        return stats
 
-    def _commit_benchmarks(self):
-        project_id = self.project_id
-        authorization_key = self.authorization_key
-        with self._local_cache.load('benchmark') as benchmark_data:
-            for handle in benchmark_data:
-                if not handle.has_rest_data():
-                    data = handle.data
-                    as_json = self.post_and_check_resut(
-                        '%s/api/projects/%s/benchmarks' % (self.base_url, project_id),
-                        json=data,
-                        headers={'X-AuthToken': authorization_key},
-                        msg='It was not possible to create the benchmark',
-                        expected_status=201,
-                    )
-                    handle.set_rest_data(as_json)
-                    sys.stdout.write('Saved benchmark: %s\n' % (as_json,))
-
-    def _commit_measurements(self):
-        project_id = self.project_id
-        authorization_key = self.authorization_key
-
-        with self._local_cache.load('benchmark') as benchmark_data:
-            benchmark_name_to_id = {}
+    def commit_async(self, concurrency=8):
+        '''
+        Same as commit(), but returns a coroutine which does the requests concurrently in the
+        current event loop (see: pyspeedtin.async_commit).
+
+        i.e.:
+            await api.commit_async(concurrency=10)
+
+        :param int concurrency:
+            The maximum number of requests in flight.
+        '''
+        from pyspeedtin.async_commit import commit_async
+        return commit_async(self, concurrency)
+
+    def _merge_spool(self, stats=None):
+        '''
+        Merges the measurements in the shards (of this process and of processes which are no
+        longer alive) in the 'measurement' bucket.
+        '''
+        if self._measurement_spool is not None:
+            self._measurement_spool.merge_into(self._local_cache, stats)
+
+    def _needs_request_encoding_probe(self):
+        '''
+        :return bool:
+            True if it's still not known whether the server accepts compressed requests and there
+            are measurements to be committed.
+
+            The server is probed only once: it lists the content codings it accepts in requests
+            in the Accept-Encoding of its responses to get the benchmarks, which is saved in the
+            local cache (see: _on_benchmarks_response).
+        '''
+        return (
+            self.compress_requests and
+            self._load_sync_state(_REQUEST_ENCODING_SYNC_KEY) is None and
+            self._local_cache.count('measurement') > 0)
+
+    def _get_request_encoding(self):
+        '''
+        :return str|NoneType:
+            The content coding to compress the request bodies (None if they're not compressed).
+        '''
+        if not self.compress_requests:
+            return None
+        state = self._load_sync_state(_REQUEST_ENCODING_SYNC_KEY)
+        if state is None or not state['encoding']:
+            return None
+        # Note: the codec may not be available anymore (i.e.: zstandard was uninstalled).
+        return choose_request_encoding(state['encoding'])
+
+    def _commit_benchmarks(self, pool=None):
+        '''
+        :return bool:
+            True if the benchmarks from the server were merged in the local cache.
+        '''
+        if pool is None:
+            pool = UploadPool()
+
+        known_benchmarks, pending_benchmarks = self._count_benchmarks()
+        if not pending_benchmarks:
+            return False
+
+        # Benchmarks already in the server (i.e.: created in some other machine) just have their
+        # ids saved in the local cache, so, only the missing ones are created.
+        self._get_server_benchmarks(known_benchmarks)
+
+        url = self._benchmarks_url()
+        headers = {'X-AuthToken': self.authorization_key}
+
+        def post_benchmark(handle):
+            return self.post_and_check_resut(
+                url,
+                json=handle.data,
+                headers=headers,
+                msg='It was not possible to create the benchmark',
+                expected_status=201,
+            )
+
+        def on_benchmark_saved(handle, as_json):
+            handle.set_rest_data(as_json)
+            sys.stdout.write('Saved benchmark: %s\n' % (as_json,))
+
+        with self._local_cache.load(
+                'benchmark', self.checkpoint_interval, pending_only=True) as benchmark_data:
+            pool.map_in_order(benchmark_data, post_benchmark, on_benchmark_saved)
+        return True
+
+    def _count_benchmarks(self):
+        '''
+        :return tuple(int, int):
+            The number of benchmarks in the local cache with and without an id.
+        '''
+        known_benchmarks = pending_benchmarks = 0
+        with self._local_cache.load('benchmark', read_only=True) as benchmark_data:
             for handle in benchmark_data:
-                benchmark_name_to_id[int(handle.rest_data['id'])] = handle.data['name']
+                if handle.has_rest_data():
+                    known_benchmarks += 1
+                else:
+                    pending_benchmarks += 1
+        return known_benchmarks, pending_benchmarks
+
+    def _commit_measurements(self, pool=None, has_server_benchmarks=False):
+        if pool is None:
+            pool = UploadPool()
+        headers = {'X-AuthToken': self.authorization_key}
 
-        with self._local_cache.load('measurement') as measurement_data:
+        benchmark_ids = _BenchmarkIds(self._local_cache, has_server_benchmarks)
+        run_contexts = RunContexts(self._local_cache)
+
+        def get_benchmark_id(benchmark_id):
+            if benchmark_ids.needs_server_benchmarks(benchmark_id):
+                # Ok, it's not there, try to get it from the REST API (and take the
+                # chance to update our local cache).
+                benchmark_ids.add_server_benchmarks(
+                    self._get_server_benchmarks(benchmark_ids.known_benchmarks))
+            return benchmark_ids.get_id(benchmark_id)
+
+        def iter_measurements(measurement_data):
+            # Note: the benchmark ids are resolved in this thread (as it may access the cache).
             for handle in measurement_data:
-                benchmark_id, json = handle.data
-
-                try:
-                    int(benchmark_id)
-                except ValueError:
-                    # The benchmark_id is actually the name of the benchmark, so, we have
-                    # to get its id from the name.
-                    try:
-                        benchmark_id = benchmark_name_to_id[benchmark_id]
-                    except KeyError:
-                        # Ok, it's not there, try to get it from the REST API (and take the
-                        # chance to update our local cache).
-                        benchmarks_request = self.get('%s/api/projects/%s/benchmarks' % (
-                            self.base_url,
-                            project_id), headers={'X-AuthToken': authorization_key})
-                        as_json = self.check_request_result(
-                            benchmarks_request,
-                            'Unable to get the benchmarks from the server',
-                            expected_status=200,
-                        )
-
-                        for benchmark in as_json:
-                            if benchmark['name'] not in benchmark_name_to_id:
-                                benchmark_name_to_id[benchmark['name']] = int(benchmark['id'])
-                                self._local_cache.add(
-                                    'benchmark', {'name': benchmark['name']}, benchmark)
-                        try:
-                            benchmark_id = benchmark_name_to_id[benchmark_id]
-                        except KeyError:
-                            raise ValueError(
-                                'Unable to find benchmark with the name: %s' % (benchmark_id))
-
-                as_json = self.post_and_check_resut(
-                    '%s/api/projects/%s/benchmarks/%s/measurements' % (
-                        self.base_url, project_id, benchmark_id),
-                    json=json,
-                    headers={'X-AuthToken': authorization_key},
-                    msg='It was not possible to create the measurement',
-                    expected_status=201,
-                )
-                sys.stdout.write('Saved measurement: %s\n' % (as_json,))
-                handle.remove()
+                if run_contexts.needs_load(handle.data):
+                    run_contexts.load()
+                benchmark_id, json = run_contexts.get_payload(handle.data)
+                yield handle, get_benchmark_id(benchmark_id), json
+
+        def post_measurement(item):
+            _handle, benchmark_id, json = item
+            return self.post_and_check_resut(
+                self._measurements_url(benchmark_id),
+                json=json,
+                headers=headers,
+                msg='It was not possible to create the measurement',
+                expected_status=201,
+            )
+
+        def on_measurement_saved(item, as_json):
+            handle = item[0]
+            sys.stdout.write('Saved measurement: %s\n' % (as_json,))
+            handle.remove()
+
+        with self._local_cache.load('measurement', self.checkpoint_interval) as measurement_data:
+            pool.map_in_order(iter_measurements(measurement_data), post_measurement, on_measurement_saved)
+
+    def sync_benchmarks(self):
+        '''
+        Updates the benchmarks in the local cache with the benchmarks in the server.
+
+        The request is conditional (If-None-Match/If-Modified-Since from the last sync), so, if
+        nothing changed in the server, the benchmarks are not transferred again.
+
+        :return bool:
+            True if the benchmarks changed since the last sync.
+        '''
+        return self._get_server_benchmarks() is not None
+
+    def _get_server_benchmarks(self, known_benchmarks=None):
+        '''
+        :param int known_benchmarks:
+            The number of benchmarks with an id in the local cache (if given and it's lower than
+            the number of benchmarks last synced the request is not conditional).
+
+        :return list|NoneType:
+            The benchmarks in the server (already merged in the local cache) or None if they
+            didn't change since the last sync.
+        '''
+        benchmarks_request = self.retry_policy.call(
+            self.get, self._benchmarks_url(), headers=self._get_benchmarks_headers(known_benchmarks))
+        return self._on_benchmarks_response(benchmarks_request)
+
+    def _get_benchmarks_headers(self, known_benchmarks=None):
+        headers = {'X-AuthToken': self.authorization_key}
+
+        sync_state = self._load_sync_state(_BENCHMARKS_SYNC_KEY)
+        if self.compress_requests and self._load_sync_state(_REQUEST_ENCODING_SYNC_KEY) is None:
+            # A 304 may not have the Accept-Encoding, so, the server is probed with a full request.
+            sync_state = None
+        if sync_state and (known_benchmarks is None or known_benchmarks >= sync_state['benchmarks']):
+            if sync_state['etag']:
+                headers['If-None-Match'] = sync_state['etag']
+            if sync_state['last_modified']:
+                headers['If-Modified-Since'] = sync_state['last_modified']
+        return headers
+
+    def _on_benchmarks_response(self, benchmarks_request):
+        response_headers = getattr(benchmarks_request, 'headers', None) or {}
+        if self.compress_requests and (
+                benchmarks_request.status_code == 200 or
+                (benchmarks_request.status_code == 304 and
+                 response_headers.get('Accept-Encoding') is not None)):
+            # Note: a 304 without the Accept-Encoding doesn't change the saved one.
+            self._save_request_encoding(response_headers)
+
+        if benchmarks_request.status_code == 304:
+            # Not modified: what we have in the local cache is still valid.
+            return None
+
+        benchmarks = self.check_request_result(
+            benchmarks_request,
+            'Unable to get the benchmarks from the server',
+            expected_status=200,
+        )
+        self._local_cache.merge(
+            'benchmark', [({'name': benchmark['name']}, benchmark) for benchmark in benchmarks])
+
+        self._local_cache.merge('sync_state', [(_BENCHMARKS_SYNC_KEY, {
+            'etag': response_headers.get('ETag', ''),
+            'last_modified': response_headers.get('Last-Modified', ''),
+            'benchmarks': len(benchmarks),
+            'synced_at': self.date_to_str(self.curr_date()),
+        })])
+        return benchmarks
+
+    def _save_request_encoding(self, response_headers):
+        encoding = choose_request_encoding(response_headers.get('Accept-Encoding')) or ''
+        state = self._load_sync_state(_REQUEST_ENCODING_SYNC_KEY)
+        if state is None or state['encoding'] != encoding:
+            self._local_cache.merge(
+                'sync_state', [(_REQUEST_ENCODING_SYNC_KEY, {'encoding': encoding})])
+
+    def _load_sync_state(self, sync_key):
+        with self._local_cache.load('sync_state', read_only=True) as sync_state_data:
+            for handle in sync_state_data:
+                if handle.data == sync_key:
+                    return handle.rest_data
+        return None
+
+    def _benchmarks_url(self):
+        return '%s/api/projects/%s/benchmarks' % (self.base_url, self.project_id)
+
+    def _measurements_url(self, benchmark_id):
+        return '%s/api/projects/%s/benchmarks/%s/measurements' % (
+            self.base_url, self.project_id, benchmark_id)
 
     def post_and_check_resut(self, url, json, headers, msg, expected_status):
-        r = self.post(url, json=json, headers=headers, allow_redirects=False)
+        encoding = self._request_encoding
+        kwargs, size, uncompressed_size = self._encode_request(json, headers, encoding)
+        r = self.retry_policy.call(
+            self.post, url, idempotent=False, allow_redirects=False, **kwargs)
+        if encoding is not None and r.status_code == 415:
+            # The server no longer accepts it: send it (and the next ones) uncompressed.
+            self._request_encoding = None
+            kwargs, size, uncompressed_size = self._encode_request(json, headers, None)
+            r = self.retry_policy.call(
+                self.post, url, idempotent=False, allow_redirects=False, **kwargs)
+
+        stats = self._commit_stats
+        if stats is not None:
+            stats.add_request(uncompressed_size, size)
         as_json = self.check_request_result(r, msg+' Url: %s, Json: %s' % (url, json), expected_status)
         return as_json
 
+    def _encode_request(self, json, headers, encoding):
+        '''
+        :param str|NoneType encoding:
+            The content coding to compress the json (None to post it as is).
+
+        :return tuple(dict, int, int):
+            The kwargs to post the json (with `data` instead of `json` if it's compressed), the
+            size of the body and the size it'd have if it was not compressed.
+        '''
+        body = get_serializer('json').dumps(json)
+        if encoding is None:
+            return {'json': json, 'headers': headers}, len(body), len(body)
+
+        data = get_codec(encoding).compress(body)
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Encoding'] = encoding
+        return {'data': data, 'headers': headers}, len(data), len(body)
+
     def check_request_result(self, r, msg, expected_status=201):
         if r.status_code != expected_status:
             raise RuntimeError('%s. Expected status: %s != %s Msg: %s' % (msg, expected_status, r.status_code, r.text,))
@@ -221,8 +738,7 @@ class PySpeedTinApi(object):
         :param str name:
             The name of the benchmark to be created.
         '''
-        if len(name) > 50:
-            raise ValueError('The maximum benchmark name size is 50 chars. The one passed has: %s chars' % (len(name),))
+        _check_benchmark_name(name)
         self._local_cache.add('benchmark', {'name': name})
 
     def add_measurement(
@@ -281,30 +797,223 @@ class PySpeedTinApi(object):
             Any value you feel it's important to tag this measurement.
         '''
         if not machine_name:
-            import socket
-            machine_name = socket.gethostname()
+            machine_name = _get_hostname()
 
         if not machine_name:
             raise RuntimeError('Please specify machine name.')
-        json = {
-            'value': value,
-            'version': version,
-            'released': released,
-            'branch': branch,
-            'os': os,
-            'commit_id': commit_id,
-            'commit_date': commit_date,
-            'machine_name': machine_name,
-            'tag1': tag1,
-            'tag2': tag2,
-        }
-        self._local_cache.add(
-            'measurement',
-            (
-                benchmark_id,
-                json
-            )
-        )
+        # Note: the tags are kept in the measurement (they usually change for each measurement).
+        run_context = self._get_run_context(
+            (version, released, branch, os, commit_id, commit_date, machine_name, '', ''))
+        if tag1 or tag2:
+            data = (benchmark_id, value, run_context.id, tag1, tag2)
+        else:
+            data = (benchmark_id, value, run_context.id)
+        flusher = self._background_flusher
+        if flusher is not None:
+            flusher.add(data)
+        else:
+            self._store_measurements([data])
+
+    def _get_run_context(self, fields):
+        '''
+        :return RunContext:
+            The run context with the given fields (registered in the local cache the first time
+            it's used).
+        '''
+        now = time.time()
+        cached = self._run_contexts.get(fields)
+        if cached is not None and now - cached[1] < run_context_module.RUN_CONTEXT_REFRESH_INTERVAL:
+            return cached[0]
+
+        if cached is not None:
+            # Registered again (so, it's not pruned while it's still used).
+            run_context = cached[0]
+        else:
+            if len(self._run_contexts) >= MAX_CACHED_RUN_CONTEXTS:
+                # Note: registering it again in the local cache just updates its time.
+                self._run_contexts.clear()
+            run_context = RunContext(*fields)
+        # Note: it must be in the local cache before any measurement referencing it.
+        run_context.register(self._local_cache)
+        self._run_contexts[fields] = (run_context, now)
+        return run_context
+
+    def _store_measurements(self, items):
+        spool = self._measurement_spool
+        if spool is not None:
+            for data in items:
+                spool.add(data)
+        else:
+            self._local_cache.add_many('measurement', [(data, '') for data in items])
+
+    def measure(
+        self,
+        benchmark_name,
+        func,
+        warmup=1,
+        repeat=5,
+        min_time=0.2,
+        statistic='min',
+        disable_gc=True,
+        **kwargs
+    ):
+        '''
+        Measures the seconds each call to func takes (see: pyspeedtin.timing.measure) and adds
+        it as a measurement of the benchmark with the given name (the benchmark is also added).
+
+        :param str statistic:
+            The statistic of the samples used as the value (one of pyspeedtin.stats.STATISTICS).
+
+        :param kwargs:
+            Passed to add_measurement() (i.e.: version, branch, commit_id, ...). If tag1/tag2 are
+            not given, they're set with the number of samples/loops and their dispersion.
+
+        :return TimingResult:
+        '''
+        from pyspeedtin.stats import STATISTICS
+        from pyspeedtin.timing import measure
+
+        if statistic not in STATISTICS:
+            raise ValueError('Expected statistic to be one of: %s. Found: %s' % (STATISTICS, statistic))
+
+        self.add_benchmark(benchmark_name)
+        result = measure(func, warmup, repeat, min_time, disable_gc)
+
+        summary = result.summary
+        kwargs.setdefault('tag1', 'samples=%s loops=%s' % (summary['count'], result.loops))
+        kwargs.setdefault('tag2', 'stdev=%.3g median=%.3g' % (summary['stdev'], summary['median']))
+        self.add_measurement(benchmark_name, summary[statistic], **kwargs)
+        return result
+
+    def measure_memory(self, benchmark_name, func, top_n=0, **kwargs):
+        '''
+        Measures the memory used by func (see: pyspeedtin.memory.measure_memory) and adds each
+        value as a measurement of its own benchmark (which are also added):
+
+        - '<benchmark_name> peak_bytes'
+        - '<benchmark_name> allocations'
+        - '<benchmark_name> rss_bytes' (if the RSS is available in this platform)
+
+        :param int top_n:
+            If given, the top_n allocation sites of the memory still alive when func returns are
+            saved in a report in the data dir (its path is in the `report_file` of the result).
+
+        :param kwargs:
+            Passed to add_measurement() (i.e.: version, branch, commit_id, ...).
+
+        :return MemoryResult:
+        '''
+        from pyspeedtin.memory import measure_memory
+
+        suffixes = ('peak_bytes', 'allocations', 'rss_bytes')
+        for suffix in suffixes:
+            _check_benchmark_name('%s %s' % (benchmark_name, suffix))
+
+        result = measure_memory(func, top_n)
+        result.report_file = None
+        if top_n:
+            result.report_file = self._store_report(
+                benchmark_name, 'memory', '.txt', result.format_top_allocations().encode('utf-8'))
+
+        for suffix, value in zip(suffixes, (result.peak_bytes, result.allocations, result.rss_delta_bytes)):
+            if value is not None:
+                name = '%s %s' % (benchmark_name, suffix)
+                self.add_benchmark(name)
+                self.add_measurement(name, value, **kwargs)
+        return result
+
+    def add_samples(
+        self,
+        benchmark_id,
+        samples,
+        statistic='median',
+        extra_statistics=(),
+        store_samples=False,
+        **kwargs
+    ):
+        '''
+        Adds a measurement with a summary of many samples of a benchmark (instead of adding one
+        measurement for each sample).
+
+        :param list(float)|array('d')|numpy.ndarray samples:
+            The samples (see: pyspeedtin.stats.summarize).
+
+        :param str statistic:
+            The statistic of the samples used as the value of the measurement (one of
+            pyspeedtin.stats.STATISTICS).
+
+        :param tuple(str) extra_statistics:
+            Other statistics which are added as measurements of the benchmarks
+            '<benchmark_id> <statistic>' (which are also added -- so, benchmark_id must be the
+            benchmark name in this case).
+
+        :param bool store_samples:
+            If True, the samples are saved in the data dir as an array of doubles (little-endian)
+            for later analysis.
+
+        :param kwargs:
+            Passed to add_measurement() (i.e.: version, branch, commit_id, ...). If tag1/tag2 are
+            not given, they're set with the number of samples and their dispersion.
+
+        :return dict:
+            The summary of the samples (and the 'samples_file' if they were stored).
+        '''
+        from pyspeedtin.stats import STATISTICS, summarize, to_array
+
+        for stat in (statistic,) + tuple(extra_statistics):
+            if stat not in STATISTICS:
+                raise ValueError('Expected statistic to be one of: %s. Found: %s' % (STATISTICS, stat))
+        # Note: checked before anything is added.
+        for stat in extra_statistics:
+            _check_benchmark_name('%s %s' % (benchmark_id, stat))
+
+        if not hasattr(samples, 'dtype'):  # Keep numpy arrays as is.
+            samples = to_array(samples)
+        summary = summarize(samples)
+
+        if store_samples:
+            summary['samples_file'] = self._store_samples(benchmark_id, samples)
+
+        kwargs.setdefault('tag1', 'samples=%s' % (summary['count'],))
+        kwargs.setdefault('tag2', 'stdev=%.3g mad=%.3g' % (summary['stdev'], summary['mad']))
+        self.add_measurement(benchmark_id, summary[statistic], **kwargs)
+
+        for stat in extra_statistics:
+            benchmark_name = '%s %s' % (benchmark_id, stat)
+            self.add_benchmark(benchmark_name)
+            self.add_measurement(benchmark_name, summary[stat], **kwargs)
+        return summary
+
+    def _store_samples(self, benchmark_id, samples):
+        from array import array
+
+        # Note: always a copy (so, the samples passed aren't changed by byteswap).
+        samples = array('d', samples)
+        if sys.byteorder != 'little':
+            samples.byteswap()
+        return self._store_report(benchmark_id, 'samples', '.f64', samples.tobytes())
+
+    def _store_report(self, benchmark_id, kind, extension, contents):
+        '''
+        Saves the given contents in a new file in the '<kind>' dir in the data dir.
+
+        :return str:
+            The path to the file.
+        '''
+        import re
+        import uuid
+
+        reports_dir = os.path.join(self._local_cache._data_dir, kind)
+        if not os.path.isdir(reports_dir):
+            os.makedirs(reports_dir)
+        report_file = os.path.join(reports_dir, '%s-%s-%s%s' % (
+            re.sub(r'[^\w.-]', '_', str(benchmark_id))[:50],
+            self.curr_date().strftime('%Y%m%d%H%M%S'),
+            uuid.uuid4().hex[:12],
+            extension))
+        with open(report_file, 'wb') as stream:
+            stream.write(contents)
+        return report_file
 
     def run_and_get_output(self, *popenargs, **kwargs):
         '''
@@ -326,27 +1035,15 @@ class PySpeedTinApi(object):
         '''
         :param repo_path:
 
-        :return tuple(str, str):
-            Returns a tuple with the commit_id and the commit_date obtained from the given path
-            (the repo_path must the one containing the .git folder or a sub-directory).
-        '''
-        if not os.path.exists(repo_path):
-            raise OSError('The path: %s does not exist.' % (repo_path,))
-
-        while not os.path.exists(os.path.join(repo_path, '.git')):
-            initial = repo_path
-            repo_path = os.path.dirname(repo_path)
-            if initial == repo_path or not repo_path:
-                raise OSError('The path: %s does not seem to be a git-managed path.' % (repo_path,))
-
-        commit_id = self.run_and_get_output('git rev-parse HEAD'.split()).strip().decode('utf-8')
-        branch = self.run_and_get_output(
-            'git rev-parse --abbrev-ref HEAD'.split()).strip().decode('utf-8')
-        commit_date = self.run_and_get_output(
-            ['git', 'show', '-s', '--format=%ct', commit_id]).strip().decode('utf-8')
+        :return tuple(str, str, datetime.datetime):
+            Returns a tuple with the commit_id, branch and commit_date obtained from the given
+            path (the repo_path must the one containing the .git folder or a sub-directory).
 
-        commit_date = datetime.datetime.utcfromtimestamp(int(commit_date))
-        return commit_id, branch, commit_date
+        Note: the .git dir is read directly and the result is cached while the HEAD doesn't
+        change (see: pyspeedtin.git_info).
+        '''
+        from pyspeedtin.git_info import get_commit_id_branch_and_date
+        return get_commit_id_branch_and_date(repo_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,242 @@
+'''
+The asyncio version of PySpeedTinApi.commit().
+
+i.e.:
+
+    await api.commit_async(concurrency=10)
+
+The requests are done through api.async_post/api.async_get, which are coroutine functions with
+the same signature of api.post/api.get (i.e.: `await api.async_post(url, json=..., headers=...)`)
+returning an object with `status_code`, `text` and `json()` (note: if the server accepts
+compressed requests, the compressed body is passed in `data` instead of `json`). If those aren't
+set, api.post/api.get are called in the default executor of the loop.
+
+The local cache is only accessed in a separate thread (so, the loop is not blocked by it) and has
+the same semantics of the sync version: each item is only marked as saved/removed in the local
+cache after the server confirms it was created.
+'''
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import sys
+
+from pyspeedtin.compression import CommitStats
+
+
+class _Transport(object):
+
+    def __init__(self, api, loop):
+        self._api = api
+        self._loop = loop
+
+    async def post(self, url, **kwargs):
+        api = self._api
+        return await self._call_with_retry(api.async_post, api.post, url, False, **kwargs)
+
+    async def get(self, url, **kwargs):
+        api = self._api
+        return await self._call_with_retry(api.async_get, api.get, url, True, **kwargs)
+
+    async def _call_with_retry(self, async_request, request, url, idempotent, **kwargs):
+        '''
+        The same as RetryPolicy.call, but without blocking the loop.
+        '''
+        retry_policy = self._api.retry_policy
+        attempt = 0
+        while True:
+            try:
+                if async_request is not None:
+                    response = await async_request(url, **kwargs)
+                else:
+                    response = await self._loop.run_in_executor(
+                        None, functools.partial(request, url, **kwargs))
+            except retry_policy.retryable_exceptions as e:
+                if attempt >= retry_policy.max_retries or not retry_policy.should_retry_exception(e, idempotent):
+                    raise
+                delay = retry_policy.get_delay(attempt)
+                reason = str(e)
+            else:
+                if attempt >= retry_policy.max_retries or not retry_policy.should_retry_response(response):
+                    return response
+                delay = retry_policy.get_delay(attempt, response)
+                reason = 'status: %s' % (response.status_code,)
+
+            sys.stderr.write('Retrying request to: %s in %.2fs (%s).\n' % (url, delay, reason))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def _map_in_order(items, func, on_result, concurrency):
+    '''
+    Awaits func(item) for each item with at most `concurrency` items in flight and awaits
+    on_result(item, result) in the same order of the items.
+
+    If some item fails, no new items are started, the results of the ones already started are
+    still handled and then the first error is raised (the other errors are printed to stderr).
+    '''
+    in_flight = deque()
+    errors = []
+    items = iter(items)
+    while True:
+        while not errors and len(in_flight) < concurrency:
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            in_flight.append((item, asyncio.ensure_future(func(item))))
+
+        if not in_flight:
+            break
+
+        item, task = in_flight.popleft()
+        try:
+            result = await task
+        except Exception as e:
+            errors.append(e)
+            continue
+
+        try:
+            await on_result(item, result)
+        except Exception as e:
+            errors.append(e)
+
+    if errors:
+        for e in errors[1:]:
+            sys.stderr.write('Error (after a previous error): %s\n' % (e,))
+        raise errors[0]
+
+
+class _AsyncCommit(object):
+
+    def __init__(self, api, concurrency):
+        self._api = api
+        self._concurrency = max(concurrency, 1)
+        self._loop = asyncio.get_event_loop()
+        self._transport = _Transport(api, self._loop)
+        self._headers = {'X-AuthToken': api.authorization_key}
+
+        # All the accesses to the local cache are done in this thread.
+        self._cache_executor = ThreadPoolExecutor(1)
+
+        # The content coding used in the requests (None: not compressed).
+        self._request_encoding = None
+        self._stats = CommitStats()
+
+        # Only one request at a time gets the benchmarks from the server.
+        self._server_benchmarks_lock = asyncio.Lock()
+
+        # Only one coroutine at a time loads the run contexts.
+        self._run_contexts_lock = asyncio.Lock()
+
+    def _run_in_cache_thread(self, func, *args):
+        return self._loop.run_in_executor(self._cache_executor, functools.partial(func, *args))
+
+    async def _post_and_check(self, url, json, msg):
+        api = self._api
+        encoding = self._request_encoding
+        kwargs, size, uncompressed_size = api._encode_request(json, self._headers, encoding)
+        r = await self._transport.post(url, allow_redirects=False, **kwargs)
+        if encoding is not None and r.status_code == 415:
+            # The server no longer accepts it: send it (and the next ones) uncompressed.
+            self._request_encoding = None
+            kwargs, size, uncompressed_size = api._encode_request(json, self._headers, None)
+            r = await self._transport.post(url, allow_redirects=False, **kwargs)
+
+        self._stats.add_request(uncompressed_size, size)
+        return api.check_request_result(r, msg + ' Url: %s, Json: %s' % (url, json), 201)
+
+    async def commit(self):
+        from pyspeedtin.run_context import prune_run_contexts
+        api = self._api
+        sys.stdout.write('Commit results...\n')
+        assert not api.base_url.endswith('/'), 'The base url must not end with a slash.'
+        try:
+            await self._run_in_cache_thread(api._merge_spool, self._stats)
+            self._request_encoding = await self._run_in_cache_thread(api._get_request_encoding)
+            has_server_benchmarks = await self._commit_benchmarks()
+            if await self._run_in_cache_thread(api._needs_request_encoding_probe):
+                # Note: the benchmarks from the server are also merged in the local cache.
+                await self._get_server_benchmarks(None)
+                has_server_benchmarks = True
+            self._request_encoding = await self._run_in_cache_thread(api._get_request_encoding)
+            await self._commit_measurements(has_server_benchmarks)
+            await self._run_in_cache_thread(prune_run_contexts, api._local_cache)
+        finally:
+            self._cache_executor.shutdown(wait=False)
+        sys.stdout.write('%s\n' % (self._stats,))
+        return self._stats
+
+    async def _commit_benchmarks(self):
+        api = self._api
+        known_benchmarks, pending_benchmarks = await self._run_in_cache_thread(api._count_benchmarks)
+        if not pending_benchmarks:
+            return False
+
+        # Benchmarks already in the server just have their ids saved in the local cache.
+        await self._get_server_benchmarks(known_benchmarks)
+
+        url = api._benchmarks_url()
+
+        async def post_benchmark(handle):
+            return await self._post_and_check(
+                url, handle.data, 'It was not possible to create the benchmark')
+
+        async def on_benchmark_saved(handle, as_json):
+            await self._run_in_cache_thread(handle.set_rest_data, as_json)
+            sys.stdout.write('Saved benchmark: %s\n' % (as_json,))
+
+        session = api._local_cache.load('benchmark', api.checkpoint_interval, pending_only=True)
+        await self._run_session(session, post_benchmark, on_benchmark_saved)
+        return True
+
+    async def _get_server_benchmarks(self, known_benchmarks):
+        api = self._api
+        headers = await self._run_in_cache_thread(api._get_benchmarks_headers, known_benchmarks)
+        r = await self._transport.get(api._benchmarks_url(), headers=headers)
+        return await self._run_in_cache_thread(api._on_benchmarks_response, r)
+
+    async def _commit_measurements(self, has_server_benchmarks):
+        from pyspeedtin.api import _BenchmarkIds
+        from pyspeedtin.run_context import RunContexts
+        api = self._api
+
+        benchmark_ids = await self._run_in_cache_thread(
+            _BenchmarkIds, api._local_cache, has_server_benchmarks)
+        run_contexts = RunContexts(api._local_cache)
+
+        async def post_measurement(handle):
+            if run_contexts.needs_load(handle.data):
+                async with self._run_contexts_lock:
+                    if run_contexts.needs_load(handle.data):
+                        await self._run_in_cache_thread(run_contexts.load)
+            benchmark_id, json = run_contexts.get_payload(handle.data)
+            if benchmark_ids.needs_server_benchmarks(benchmark_id):
+                async with self._server_benchmarks_lock:
+                    if benchmark_ids.needs_server_benchmarks(benchmark_id):
+                        benchmark_ids.add_server_benchmarks(
+                            await self._get_server_benchmarks(benchmark_ids.known_benchmarks))
+
+            return await self._post_and_check(
+                api._measurements_url(benchmark_ids.get_id(benchmark_id)),
+                json,
+                'It was not possible to create the measurement')
+
+        async def on_measurement_saved(handle, as_json):
+            sys.stdout.write('Saved measurement: %s\n' % (as_json,))
+            await self._run_in_cache_thread(handle.remove)
+
+        session = api._local_cache.load('measurement', api.checkpoint_interval)
+        await self._run_session(session, post_measurement, on_measurement_saved)
+
+    async def _run_session(self, session, func, on_result):
+        await self._run_in_cache_thread(session.__enter__)
+        try:
+            handles = await self._run_in_cache_thread(list, session)
+            await _map_in_order(handles, func, on_result, self._concurrency)
+        finally:
+            await self._run_in_cache_thread(session.__exit__, None, None, None)
+
+
+async def commit_async(api, concurrency=8):
+    return await _AsyncCommit(api, concurrency).commit()
@@ -0,0 +1,228 @@
+'''
+A BackgroundFlusher commits the measurements of a PySpeedTinApi in a daemon thread (so,
+add_measurement() just puts the measurement in a queue in memory and returns).
+
+I.e.:
+
+    api.start_background_flush(max_items=100, max_interval=5)
+    api.add_measurement(...)  # Returns right away.
+    ...
+    api.close()  # Flushes what's pending and stops the thread.
+
+The measurements in the queue are written to the local cache and committed whenever `max_items`
+are queued or the oldest one is queued for `max_interval` seconds (also on flush()/close() and
+when the process exits -- through atexit). If a commit fails, the measurements are kept in the
+local cache and are committed in the next flush (which is retried every `max_interval` seconds).
+
+If `max_pending` measurements are queued, being committed or in the local cache and still not
+committed (i.e.: the server is down), add() blocks until the flusher catches up.
+'''
+import atexit
+from collections import deque
+import sys
+import threading
+import time
+import traceback
+
+
+class BackgroundFlusher(object):
+
+    def __init__(self, api, max_items=100, max_interval=5.0, max_pending=10000, max_workers=1):
+        '''
+        :param int max_items:
+            A flush is started when this number of measurements is queued.
+
+        :param float max_interval:
+            A flush is started when the oldest measurement queued is there for this number of
+            seconds.
+
+        :param int max_pending:
+            The maximum number of measurements queued, being committed or in the local cache and
+            still not committed (add() blocks while this number is reached).
+
+        :param int max_workers:
+            Passed to api.commit().
+        '''
+        self._api = api
+        self.max_items = max_items
+        self.max_interval = max_interval
+        self.max_pending = max(max_pending, 1)
+        self.max_workers = max_workers
+
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._first_queued_time = None
+        self._in_flight = 0
+
+        # The measurements in the local cache which are still not committed (updated after each
+        # commit) and the time to commit them if nothing else is queued.
+        self._persisted = api._local_cache.count('measurement')
+        self._persisted_flush_time = time.time() + max_interval
+
+        # add() n is flushed when _flushed_seq >= n.
+        self._queued_seq = 0
+        self._flushed_seq = 0
+        # The number of flushes finished (whether they failed or not).
+        self._flush_count = 0
+        self._flush_requested = False
+        self._closing = False
+
+        # After a failure, the next flush is only started automatically after this time.
+        self._retry_time = 0
+
+        # The error in the last flush (None if it succeeded).
+        self.last_error = None
+
+        self._thread = threading.Thread(target=self._run, name='PySpeedTin background flusher')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, data):
+        with self._condition:
+            if self._closing:
+                raise RuntimeError('The background flusher is already closed.')
+            while len(self._queue) + self._in_flight + self._persisted >= self.max_pending:
+                self._condition.wait()
+                if self._closing:
+                    raise RuntimeError('The background flusher is already closed.')
+
+            notify = not self._queue  # The flusher must start waiting for max_interval.
+            if notify:
+                self._first_queued_time = time.time()
+            self._queue.append(data)
+            self._queued_seq += 1
+            if notify or len(self._queue) >= self.max_items:
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        '''
+        Commits the measurements added so far (and the ones of a previous flush which failed).
+
+        :return bool:
+            True if they were committed in the given timeout and False otherwise (if a commit
+            failed, see: last_error).
+        '''
+        with self._condition:
+            target_seq = self._queued_seq
+            if self._flushed_seq >= target_seq and not self._queue and self.last_error is None:
+                return True
+            # Note: if the last flush failed, a new one must be done (even if nothing was added).
+            target_count = self._flush_count + 1 if self.last_error is not None else 0
+            self._flush_requested = True
+            self._condition.notify_all()
+
+            end_time = None if timeout is None else time.time() + timeout
+            while self._flushed_seq < target_seq or self._flush_count < target_count:
+                if not self._thread.is_alive():
+                    return False
+                remaining = None if end_time is None else end_time - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return self.last_error is None
+
+    def close(self, timeout=None):
+        '''
+        Flushes what's pending and stops the thread.
+
+        :return bool:
+            True if everything was committed.
+        '''
+        try:
+            atexit.unregister(self.close)
+        except AttributeError:
+            pass  # Not available in Python 2.
+
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        return not self._thread.is_alive() and not self._queue and self.last_error is None
+
+    def _get_flush_delay(self):
+        '''
+        :return float|None:
+            The time until the next flush should be started (None if there's nothing to flush).
+
+        Note: must be called with the condition acquired.
+        '''
+        if self._closing or self._flush_requested:
+            return 0
+        if not self._queue:
+            if not self._persisted:
+                return None
+            # Only what's in the local cache (i.e.: a commit failed): it's committed again later on.
+            return max(0, self._persisted_flush_time - time.time())
+        flush_time = self._first_queued_time + self.max_interval
+        if len(self._queue) >= self.max_items:
+            flush_time = 0
+        return max(0, flush_time - time.time(), self._retry_time - time.time())
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    delay = self._get_flush_delay()
+                    if delay == 0:
+                        break
+                    self._condition.wait(delay)
+
+                items = list(self._queue)
+                self._queue.clear()
+                self._in_flight = len(items)
+                target_seq = self._queued_seq
+                self._flush_requested = False
+                closing = self._closing
+
+            error = None
+            stored = False
+            try:
+                self._api._store_measurements(items)
+                stored = True
+                self._api.commit(max_workers=self.max_workers)
+            except Exception as e:
+                error = e
+                sys.stderr.write('Error committing in the background (will retry in the next flush):\n')
+                traceback.print_exc()
+
+            if not stored and closing:
+                # Last chance: they'll be committed in a new run if they're in the local cache.
+                try:
+                    self._api._store_measurements(items)
+                    stored = True
+                except Exception:
+                    sys.stderr.write(
+                        'Error: %s measurement(s) could not be saved in the local cache and were '
+                        'discarded:\n' % (len(items),))
+                    traceback.print_exc()
+
+            persisted = None
+            if stored:
+                try:
+                    persisted = self._api._local_cache.count('measurement')
+                except Exception:
+                    traceback.print_exc()
+
+            with self._condition:
+                if persisted is not None:
+                    self._persisted = persisted
+                elif stored:
+                    self._persisted += len(items)
+                self._persisted_flush_time = time.time() + self.max_interval
+                if not stored and not closing:
+                    # Not even in the local cache: keep them to be stored in the next flush.
+                    self._queue.extendleft(reversed(items))
+                    if self._first_queued_time is None or len(self._queue) == len(items):
+                        self._first_queued_time = time.time()
+                if error is not None:
+                    self._retry_time = time.time() + self.max_interval
+                else:
+                    self._retry_time = 0
+                self.last_error = error
+                self._in_flight = 0
+                self._flushed_seq = target_seq
+                self._flush_count += 1
+                self._condition.notify_all()
+                if closing and (not self._queue or error is not None):
+                    return
@@ -0,0 +1,218 @@
+'''
+Compression of the shard spool files and of the bodies of the requests posted to the server.
+
+i.e.:
+
+    codec = get_codec('gzip')
+    compressed = codec.compress(contents)
+    codec.decompress(compressed)
+
+    # A stream where each write can be decompressed as soon as it's written (i.e.: appended to a
+    # file which may be read by another process before the stream is finished).
+    stream = codec.create_stream()
+    os.write(fd, stream.write(line))
+    os.write(fd, stream.finish())
+
+The codecs are 'gzip' (always available) and 'zstd' (if the zstandard library is installed).
+
+The server lists the content codings it accepts in requests in the Accept-Encoding header of its
+responses (RFC 7694), so, requests are only compressed if the server does so.
+'''
+import threading
+import zlib
+
+
+# The codecs which may be used to compress the requests (the first one accepted by the server
+# and available is used).
+REQUEST_ENCODINGS = ('zstd', 'gzip')
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class _GzipStream(object):
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+
+    def write(self, data):
+        # Note: a sync flush makes everything written so far decompressible.
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class GzipCodec(object):
+
+    name = 'gzip'
+    extension = '.gz'
+
+    def compress(self, contents):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+        return compressor.compress(contents) + compressor.flush()
+
+    def decompress(self, contents):
+        '''
+        Note: if the contents are truncated or the end is corrupt (i.e.: the stream was not
+        finished), what could be decompressed is returned.
+        '''
+        try:
+            return zlib.decompressobj(_GZIP_WBITS).decompress(contents)
+        except zlib.error:
+            pass
+
+        # Find the longest prefix which can be decompressed.
+        valid, invalid = 0, len(contents)
+        while invalid - valid > 1:
+            middle = (valid + invalid) // 2
+            try:
+                zlib.decompressobj(_GZIP_WBITS).decompress(contents[:middle])
+            except zlib.error:
+                invalid = middle
+            else:
+                valid = middle
+        return zlib.decompressobj(_GZIP_WBITS).decompress(contents[:valid])
+
+    def create_stream(self):
+        return _GzipStream()
+
+
+class _ZstdStream(object):
+
+    def __init__(self, zstandard):
+        self._compressor = zstandard.ZstdCompressor().compressobj()
+        self._flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+
+    def write(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(self._flush_block)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class ZstdCodec(object):
+
+    name = 'zstd'
+    extension = '.zst'
+
+    def __init__(self):
+        import zstandard
+        self._zstandard = zstandard
+
+    def compress(self, contents):
+        return self._zstandard.ZstdCompressor().compress(contents)
+
+    def decompress(self, contents):
+        return self._zstandard.ZstdDecompressor().decompressobj().decompress(contents)
+
+    def create_stream(self):
+        return _ZstdStream(self._zstandard)
+
+
+_factories = {'gzip': GzipCodec, 'zstd': ZstdCodec}
+_codecs = {}
+_lock = threading.Lock()
+
+
+def get_codec(name):
+    '''
+    :raise ValueError:
+        If there's no codec with the given name (or it's not available in this environment).
+    '''
+    codec = _codecs.get(name)
+    if codec is None:
+        with _lock:
+            try:
+                factory = _factories[name]
+            except KeyError:
+                raise ValueError('Unexpected compression: %s' % (name,))
+            try:
+                codec = factory()
+            except ImportError:
+                raise ValueError('The compression: %s is not available.' % (name,))
+            _codecs[name] = codec
+    return codec
+
+
+def get_codec_from_extension(extension):
+    '''
+    :return GzipCodec|ZstdCodec|NoneType:
+        The codec of the given file extension (None if it's not from a codec).
+
+    :raise ValueError:
+        If the codec of the extension is not available in this environment.
+    '''
+    for name, factory in _factories.items():
+        if factory.extension == extension:
+            return get_codec(name)
+    return None
+
+
+def is_codec_available(name):
+    try:
+        get_codec(name)
+    except ValueError:
+        return False
+    return True
+
+
+def choose_request_encoding(accept_encoding):
+    '''
+    :param str accept_encoding:
+        The Accept-Encoding header of a response from the server (i.e.: 'gzip, zstd;q=0.5').
+
+    :return str|NoneType:
+        The content coding to be used in the requests (None if no codec accepted by the server
+        is available).
+    '''
+    accepted = set()
+    for coding in (accept_encoding or '').split(','):
+        coding, _, params = coding.partition(';')
+        params = params.replace(' ', '')
+        if params in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+
+    for name in REQUEST_ENCODINGS:
+        if name in accepted and is_codec_available(name):
+            return name
+    return None
+
+
+class CommitStats(object):
+    '''
+    The bytes uploaded in a commit (and the bytes they'd have if they were not compressed).
+    '''
+
+    def __init__(self):
+        self.requests = 0
+        self.request_bytes = 0
+        self.request_uncompressed_bytes = 0
+        self.spool_bytes = 0
+        self.spool_uncompressed_bytes = 0
+        self._lock = threading.Lock()
+
+    def add_request(self, uncompressed_size, size):
+        with self._lock:
+            self.requests += 1
+            self.request_uncompressed_bytes += uncompressed_size
+            self.request_bytes += size
+
+    def add_spool(self, uncompressed_size, size):
+        with self._lock:
+            self.spool_uncompressed_bytes += uncompressed_size
+            self.spool_bytes += size
+
+    @property
+    def saved_bytes(self):
+        return (
+            self.request_uncompressed_bytes - self.request_bytes +
+            self.spool_uncompressed_bytes - self.spool_bytes)
+
+    def __str__(self):
+        msg = 'Uploaded %s request(s): %s bytes (%s uncompressed)' % (
+            self.requests, self.request_bytes, self.request_uncompressed_bytes)
+        if self.spool_uncompressed_bytes:
+            msg += '. Merged spool: %s bytes (%s uncompressed)' % (
+                self.spool_bytes, self.spool_uncompressed_bytes)
+        return msg + '. Saved: %s bytes.' % (self.saved_bytes,)
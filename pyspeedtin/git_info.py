@@ -0,0 +1,224 @@
+'''
+Gets the commit id, branch and commit date of a git repository reading the files in the .git
+dir directly (HEAD, loose refs, packed-refs and loose commit objects) instead of running git.
+
+git is only run (once, in the repo root) to get the commit date when the commit object is packed
+(or if the repository can't be read directly -- i.e.: some unsupported ref storage).
+
+The result is kept in memory for each repo root and it's only computed again when the HEAD, the
+ref it points to or the packed-refs change.
+
+i.e.:
+
+    commit_id, branch, commit_date = get_commit_id_branch_and_date(path)
+'''
+import datetime
+import os
+import subprocess
+import threading
+import zlib
+
+
+_SHA_LEN = 40
+
+# The max number of symbolic refs followed.
+_MAX_REF_DEPTH = 5
+
+# repo root -> (stamp, (commit_id, branch, commit_date))
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def find_repo_root(path):
+    '''
+    :return str:
+        The directory containing the .git (dir or file) for the given path.
+    '''
+    if not os.path.exists(path):
+        raise OSError('The path: %s does not exist.' % (path,))
+
+    repo_root = os.path.abspath(path)
+    while not os.path.exists(os.path.join(repo_root, '.git')):
+        initial = repo_root
+        repo_root = os.path.dirname(repo_root)
+        if initial == repo_root or not repo_root:
+            raise OSError('The path: %s does not seem to be a git-managed path.' % (path,))
+    return repo_root
+
+
+def _read_text(filename):
+    try:
+        with open(filename, 'rb') as stream:
+            return stream.read().decode('utf-8').strip()
+    except (IOError, OSError):
+        return None
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+class _GitDirs(object):
+
+    def __init__(self, repo_root):
+        git_path = os.path.join(repo_root, '.git')
+        if os.path.isfile(git_path):
+            # A worktree or submodule: the .git file points to the actual git dir.
+            contents = _read_text(git_path) or ''
+            if not contents.startswith('gitdir:'):
+                raise RuntimeError('Unexpected contents in: %s' % (git_path,))
+            git_path = os.path.normpath(os.path.join(repo_root, contents[len('gitdir:'):].strip()))
+
+        # Has the HEAD.
+        self.git_dir = git_path
+
+        # Has the refs and objects (different from the git_dir in a worktree).
+        common_dir = _read_text(os.path.join(git_path, 'commondir'))
+        if common_dir:
+            self.common_dir = os.path.normpath(os.path.join(git_path, common_dir))
+        else:
+            self.common_dir = git_path
+
+    def ref_files(self, ref):
+        if ref == 'HEAD' or not ref.startswith('refs/'):
+            return [os.path.join(self.git_dir, ref)]
+        # Note: in a worktree the refs are in the common dir.
+        return [os.path.join(self.git_dir, ref), os.path.join(self.common_dir, ref)]
+
+    @property
+    def packed_refs_file(self):
+        return os.path.join(self.common_dir, 'packed-refs')
+
+
+def _read_packed_refs(packed_refs_file):
+    refs = {}
+    contents = _read_text(packed_refs_file)
+    if contents:
+        for line in contents.splitlines():
+            if not line or line[0] in '#^':
+                continue  # Comment or peeled tag.
+            sha, _, ref = line.partition(' ')
+            refs[ref.strip()] = sha
+    return refs
+
+
+def _resolve(dirs):
+    '''
+    :return tuple(str, str, list(str)):
+        The commit id, the branch ('HEAD' if detached) and the files read (to be checked for
+        changes).
+    '''
+    files = []
+    ref = 'HEAD'
+    branch = None
+    packed_refs = None
+    for _i in range(_MAX_REF_DEPTH):
+        contents = None
+        for ref_file in dirs.ref_files(ref):
+            files.append(ref_file)
+            contents = _read_text(ref_file)
+            if contents:
+                break
+
+        if not contents:
+            if packed_refs is None:
+                files.append(dirs.packed_refs_file)
+                packed_refs = _read_packed_refs(dirs.packed_refs_file)
+            contents = packed_refs.get(ref)
+            if not contents:
+                raise RuntimeError('Unable to resolve ref: %s in: %s' % (ref, dirs.git_dir))
+
+        if contents.startswith('ref:'):
+            ref = contents[len('ref:'):].strip()
+            if branch is None:
+                branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+            continue
+
+        if len(contents) != _SHA_LEN:
+            raise RuntimeError('Unexpected contents for ref: %s in: %s' % (ref, dirs.git_dir))
+        return contents, branch or 'HEAD', files
+
+    raise RuntimeError('Too many symbolic refs for HEAD in: %s' % (dirs.git_dir,))
+
+
+def _read_loose_commit_time(dirs, commit_id):
+    '''
+    :return int|None:
+        The committer timestamp of the commit (None if it's not a loose object).
+    '''
+    object_file = os.path.join(dirs.common_dir, 'objects', commit_id[:2], commit_id[2:])
+    try:
+        with open(object_file, 'rb') as stream:
+            contents = zlib.decompress(stream.read())
+    except (IOError, OSError, zlib.error):
+        return None
+
+    header, _, body = contents.partition(b'\0')
+    if not header.startswith(b'commit '):
+        return None
+    for line in body.split(b'\n'):
+        if not line:
+            break  # End of the headers (the message follows).
+        if line.startswith(b'committer '):
+            # committer Name <email> <timestamp> <tz>
+            return int(line.rsplit(b' ', 2)[1])
+    return None
+
+
+def _run_git(args, repo_root):
+    output = subprocess.check_output(['git'] + args, cwd=repo_root)
+    return output.strip().decode('utf-8')
+
+
+def _compute(repo_root):
+    try:
+        dirs = _GitDirs(repo_root)
+        commit_id, branch, files = _resolve(dirs)
+    except (RuntimeError, ValueError):
+        # Let git itself handle it.
+        output = _run_git(['log', '-1', '--format=%H%n%ct', 'HEAD'], repo_root).splitlines()
+        branch = _run_git(['rev-parse', '--abbrev-ref', 'HEAD'], repo_root)
+        return None, (output[0], branch, int(output[1]))
+
+    commit_time = _read_loose_commit_time(dirs, commit_id)
+    if commit_time is None:
+        commit_time = int(_run_git(['log', '-1', '--format=%ct', commit_id], repo_root))
+
+    # If any of these change, it must be computed again.
+    stamp = tuple((f, _mtime(f)) for f in files)
+    return stamp, (commit_id, branch, commit_time)
+
+
+def _is_current(stamp):
+    return stamp is not None and all(_mtime(f) == mtime for f, mtime in stamp)
+
+
+def get_commit_id_branch_and_date(path):
+    '''
+    :param str path:
+        The repo root or some file/dir inside it.
+
+    :return tuple(str, str, datetime.datetime):
+        The commit id, branch ('HEAD' if detached) and the commit date (utc) of the HEAD of the
+        repository.
+    '''
+    repo_root = find_repo_root(path)
+    with _cache_lock:
+        cached = _cache.get(repo_root)
+    if cached is not None and _is_current(cached[0]):
+        result = cached[1]
+    else:
+        stamp, result = _compute(repo_root)
+        with _cache_lock:
+            _cache[repo_root] = (stamp, result)
+
+    commit_id, branch, commit_time = result
+    return commit_id, branch, datetime.datetime.utcfromtimestamp(commit_time)
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,282 @@
+'''
+Low overhead latency instrumentation which may be kept enabled in production code.
+
+i.e.:
+
+    recorder = LatencyRecorder(api, interval=60)
+
+    @recorder.timed('handle_request')
+    def handle_request():
+        ...
+
+    with recorder.section('load_users'):
+        ...
+
+Each call just increments a counter in a histogram of the current thread (so, no locks are
+needed). Periodically (every `interval` seconds, in a daemon thread) the histograms of all the
+threads are aggregated and the percentiles of each name are added as measurements of the
+benchmarks '<name> p50', '<name> p95' and '<name> p99' (in seconds).
+
+The histogram has log buckets (each power of 2 is split in 32 sub-buckets -- as in an HDR
+histogram), so, the percentiles have a relative error of at most ~1.6%.
+
+Note: a call recorded while the histograms are being aggregated may be lost.
+'''
+from array import array
+import functools
+import sys
+import threading
+import time
+import traceback
+
+from pyspeedtin.api import MAX_BENCHMARK_NAME_SIZE, _check_benchmark_name
+
+
+_SUB_BUCKET_BITS = 6
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS  # Values below this have their own bucket.
+_HALF_SUB_BUCKETS = _SUB_BUCKETS >> 1
+
+# Values (in nanoseconds) are capped at 2 ** 40 (~18 minutes).
+_MAX_VALUE_BITS = 40
+_MAX_VALUE = (1 << _MAX_VALUE_BITS) - 1
+_BUCKETS = _SUB_BUCKETS + (_MAX_VALUE_BITS - _SUB_BUCKET_BITS) * _HALF_SUB_BUCKETS
+
+
+if hasattr(time, 'perf_counter_ns'):
+    _timer_ns = time.perf_counter_ns
+else:
+
+    def _timer_ns():
+        return int(time.perf_counter() * 1e9)
+
+
+def _bucket_index(value):
+    if value < _SUB_BUCKETS:
+        return value if value > 0 else 0
+    if value > _MAX_VALUE:
+        value = _MAX_VALUE
+    shift = value.bit_length() - _SUB_BUCKET_BITS
+    return _SUB_BUCKETS + (shift - 1) * _HALF_SUB_BUCKETS + ((value >> shift) - _HALF_SUB_BUCKETS)
+
+
+def _bucket_value(index):
+    '''
+    :return float:
+        The value in the middle of the bucket.
+    '''
+    if index < _SUB_BUCKETS:
+        return float(index)
+    shift = (index - _SUB_BUCKETS) // _HALF_SUB_BUCKETS + 1
+    sub_bucket = (index - _SUB_BUCKETS) % _HALF_SUB_BUCKETS + _HALF_SUB_BUCKETS
+    return (sub_bucket << shift) + (1 << shift) / 2.0
+
+
+class LogHistogram(object):
+
+    def __init__(self):
+        self.counts = array('q', [0]) * _BUCKETS
+        self.total = 0
+
+    def record(self, value):
+        '''
+        :param int value:
+            The value in nanoseconds.
+        '''
+        self.counts[_bucket_index(value)] += 1
+        self.total += 1
+
+    def merge(self, other):
+        counts = self.counts
+        for i, count in enumerate(other.counts):
+            if count:
+                counts[i] += count
+        self.total += other.total
+
+    def percentile(self, percentile):
+        '''
+        :return float:
+            The value (in nanoseconds) at the given percentile (0-100).
+        '''
+        if not self.total:
+            raise ValueError('No values recorded.')
+        rank = max(1, int(round(percentile / 100.0 * self.total)))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return _bucket_value(i)
+        raise AssertionError('Percentile not found.')
+
+
+class _ThreadHistograms(object):
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+
+        # name -> LogHistogram (replaced by a new dict when aggregated).
+        self.histograms = {}
+
+
+class _Section(object):
+
+    __slots__ = ['_recorder', '_name', '_start']
+
+    def __init__(self, recorder, name):
+        self._recorder = recorder
+        self._name = name
+        self._start = 0
+
+    def __enter__(self):
+        self._start = _timer_ns()
+        return self
+
+    def __exit__(self, *args):
+        self._recorder.record(self._name, _timer_ns() - self._start)
+
+
+class LatencyRecorder(object):
+
+    def __init__(self, api, interval=60.0, percentiles=(50, 95, 99), **kwargs):
+        '''
+        :param PySpeedTinApi api:
+            Used to add the benchmarks and measurements.
+
+        :param float interval:
+            The histograms are aggregated every `interval` seconds (if None, only when
+            aggregate() is called).
+
+        :param tuple(int) percentiles:
+            The percentiles added as measurements.
+
+        :param kwargs:
+            Passed to api.add_measurement() (i.e.: version, branch, ...).
+        '''
+        self._api = api
+        self.percentiles = tuple(percentiles)
+        self._measurement_kwargs = kwargs
+        self._local = threading.local()
+
+        # All the _ThreadHistograms (only changed with the lock held).
+        self._lock = threading.Lock()
+        self._thread_histograms = []
+
+        self._stop_event = threading.Event()
+        self._thread = None
+        if interval is not None:
+            self._thread = threading.Thread(
+                target=self._run, args=(interval,), name='PySpeedTin latency recorder')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def timed(self, name):
+        '''
+        Decorator to record the time of each call of the decorated function.
+        '''
+        self._check_name(name)
+
+        def decorator(func):
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = _timer_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, _timer_ns() - start)
+
+            return wrapper
+
+        return decorator
+
+    def section(self, name):
+        '''
+        Context manager to record the time of the code in it.
+        '''
+        self._check_name(name)
+        return _Section(self, name)
+
+    def record(self, name, value):
+        '''
+        :param int value:
+            The time (in nanoseconds).
+        '''
+        try:
+            histograms = self._local.thread_histograms.histograms
+        except AttributeError:
+            histograms = self._register_thread().histograms
+
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = LogHistogram()
+        histogram.record(value)
+
+    def aggregate(self):
+        '''
+        Adds the percentiles of the values recorded since the last aggregation as measurements.
+
+        :return dict(str, LogHistogram):
+            The aggregated histograms.
+        '''
+        with self._lock:
+            thread_histograms = list(self._thread_histograms)
+            self._thread_histograms = [
+                t for t in thread_histograms if t.thread.is_alive()]
+
+        merged = {}
+        for t in thread_histograms:
+            histograms = t.histograms
+            t.histograms = {}
+            for name, histogram in list(histograms.items()):
+                current = merged.get(name)
+                if current is None:
+                    merged[name] = histogram
+                else:
+                    current.merge(histogram)
+
+        api = self._api
+        for name, histogram in sorted(merged.items()):
+            for percentile in self.percentiles:
+                benchmark_name = '%s p%s' % (name, percentile)
+                api.add_benchmark(benchmark_name)
+                kwargs = self._measurement_kwargs.copy()
+                kwargs.setdefault('tag1', 'count=%s' % (histogram.total,))
+                api.add_measurement(benchmark_name, histogram.percentile(percentile) / 1e9, **kwargs)
+        return merged
+
+    def close(self):
+        '''
+        Stops the periodic aggregation and aggregates what's still pending.
+        '''
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.aggregate()
+
+    def _register_thread(self):
+        thread_histograms = self._local.thread_histograms = _ThreadHistograms()
+        with self._lock:
+            self._thread_histograms.append(thread_histograms)
+        return thread_histograms
+
+    def get_max_name_size(self):
+        '''
+        :return int:
+            The maximum size of a name (so that the benchmark name with any of the percentile
+            suffixes has at most MAX_BENCHMARK_NAME_SIZE chars).
+        '''
+        suffix_sizes = [len(' p%s' % (percentile,)) for percentile in self.percentiles]
+        return MAX_BENCHMARK_NAME_SIZE - max(suffix_sizes or [0])
+
+    def _check_name(self, name):
+        # The benchmarks added are '<name> p<percentile>' (see: aggregate).
+        for percentile in self.percentiles:
+            _check_benchmark_name('%s p%s' % (name, percentile))
+
+    def _run(self, interval):
+        while not self._stop_event.wait(interval):
+            try:
+                self.aggregate()
+            except Exception:
+                sys.stderr.write('Error aggregating latencies:\n')
+                traceback.print_exc()
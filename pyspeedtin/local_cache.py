@@ -1,25 +1,21 @@
-import datetime
+from collections import OrderedDict
+import hashlib
 import json
 from os.path import os
 import re
+import threading
+import uuid
 
+from pyspeedtin.serializers import DEFAULT_SERIALIZER, date_to_str, default_convert, get_serializer, \
+    json_dumps
 from pyspeedtin.system_mutex import timed_acquire_mutex
 
-def date_to_str(date):
-    return date.strftime('%Y-%m-%d %H:%M:%S.%f')
-
-def json_dumps(obj):
-    return json.dumps(obj, default=default_convert)
-
-def default_convert(obj):
-    if obj.__class__ == datetime.datetime:
-        return date_to_str(obj)
-    raise TypeError("Type not serializable: %s" % (obj,))
-
 class _HandleData(object):
 
-    def __init__(self, handle_data):
+    def __init__(self, handle_data, bucket=None, record_id=None):
         self._handle_data = handle_data
+        self._bucket = bucket
+        self._record_id = record_id
         self._changed = False
         self._remove = False
 
@@ -27,69 +23,573 @@ class _HandleData(object):
         return bool(self._handle_data.get('rest_data'))
 
     def set_rest_data(self, rest_data):
+        if self._bucket is not None:
+            _check_writable(self._bucket)
         self._handle_data['rest_data'] = rest_data
         self._changed = True
+        if self._bucket is not None:
+            self._bucket._on_set_rest_data(self)
 
     def remove(self):
+        if self._bucket is not None:
+            _check_writable(self._bucket)
         self._changed = True
         self._remove = True
+        if self._bucket is not None:
+            self._bucket._on_remove(self)
 
     data = property(lambda self: self._handle_data['data'])
     rest_data = property(lambda self: self._handle_data['rest_data'])
 
-try:
-    xrange  # @UndefinedVariable
-except:
-    xrange = range
+# Kinds of the records written to a bucket journal.
+_OP_ADD = 'a'
+_OP_SET_REST_DATA = 's'
+_OP_REMOVE = 'r'
+
+# Version 1 had no serializer in the header (it was always saved with the stdlib json).
+_JOURNAL_VERSION = 2
+
+# The journal is compacted when it has at least this number of dead records and they outnumber
+# the live records.
+COMPACT_MIN_DEAD_RECORDS = 64
+
+# The index of a bucket is saved to disk when at least this number of records was applied to it
+# since it was last saved (smaller changes are just read again from the end of the journal).
+INDEX_SAVE_MIN_RECORDS = 256
+
+# The maximum number of records (in all the buckets) kept in memory by a JournalBackend (the
+# records of the buckets least recently used are dropped first -- their indexes are still kept).
+CACHE_MAX_RECORDS = 100000
+
+
+def _normalize_for_digest(obj):
+    '''
+    :return:
+        The object converted so that objects which compare equal have the same json
+        representation or _NOT_COMPARABLE if it can never be equal to some data read from the
+        disk (i.e.: it has a tuple, datetime or a nan, which are never equal to what's loaded
+        from json).
+    '''
+    cls = obj.__class__
+    if cls is dict:
+        ret = {}
+        for key, val in obj.items():
+            if key.__class__ is not str:
+                return _NOT_COMPARABLE
+            val = _normalize_for_digest(val)
+            if val is _NOT_COMPARABLE:
+                return _NOT_COMPARABLE
+            ret[key] = val
+        return ret
+
+    if cls is list:
+        ret = []
+        for val in obj:
+            val = _normalize_for_digest(val)
+            if val is _NOT_COMPARABLE:
+                return _NOT_COMPARABLE
+            ret.append(val)
+        return ret
+
+    if cls is bool:
+        return int(obj)
+
+    if cls is float:
+        if obj != obj:  # nan
+            return _NOT_COMPARABLE
+        if obj.is_integer():
+            return int(obj)
+        return obj
+
+    if obj is None or cls in (str, int):
+        return obj
+
+    return _NOT_COMPARABLE
+
+
+_NOT_COMPARABLE = object()
+
+
+def content_digest(data):
+    '''
+    :return str|NoneType:
+        A digest of the canonical json of the given data (data which compares equal has the same
+        digest) or None if the data can never be equal to data read from a bucket.
+    '''
+    data = _normalize_for_digest(data)
+    if data is _NOT_COMPARABLE:
+        return None
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class _BucketIndex(object):
+    '''
+    A summary of the journal of a bucket up to a given offset, with the digest of the data of
+    each live record (so, checking for duplicates doesn't need to read the whole journal, just
+    the records appended after the offset).
+
+    It's saved next to the bucket and is rebuilt when missing or stale (i.e.: when the journal
+    is compacted its generation changes). The file has 2 lines: a summary (see: to_json) and the
+    digests (so, the number of records can be known without reading all the digests).
+    '''
+
+    def __init__(self):
+        self.generation = None
+        self.offset = 0
+        self.next_id = 0
+        self.total_records = 0
+
+        # record id -> digest of its data
+        self.digests = {}
+
+        # digest -> ids of the live records with that digest
+        self._ids = {}
+
+        # Number of records applied since it was loaded/saved.
+        self.unsaved_records = 0
+
+    @property
+    def live_records(self):
+        return len(self.digests)
+
+    def __contains__(self, digest):
+        return digest in self._ids
+
+    def find(self, digest):
+        '''
+        :return int|NoneType:
+            The id of a live record with the given digest (None if there's no such record).
+        '''
+        ids = self._ids.get(digest)
+        if ids:
+            return ids[0]
+        return None
+
+    def on_add(self, record_id, data):
+        self._add_digest(record_id, content_digest(data))
+
+    def _add_digest(self, record_id, digest):
+        self.digests[record_id] = digest
+        ids = self._ids.get(digest)
+        if ids is None:
+            self._ids[digest] = [record_id]
+        else:
+            ids.append(record_id)
+
+    def on_remove(self, record_id):
+        digest = self.digests.pop(record_id)
+        ids = self._ids[digest]
+        ids.remove(record_id)
+        if not ids:
+            del self._ids[digest]
+
+    def to_json(self):
+        '''
+        :return dict:
+            The summary of the index (without the digests -- see: digests_to_json).
+        '''
+        return {
+            'generation': self.generation,
+            'offset': self.offset,
+            'next_id': self.next_id,
+            'total_records': self.total_records,
+            'live_records': self.live_records,
+        }
+
+    def digests_to_json(self):
+        return list(self.digests.items())
+
+    @classmethod
+    def from_json(cls, contents, digests):
+        index = cls()
+        index.generation = contents['generation']
+        index.offset = contents['offset']
+        index.next_id = contents['next_id']
+        index.total_records = contents['total_records']
+        for record_id, digest in digests:
+            index._add_digest(record_id, digest)
+        return index
+
+
+class _Journal(object):
+    '''
+    The contents of a bucket are kept in an append-only journal: a header line (json with the
+    version of the journal and the name of the serializer of the records) followed by one record
+    per line.
+
+    Each record is one of:
+
+        {"o": "a", "i": <id>, "d": <data>, "r": <rest_data>}  # Add
+        {"o": "s", "i": <id>, "r": <rest_data>}  # Set rest data (supersedes the previous one)
+        {"o": "r", "i": <id>}  # Remove
+
+    So, adding some data is a single append and changing/removing it appends a record which makes
+    the previous ones dead (dead records are dropped when the journal is compacted).
+
+    Buckets saved in previous formats (a json list with all the contents, a journal without the
+    serializer in the header or with some other serializer) are still read and are converted to
+    the current format (with the given serializer) on the first write.
+    '''
+
+    def __init__(self, contents_file, compact_min_dead=COMPACT_MIN_DEAD_RECORDS, serializer=None):
+        self.contents_file = contents_file
+        self.compact_min_dead = compact_min_dead
+        self.serializer = serializer if serializer is not None else get_serializer()
+
+        # record id -> handle data ({'data': ..., 'rest_data': ...}) (None if only the index was
+        # loaded).
+        self.records = None
+        self.index = _BucketIndex()
+
+        # When True the contents on disk are not in the current journal format (or were written
+        # with another serializer) or its last record was not completely written (so, it must be
+        # rewritten before appending to it).
+        self.needs_rewrite = False
+
+        # Records applied in memory but still not written to disk.
+        self._pending = []
+
+    def read(self, index=None, load_records=True, records=None):
+        '''
+        :param _BucketIndex index:
+            A previously computed index. If it still matches the journal, only the records after
+            its offset are read to update it.
+
+        :param bool load_records:
+            If False, only the index is updated (and self.records is None).
+
+        :param OrderedDict records:
+            The records previously read along with the given index (if the index still matches
+            the journal, they're updated with the records after its offset).
+        '''
+        if load_records or records is not None:
+            self.records = OrderedDict()
+
+        if not os.path.exists(self.contents_file):
+            return self
+
+        with open(self.contents_file, 'rb') as stream:
+            header_line = stream.readline()
+            if not header_line.strip():
+                self.needs_rewrite = bool(header_line)
+                return self
+
+            if header_line.lstrip().startswith(b'['):
+                # Old format: a json list with all the handle data.
+                index = self.index
+                contents = json.loads((header_line + stream.read()).decode('utf-8'))
+                for handle_data in contents:
+                    if self.records is not None:
+                        self.records[index.next_id] = handle_data
+                    index.on_add(index.next_id, handle_data['data'])
+                    index.next_id += 1
+                index.total_records = index.unsaved_records = len(contents)
+                self.needs_rewrite = True
+                return self
+
+            if not header_line.endswith(b'\n'):
+                # The header itself was not completely written.
+                self.needs_rewrite = True
+                return self
+
+            header = json.loads(header_line.decode('utf-8'))
+            version = header.get('journal')
+            if version == 1:
+                loads = json.loads
+                self.needs_rewrite = True
+            elif version == _JOURNAL_VERSION:
+                serializer_name = header['serializer']
+                loads = get_serializer(serializer_name).loads
+                if serializer_name != self.serializer.name:
+                    self.needs_rewrite = True
+            else:
+                raise RuntimeError('Unexpected bucket format in: %s' % (self.contents_file,))
+            generation = header['generation']
+
+            if (
+                    index is not None and
+                    index.generation == generation and
+                    len(header_line) <= index.offset <= os.fstat(stream.fileno()).st_size):
+                self.index = index
+                if records is not None:
+                    self.records = records
+                    stream.seek(index.offset)
+                elif self.records is not None:
+                    # The records are still needed, but the index is only updated for the tail.
+                    self._apply_lines(stream.read(index.offset - len(header_line)), False, loads)
+                else:
+                    stream.seek(index.offset)
+            else:
+                self.index.generation = generation
+                self.index.offset = len(header_line)
+
+            self._apply_lines(stream.read(), True, loads)
+        return self
 
+    def _apply_lines(self, contents, update_index, loads):
+        lines = contents.split(b'\n')
+        if lines[-1]:
+            # The last write was interrupted: discard the partial record.
+            self.needs_rewrite = True
+        del lines[-1]
+
+        if update_index:
+            self.index.offset += sum(len(line) + 1 for line in lines)
+
+        for line in lines:
+            if line:
+                self._apply(loads(line), update_index)
+
+    def _apply(self, record, update_index=True):
+        op = record['o']
+        record_id = record['i']
+        records = self.records
+        index = self.index
+
+        if op == _OP_ADD:
+            if records is not None:
+                records[record_id] = {'rest_data': record['r'], 'data': record['d']}
+            if update_index:
+                index.on_add(record_id, record['d'])
+                if record_id >= index.next_id:
+                    index.next_id = record_id + 1
+
+        elif op == _OP_SET_REST_DATA:
+            if records is not None:
+                records[record_id]['rest_data'] = record['r']
+
+        elif op == _OP_REMOVE:
+            if records is not None:
+                del records[record_id]
+            if update_index:
+                index.on_remove(record_id)
+
+        else:
+            raise RuntimeError('Unexpected record: %s in: %s' % (record, self.contents_file))
+
+        if update_index:
+            index.total_records += 1
+            index.unsaved_records += 1
+
+    def count_live_records(self, summary):
+        '''
+        Counts the live records reading just the records after the offset of a saved index.
+
+        :param dict summary:
+            The summary of a saved index (see: _BucketIndex.to_json).
+
+        :return int|NoneType:
+            The number of live records (None if the index doesn't match the journal).
+        '''
+        if not os.path.exists(self.contents_file):
+            return 0
+
+        with open(self.contents_file, 'rb') as stream:
+            header_line = stream.readline()
+            if not header_line.endswith(b'\n') or header_line.lstrip().startswith(b'['):
+                return None
+            header = json.loads(header_line.decode('utf-8'))
+            if header.get('journal') != _JOURNAL_VERSION or header['generation'] != summary['generation']:
+                return None
+            offset = summary['offset']
+            if not len(header_line) <= offset <= os.fstat(stream.fileno()).st_size:
+                return None
+
+            stream.seek(offset)
+            loads = get_serializer(header['serializer']).loads
+            live_records = summary['live_records']
+            # Note: the last line is either empty or a record whose write was interrupted.
+            for line in stream.read().split(b'\n')[:-1]:
+                if line:
+                    op = loads(line)['o']
+                    if op == _OP_ADD:
+                        live_records += 1
+                    elif op == _OP_REMOVE:
+                        live_records -= 1
+        return live_records
+
+    @property
+    def dead_records(self):
+        return self.index.total_records - self.index.live_records
+
+    @property
+    def pending_records(self):
+        return len(self._pending)
+
+    def add(self, data, rest_data=''):
+        record_id = self.index.next_id
+        self._stage({'o': _OP_ADD, 'i': record_id, 'd': data, 'r': rest_data})
+        return record_id
+
+    def set_rest_data(self, record_id, rest_data):
+        self._stage({'o': _OP_SET_REST_DATA, 'i': record_id, 'r': rest_data})
+
+    def remove(self, record_id):
+        self._stage({'o': _OP_REMOVE, 'i': record_id})
+
+    def _stage(self, record):
+        serializer = self.serializer
+        encoded = serializer.dumps(record)
+        # Apply what was actually serialized (i.e.: datetimes as strings) so that the contents in
+        # memory are the same ones which will be read later on.
+        self._apply(serializer.loads(encoded))
+        self._pending.append(encoded)
+
+    def flush(self):
+        '''
+        Writes the records staged so far.
+
+        Usually this is a single append, but if the journal has to be rewritten (new file, old
+        format, interrupted write or too many dead records) it's compacted instead (which
+        atomically replaces the file with one having all the live records).
+        '''
+        if not self._pending:
+            return
+
+        dead_records = self.dead_records
+        if (
+                self.index.generation is None or
+                self.needs_rewrite or
+                (dead_records >= self.compact_min_dead and dead_records > self.index.live_records)):
+            self.compact()
+            return
+
+        contents = b'\n'.join(self._pending) + b'\n'
+        with open(self.contents_file, 'ab') as stream:
+            stream.write(contents)
+        self.index.offset += len(contents)
+        self._pending = []
+
+    def compact(self):
+        '''
+        Rewrites the journal with just the live records (the ids are kept).
+        '''
+        if self.records is None:
+            # Only the index was loaded: the records must be read now (along with what's staged).
+            journal = _Journal(self.contents_file, self.compact_min_dead, self.serializer).read()
+            for encoded in self._pending:
+                journal._apply(self.serializer.loads(encoded))
+            self.records = journal.records
+            self.index = journal.index
+
+        generation = _new_generation()
+        dumps = self.serializer.dumps
+        contents = [_journal_header(generation, self.serializer.name)]
+        for record_id, handle_data in self.records.items():
+            contents.append(dumps(
+                {'o': _OP_ADD, 'i': record_id, 'd': handle_data['data'], 'r': handle_data['rest_data']}))
+        contents = b'\n'.join(contents) + b'\n'
+
+        _write_atomic(self.contents_file, contents)
+
+        index = self.index
+        index.generation = generation
+        index.offset = len(contents)
+        index.total_records = index.live_records
+        index.unsaved_records = index.live_records
+        self.needs_rewrite = False
+        self._pending = []
+
+
+def _write_atomic(filename, contents):
+    '''
+    Writes the contents to a temporary file which then replaces the given file (so, readers see
+    either the old or the new contents, never a partially written file).
+    '''
+    temp_filename = '%s.%s.tmp' % (filename, uuid.uuid4().hex)
+    try:
+        with open(temp_filename, 'wb') as stream:
+            stream.write(contents)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(temp_filename, filename)
+    except:
+        try:
+            os.remove(temp_filename)
+        except:
+            pass
+        raise
 
-class _IteratorWithRemove(object):
 
-    def __init__(self, lst):
-        self.lst = lst
-        self.i = 0
+def _new_generation():
+    return uuid.uuid4().hex
 
-    def remove(self):
-        del self.lst[self.i]
-        self.i -= 1
 
-    def __iter__(self):
-        while True:
-            if self.i >= len(self.lst):
-                break
-            yield self.lst[self.i]
-            self.i += 1
+def _journal_header(generation, serializer_name):
+    # Note: the header is always json (the serializer of the records is only known after it's read).
+    return json_dumps({
+        'journal': _JOURNAL_VERSION,
+        'generation': generation,
+        'serializer': serializer_name,
+    }).encode('utf-8')
 
 
 class _Bucket(object):
+    '''
+    A session to iterate over the contents of a bucket (while the bucket mutex is held).
+
+    Changes done through the handles are kept in memory and are written when the session exits
+    (even if it exits with an exception) or whenever `checkpoint_interval` changes are pending
+    (so, if the process is killed, at most `checkpoint_interval` changes are lost).
+
+    A read only session holds the bucket mutex in shared mode (so, other readers aren't blocked)
+    and the handles can't be changed.
+    '''
 
-    def __init__(self, local_cache, bucket_name):
-        self._local_cache = local_cache
+    def __init__(self, backend, bucket_name, checkpoint_interval=None, pending_only=False, read_only=False):
+        self._backend = backend
         self._bucket_name = bucket_name
+        self._checkpoint_interval = checkpoint_interval
+        self._pending_only = pending_only
+        self._read_only = read_only
         self._mutex_handle = None
+        self._journal = None
 
     def __enter__(self, *args, **kwargs):
-        self._mutex_handle = mutex_handle = timed_acquire_mutex(_get_mutex_name(self._bucket_name))
+        self._mutex_handle = mutex_handle = self._backend._acquire_mutex(
+            self._bucket_name, shared=self._read_only)
         mutex_handle.__enter__()
         return self
 
     def __exit__(self, *args, **kwargs):
-        self._mutex_handle.__exit__()
-        self._mutex_handle = None
+        try:
+            journal = self._journal
+            if journal is not None:
+                self._journal = None
+                journal.flush()
+                self._backend._release_journal(self._bucket_name, journal)
+        finally:
+            self._mutex_handle.__exit__()
+            self._mutex_handle = None
 
     def __iter__(self):
         assert self._mutex_handle is not None
-        contents_file = self._local_cache._get_contents_file(self._bucket_name)
-        data = self._local_cache._get_current_data(contents_file)
-        it = _IteratorWithRemove(data)
-        for handle_data in it:
-            h = _HandleData(handle_data)
-            yield h
-            if h._changed:
-                if h._remove:
-                    it.remove()
-                with open(contents_file, 'w') as stream:
-                    stream.write(json_dumps((data)))
+        self._journal = journal = self._backend._get_journal(self._bucket_name)
+        for record_id, handle_data in list(journal.records.items()):
+            if self._pending_only and handle_data.get('rest_data'):
+                continue
+            yield _HandleData(handle_data, self, record_id)
+
+    def flush(self):
+        '''
+        Writes the changes done so far.
+        '''
+        if self._journal is not None:
+            self._journal.flush()
+
+    def _on_set_rest_data(self, handle):
+        self._journal.set_rest_data(handle._record_id, handle.rest_data)
+        self._on_change()
+
+    def _on_remove(self, handle):
+        self._journal.remove(handle._record_id)
+        self._on_change()
+
+    def _on_change(self):
+        checkpoint_interval = self._checkpoint_interval
+        if checkpoint_interval and self._journal.pending_records >= checkpoint_interval:
+            self._journal.flush()
 
 
 def check_valid_bucket_name(bucket_name):
@@ -100,60 +600,360 @@ def check_valid_bucket_name(bucket_name):
         raise AssertionError('Bucket name is invalid: %s' % (bucket_name,))
 
 
+def _check_writable(bucket_session):
+    if bucket_session._read_only:
+        raise RuntimeError('Unable to change the bucket: %s (loaded as read only).' % (
+            bucket_session._bucket_name,))
+
+
 def _get_mutex_name(bucket):
-    return 'pyspeedtin_%s' % (bucket,)
+    # Note: the lock file is created in the data dir (so, it's scoped to the project).
+    return '%s.lock' % (bucket,)
+
+
+class JournalBackend(object):
+    '''
+    Keeps each bucket in a journal file in the data dir (access to a bucket is synchronized
+    among processes with a system mutex whose lock file is also in the data dir).
+    '''
+
+    def __init__(
+        self,
+        data_dir,
+        compact_min_dead=COMPACT_MIN_DEAD_RECORDS,
+        max_cached_records=CACHE_MAX_RECORDS,
+        serializer=DEFAULT_SERIALIZER,
+    ):
+        '''
+        :param int max_cached_records:
+            The maximum number of records kept in memory (see: _CachedBucket).
+
+        :param str serializer:
+            The name of the serializer used to write the buckets (see: pyspeedtin.serializers).
+        '''
+        self._data_dir = data_dir
+        self._serializer = get_serializer(serializer)
+        self._compact_min_dead = compact_min_dead
+        self._max_cached_records = max_cached_records
+
+        # bucket name -> _CachedBucket (as of the last time the bucket was accessed in this
+        # process, the least recently used first).
+        self._cache = OrderedDict()
+
+        # The bucket mutex is held per thread, but the cache is shared by all the threads.
+        self._cache_lock = threading.Lock()
+
+    def add(self, bucket_name, data, rest_data=''):
+        self.add_many(bucket_name, [(data, rest_data)])
+
+    def add_many(self, bucket_name, items):
+        with self._acquire_mutex(bucket_name):
+            journal = self._get_journal(bucket_name, load_records=False)
+
+            for data, rest_data in items:
+                # Don't add duplicate data
+                digest = content_digest(data)
+                if digest is None or digest not in journal.index:
+                    journal.add(data, rest_data)
+            journal.flush()
+
+            self._release_journal(bucket_name, journal)
+
+    def merge(self, bucket_name, items):
+        with self._acquire_mutex(bucket_name):
+            journal = self._get_journal(bucket_name)
+
+            for data, rest_data in items:
+                digest = content_digest(data)
+                record_id = journal.index.find(digest) if digest is not None else None
+                if record_id is None:
+                    journal.add(data, rest_data)
+                elif journal.records[record_id]['rest_data'] != rest_data:
+                    journal.set_rest_data(record_id, rest_data)
+            journal.flush()
+
+            self._release_journal(bucket_name, journal)
+
+    def clear(self, bucket_name):
+        with self._acquire_mutex(bucket_name):
+            with self._cache_lock:
+                self._cache.pop(bucket_name, None)
+            for filename in (self._get_contents_file(bucket_name), self._get_index_file(bucket_name)):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def load(self, bucket_name, checkpoint_interval=None, pending_only=False, read_only=False):
+        return _Bucket(self, bucket_name, checkpoint_interval, pending_only, read_only)
+
+    def count(self, bucket_name):
+        with self._acquire_mutex(bucket_name, shared=True):
+            with self._cache_lock:
+                cached = bucket_name in self._cache
+            if not cached:
+                # Only the summary of the saved index is read (not the digests of the records)
+                # along with the end of the journal.
+                summary = self._load_index_summary(bucket_name)
+                if summary is not None:
+                    live_records = _Journal(
+                        self._get_contents_file(bucket_name), self._compact_min_dead,
+                        self._serializer).count_live_records(summary)
+                    if live_records is not None:
+                        return live_records
+
+            # Note: only the index is needed (so, just the end of the journal is read).
+            journal = self._get_journal(bucket_name, load_records=False)
+            self._release_journal(bucket_name, journal)
+            return journal.index.live_records
+
+    def _acquire_mutex(self, bucket_name, shared=False):
+        return timed_acquire_mutex(
+            _get_mutex_name(bucket_name), lock_dir=self._data_dir, shared=shared)
+
+    # Private API (system mutex must be held already).
+    def _get_journal(self, bucket_name, load_records=True):
+        # Note: the cached bucket is only kept in memory again after the journal is released (so,
+        # if some error happens in the meanwhile it's not reused).
+        with self._cache_lock:
+            cached = self._cache.pop(bucket_name, None)
+        contents_file = self._get_contents_file(bucket_name)
+        if cached is None:
+            return _Journal(contents_file, self._compact_min_dead, self._serializer).read(
+                self._load_index(bucket_name), load_records)
+
+        if (
+                (cached.records is not None or not load_records) and
+                cached.stat is not None and
+                cached.stat == _get_file_stat(contents_file)):
+            # Not changed by some other process: no need to read it.
+            journal = _Journal(contents_file, self._compact_min_dead, self._serializer)
+            journal.index = cached.index
+            journal.records = cached.records
+            return journal
+
+        return _Journal(contents_file, self._compact_min_dead, self._serializer).read(
+            cached.index, load_records, cached.records)
+
+    def _release_journal(self, bucket_name, journal):
+        index = journal.index
+        if index.generation is None:
+            return
+        if index.unsaved_records >= INDEX_SAVE_MIN_RECORDS:
+            self._save_index(bucket_name, index)
+
+        records = journal.records
+        if records is not None and len(records) > self._max_cached_records:
+            records = None
+
+        stat = None
+        if not journal.needs_rewrite:
+            # Note: if it needs to be rewritten it has to be read again to know about it.
+            stat = _get_file_stat(journal.contents_file)
+
+        with self._cache_lock:
+            self._cache[bucket_name] = _CachedBucket(index, records, stat)
+            self._evict_records()
+
+    def _evict_records(self):
+        # Note: must be called with the cache lock acquired.
+        cached_records = sum(
+            len(cached.records) for cached in self._cache.values() if cached.records is not None)
+        for cached in self._cache.values():
+            if cached_records <= self._max_cached_records:
+                break
+            if cached.records is not None:
+                cached_records -= len(cached.records)
+                cached.records = None
+
+    def _load_index(self, bucket_name):
+        index_file = self._get_index_file(bucket_name)
+        if not os.path.exists(index_file):
+            return None
+        try:
+            with open(index_file, 'rb') as stream:
+                loads = self._serializer.loads
+                summary = loads(stream.readline())
+                if 'digests' in summary:
+                    # Saved by a previous version (in a single line).
+                    return _BucketIndex.from_json(summary, summary['digests'])
+                return _BucketIndex.from_json(summary, loads(stream.read()))
+        except Exception:
+            # Corrupt: it'll be rebuilt.
+            return None
+
+    def _load_index_summary(self, bucket_name):
+        '''
+        :return dict|NoneType:
+            The summary of the saved index (see: _BucketIndex.to_json) or None if it's not
+            available.
+        '''
+        index_file = self._get_index_file(bucket_name)
+        if not os.path.exists(index_file):
+            return None
+        try:
+            with open(index_file, 'rb') as stream:
+                summary = self._serializer.loads(stream.readline())
+        except Exception:
+            return None
+        if not isinstance(summary, dict) or 'live_records' not in summary:
+            return None
+        return summary
+
+    def _save_index(self, bucket_name, index):
+        dumps = self._serializer.dumps
+        _write_atomic(
+            self._get_index_file(bucket_name),
+            dumps(index.to_json()) + b'\n' + dumps(index.digests_to_json()))
+        index.unsaved_records = 0
+
+    def _get_index_file(self, bucket_name):
+        return os.path.join(self._data_dir, bucket_name + '.index')
+
+    def _get_contents_file(self, bucket_name):
+        contents_file = os.path.join(self._data_dir, bucket_name)
+        return contents_file
+
+
+class _CachedBucket(object):
+    '''
+    The contents of a bucket kept in memory by the JournalBackend between accesses.
+
+    Changes done in this process are written through (so, the contents in memory are always the
+    same ones in the disk after a write) and the file stat (inode, size, mtime) is checked when
+    it's accessed again: if it's the same, the file isn't read at all and if it changed (some other
+    process wrote to it), only the records after the index offset are read (or everything if it
+    was compacted).
+
+    Note: the data of the handles is shared with the cache, so, it must not be changed other than
+    through the handle methods.
+    '''
+
+    def __init__(self, index, records, stat):
+        self.index = index
+
+        # OrderedDict(record id -> handle data) or None (if only the index is kept).
+        self.records = records
+
+        # The stat of the bucket file when it was last accessed (None if it must be read again).
+        self.stat = stat
+
+
+def _get_file_stat(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def create_backend(backend, data_dir, **kwargs):
+    '''
+    :param str|object backend:
+        'journal' (default), 'sqlite' or an object with the same interface as JournalBackend.
+    '''
+    if backend is None or backend == 'journal':
+        return JournalBackend(data_dir, **kwargs)
+
+    if backend == 'sqlite':
+        from pyspeedtin.sqlite_backend import SqliteBackend
+        return SqliteBackend(data_dir, **kwargs)
+
+    if isinstance(backend, str):
+        raise ValueError('Unexpected cache backend: %s' % (backend,))
+    return backend
 
 
 class LocalCache(object):
+    '''
+    Keeps data in buckets (where the same data is not added twice) and provides a way to iterate
+    over the data in a bucket to associate the data saved in the server (rest_data) or remove it.
 
-    def __init__(self, data_dir):
-        self._data_dir = data_dir
+    The actual storage is done by a backend (see: create_backend).
+    '''
+
+    def __init__(self, data_dir, backend=None, **kwargs):
         try:
             os.makedirs(data_dir)
         except:
             pass
+        self._data_dir = data_dir
+        self._backend = create_backend(backend, data_dir, **kwargs)
 
     def add(self, bucket_name, data, rest_data=''):
         check_valid_bucket_name(bucket_name)
-        with timed_acquire_mutex(_get_mutex_name(bucket_name)):
-            contents_file = self._get_contents_file(bucket_name)
-            initial_data = self._get_current_data(contents_file)
+        self._backend.add(bucket_name, data, rest_data)
 
-            for handle_data in initial_data:
-                # Don't add duplicate data
-                if handle_data['data'] == data:
-                    return
+    def add_many(self, bucket_name, items):
+        '''
+        Adds many items at once (the same as calling add() for each item, but the bucket is
+        written only once).
 
-            handle_data = {
-                'rest_data': rest_data,
-                'data': data,
-            }
+        :param list(tuple(data, rest_data)) items:
+        '''
+        check_valid_bucket_name(bucket_name)
+        items = list(items)
+        if items:
+            self._backend.add_many(bucket_name, items)
 
-            initial_data.append(handle_data)
-            with open(contents_file, 'w') as stream:
-                stream.write(json_dumps(initial_data))
+    def merge(self, bucket_name, items):
+        '''
+        Adds the items which are still not in the bucket and updates the rest data of the ones
+        already there (the bucket is written only once).
 
-    def clear(self, bucket_name):
+        :param list(tuple(data, rest_data)) items:
+        '''
         check_valid_bucket_name(bucket_name)
-        with timed_acquire_mutex(_get_mutex_name(bucket_name)):
-            contents_file = self._get_contents_file(bucket_name)
-            if os.path.exists(contents_file):
-                os.remove(contents_file)
-        
-    def load(self, bucket_name):
+        items = list(items)
+        if items:
+            self._backend.merge(bucket_name, items)
+
+    def clear(self, bucket_name):
         check_valid_bucket_name(bucket_name)
-        return _Bucket(self, bucket_name)
+        self._backend.clear(bucket_name)
 
-    # Private API (system mutex must be held already).
-    def _get_current_data(self, contents_file):
-        initial_data = []
-        if os.path.exists(contents_file):
-            with open(contents_file, 'r') as stream:
-                current_contents = stream.read()
-                if current_contents:
-                    initial_data = json.loads(current_contents)
-        return initial_data
+    def count(self, bucket_name):
+        '''
+        :return int:
+            The number of items in the bucket (without loading them).
+        '''
+        check_valid_bucket_name(bucket_name)
+        return self._backend.count(bucket_name)
 
-    def _get_contents_file(self, bucket_name):
-        contents_file = os.path.join(self._data_dir, bucket_name)
-        return contents_file
+    def has_shards(self, bucket_name):
+        '''
+        :return bool:
+            True if some data of the bucket is still in the shards of a spool (see: create_spool).
+        '''
+        check_valid_bucket_name(bucket_name)
+        from pyspeedtin.shard_spool import has_shards
+        return has_shards(self._data_dir, bucket_name)
+
+    def create_spool(self, bucket_name, compression=None):
+        '''
+        :param str compression:
+            The compression of the shards of the spool ('gzip', 'zstd' or None).
+
+        :return ShardSpool|None:
+            A spool where data can be added to the bucket without holding its mutex (None if the
+            backend already supports concurrent writers).
+        '''
+        check_valid_bucket_name(bucket_name)
+        if getattr(self._backend, 'concurrent_writes', False):
+            return None
+        from pyspeedtin.shard_spool import ShardSpool
+        return ShardSpool(self._data_dir, bucket_name, compression)
+
+    def load(self, bucket_name, checkpoint_interval=None, pending_only=False, read_only=False):
+        '''
+        :param int checkpoint_interval:
+            If given, changes done in the session are written whenever this number of changes is
+            pending (otherwise they're only written when the session exits).
+
+        :param bool pending_only:
+            If True, only the data without rest_data is loaded.
+
+        :param bool read_only:
+            If True, the handles can't be changed and other processes may read the bucket at the
+            same time (only sessions which change the bucket are exclusive).
+        '''
+        check_valid_bucket_name(bucket_name)
+        return self._backend.load(bucket_name, checkpoint_interval, pending_only, read_only)
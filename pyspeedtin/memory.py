@@ -0,0 +1,115 @@
+'''
+Measures the memory used by a function.
+
+i.e.:
+
+    result = measure_memory(func, top_n=10)
+    result.peak_bytes, result.allocations, result.rss_delta_bytes
+
+- peak_bytes: the peak of the memory allocated by Python while func runs (from tracemalloc) over
+  the memory allocated before it runs.
+- allocations: the number of memory blocks allocated by func and still alive when it returns.
+- rss_delta_bytes: how much the resident set size of the process changed (from /proc/self/statm
+  or, if not available, the max RSS from resource.getrusage -- which only grows, so, in this case
+  it's only reported when func makes the process reach a new max).
+
+If top_n is given, the top_n allocation sites (file:line) of the memory still alive when func
+returns are also available (i.e.: to be saved in a report).
+'''
+import os
+import sys
+import tracemalloc
+
+
+def _get_rss_bytes():
+    try:
+        with open('/proc/self/statm', 'rb') as stream:
+            return int(stream.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss  # Bytes on Mac OS (KB elsewhere).
+    return max_rss * 1024
+
+
+class MemoryResult(object):
+
+    def __init__(self, peak_bytes, allocations, rss_delta_bytes, top_allocations):
+        self.peak_bytes = peak_bytes
+        self.allocations = allocations
+
+        # None if the RSS is not available in this platform.
+        self.rss_delta_bytes = rss_delta_bytes
+
+        # list(tuple(str, int, int)): (file:line, size in bytes, count) of the top allocation
+        # sites (empty if top_n was not given).
+        self.top_allocations = top_allocations
+
+    def format_top_allocations(self):
+        lines = []
+        for i, (location, size, count) in enumerate(self.top_allocations):
+            lines.append('#%s: %s: %.1f KiB in %s blocks' % (i + 1, location, size / 1024.0, count))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<MemoryResult peak_bytes=%s allocations=%s rss_delta_bytes=%s>' % (
+            self.peak_bytes, self.allocations, self.rss_delta_bytes)
+
+
+def measure_memory(func, top_n=0):
+    '''
+    :param callable func:
+        The function to be measured (called without arguments).
+
+    :param int top_n:
+        The number of allocation sites to be collected in MemoryResult.top_allocations.
+
+    :return MemoryResult:
+    '''
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        rss_before = _get_rss_bytes()
+        current_before = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        func()
+
+        peak = tracemalloc.get_traced_memory()[1]
+        rss_after = _get_rss_bytes()
+        after = tracemalloc.take_snapshot()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    # Don't count what tracemalloc itself allocated.
+    trace_filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    differences = after.filter_traces(trace_filters).compare_to(
+        before.filter_traces(trace_filters), 'lineno')
+
+    allocations = sum(stat.count_diff for stat in differences if stat.count_diff > 0)
+
+    top_allocations = []
+    if top_n:
+        grown = sorted(
+            (stat for stat in differences if stat.size_diff > 0),
+            key=lambda stat: stat.size_diff, reverse=True)
+        for stat in grown[:top_n]:
+            frame = stat.traceback[0]
+            top_allocations.append(
+                ('%s:%s' % (frame.filename, frame.lineno), stat.size_diff, stat.count_diff))
+
+    rss_delta = None
+    if rss_before is not None and rss_after is not None:
+        rss_delta = rss_after - rss_before
+
+    return MemoryResult(max(0, peak - current_before), allocations, rss_delta, top_allocations)
@@ -0,0 +1,198 @@
+'''
+The fields of a measurement which are usually the same for all the measurements of a run
+(version, branch, commit, machine, ...) are kept in a RunContext, which is saved only once in the
+'run_context' bucket of the local cache, so, a measurement in the local cache is just:
+
+    [benchmark_id, value, context_id]
+
+or, if it has tags (which usually change for each measurement -- i.e.: the number of samples --
+so, they're not in the RunContext, otherwise there'd be a new RunContext for each measurement):
+
+    [benchmark_id, value, context_id, tag1, tag2]
+
+and the full payload of the measurement is only created when it's posted to the server.
+
+A run context is registered with the time it was registered and the ones registered more than
+RUN_CONTEXT_MAX_AGE seconds ago are removed when no measurement is pending (see:
+prune_run_contexts). A process registers a run context again if it's still used
+RUN_CONTEXT_REFRESH_INTERVAL seconds after it was registered, so, a run context which is still in
+use is never removed.
+
+i.e.:
+
+    run_contexts = RunContexts(local_cache)
+    if run_contexts.needs_load(handle.data):
+        run_contexts.load()
+    benchmark_id, json = run_contexts.get_payload(handle.data)
+
+Note: measurements saved as [benchmark_id, json] (by previous versions) are still supported.
+'''
+import datetime
+import hashlib
+import json
+import time
+
+from pyspeedtin.serializers import date_to_str, default_convert
+
+
+RUN_CONTEXT_BUCKET = 'run_context'
+
+RUN_CONTEXT_MAX_AGE = 24 * 60 * 60
+
+RUN_CONTEXT_REFRESH_INTERVAL = RUN_CONTEXT_MAX_AGE / 4
+
+
+class RunContext(object):
+    '''
+    An immutable record with the fields of a measurement other than its value (the tags of the
+    RunContexts created now are always empty: they're kept in the measurement).
+    '''
+
+    FIELDS = (
+        'version',
+        'released',
+        'branch',
+        'os',
+        'commit_id',
+        'commit_date',
+        'machine_name',
+        'tag1',
+        'tag2',
+    )
+
+    __slots__ = FIELDS + ('id',)
+
+    def __init__(self, version, released, branch, os, commit_id, commit_date, machine_name, tag1, tag2):
+        if isinstance(commit_date, datetime.datetime):
+            # Saved as a string (the same format used when it was saved in each measurement).
+            commit_date = date_to_str(commit_date)
+
+        values = (version, released, branch, os, commit_id, commit_date, machine_name, tag1, tag2)
+        for field, value in zip(self.FIELDS, values):
+            object.__setattr__(self, field, value)
+
+        # The id is the digest of the contents (so, the same fields always have the same id).
+        # Note: not content_digest (which rejects values that are still saved as json, i.e.:
+        # tuples or str subclasses).
+        object.__setattr__(self, 'id', hashlib.sha1(self._encode().encode('utf-8')).hexdigest()[:16])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RunContext is immutable.')
+
+    def __eq__(self, other):
+        return isinstance(other, RunContext) and self.id == other.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return '<RunContext %s: %s>' % (self.id, self.to_json())
+
+    def to_json(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def _encode(self):
+        return json.dumps(self.to_json(), sort_keys=True, default=default_convert)
+
+    def register(self, local_cache):
+        '''
+        Saves it in the local cache (or updates the time it was registered if it's already there).
+        '''
+        # Note: saved as loaded from json (so, the same fields are always the same data).
+        data = {'id': self.id, 'fields': json.loads(self._encode())}
+        local_cache.merge(RUN_CONTEXT_BUCKET, [(data, {'registered': time.time()})])
+
+    def create_payload(self, value, tags=None):
+        '''
+        :param tuple(str, str) tags:
+            If given, the tag1/tag2 of the measurement.
+
+        :return dict:
+            The json posted to the server for a measurement with the given value.
+        '''
+        payload = self.to_json()
+        payload['value'] = value
+        if tags is not None:
+            payload['tag1'], payload['tag2'] = tags
+        return payload
+
+    @classmethod
+    def from_json(cls, contents):
+        return cls(*[contents[field] for field in cls.FIELDS])
+
+
+class RunContexts(object):
+    '''
+    Provides the json to be posted to the server for the measurements in the local cache.
+
+    The run contexts are only loaded from the local cache when some measurement references a
+    run context which wasn't loaded yet (so, they're loaded at most once in a commit, unless
+    some other process registers a new run context during the commit).
+    '''
+
+    def __init__(self, local_cache):
+        self._local_cache = local_cache
+        self._run_contexts = {}
+
+    def needs_load(self, data):
+        '''
+        :param list data:
+            The measurement in the local cache.
+        '''
+        return len(data) >= 3 and data[2] not in self._run_contexts
+
+    def load(self):
+        run_contexts = {}
+        with self._local_cache.load(RUN_CONTEXT_BUCKET, read_only=True) as run_context_data:
+            for handle in run_context_data:
+                run_contexts[handle.data['id']] = RunContext.from_json(handle.data['fields'])
+        self._run_contexts = run_contexts
+
+    def get_payload(self, data):
+        '''
+        :param list data:
+            The measurement in the local cache: [benchmark_id, value, context_id],
+            [benchmark_id, value, context_id, tag1, tag2] or [benchmark_id, json] (saved by
+            previous versions).
+
+        :return tuple(str, dict):
+            The benchmark id and the json to be posted to the server.
+        '''
+        if len(data) == 2:
+            return data[0], data[1]
+
+        benchmark_id, value, context_id = data[:3]
+        try:
+            run_context = self._run_contexts[context_id]
+        except KeyError:
+            raise RuntimeError('Unable to find the run context: %s (measurement: %s)' % (context_id, data))
+        return benchmark_id, run_context.create_payload(value, data[3:] or None)
+
+
+def prune_run_contexts(local_cache, max_age=None):
+    '''
+    Removes the run contexts registered more than `max_age` seconds ago (by default
+    RUN_CONTEXT_MAX_AGE) if no measurement is pending (in the local cache or in shards still
+    not merged).
+
+    :return int:
+        The number of run contexts removed.
+    '''
+    if max_age is None:
+        max_age = RUN_CONTEXT_MAX_AGE
+    if local_cache.count('measurement') or local_cache.has_shards('measurement'):
+        return 0
+
+    min_time = time.time() - max_age
+    removed = 0
+    with local_cache.load(RUN_CONTEXT_BUCKET) as run_context_data:
+        for handle in run_context_data:
+            # Note: registered by a previous version if there's no time.
+            rest_data = handle.rest_data
+            if not rest_data or rest_data.get('registered', 0) < min_time:
+                handle.remove()
+                removed += 1
+    return removed
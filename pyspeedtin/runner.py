@@ -0,0 +1,187 @@
+'''
+Runs a suite of benchmarks, each one in a new process (so, imports, caches and the state of the
+GC of a benchmark don't influence the others) pinned to a dedicated CPU, with as many benchmarks
+running in parallel as there are CPUs available.
+
+i.e.:
+
+    runner = BenchmarkRunner(api, version='2.2', branch='master')
+    runner.run([create_10_users, ('select_100_users', select_100_users)])
+    api.commit()
+
+The benchmarks are measured with pyspeedtin.timing.measure and the results are added as
+measurements (with the CPU used in tag1).
+
+Note: the processes are started with the 'spawn' method, so, the callables must be picklable
+(i.e.: functions defined at the top level of a module or functools.partial of those).
+'''
+from collections import deque
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import traceback
+
+from pyspeedtin.api import _check_benchmark_name
+
+
+def get_available_cpus():
+    '''
+    :return list(int):
+        The CPUs which this process may use.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def _run_benchmark(conn, func, cpu, measure_kwargs):
+    # Note: this is the target of the benchmark process.
+    try:
+        pinned = False
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, [cpu])
+            pinned = True
+
+        from pyspeedtin.timing import measure
+        result = measure(func, **measure_kwargs)
+        conn.send((None, result.summary, result.loops, pinned))
+    except BaseException:
+        conn.send((traceback.format_exc(), None, None, False))
+    finally:
+        conn.close()
+
+
+class RunResult(object):
+
+    def __init__(self, name, cpu, summary=None, loops=None, pinned=False, error=None):
+        self.name = name
+        self.cpu = cpu
+        self.summary = summary
+        self.loops = loops
+
+        # Whether the process was actually pinned to the cpu (not available in all platforms).
+        self.pinned = pinned
+
+        # The traceback if the benchmark failed.
+        self.error = error
+
+    def __repr__(self):
+        if self.error is not None:
+            return '<RunResult %s failed>' % (self.name,)
+        return '<RunResult %s cpu=%s min=%.9fs>' % (self.name, self.cpu, self.summary['min'])
+
+
+class BenchmarkRunner(object):
+
+    def __init__(
+        self,
+        api,
+        cpus=None,
+        warmup=1,
+        repeat=5,
+        min_time=0.2,
+        statistic='min',
+        disable_gc=True,
+        **kwargs
+    ):
+        '''
+        :param PySpeedTinApi api:
+            Used to add the benchmarks and measurements.
+
+        :param list(int) cpus:
+            The CPUs used to run the benchmarks (one benchmark per CPU at a time). By default all
+            the CPUs available.
+
+        :param str statistic:
+            The statistic of the samples used as the value (one of pyspeedtin.stats.STATISTICS).
+
+        :param kwargs:
+            Passed to api.add_measurement() (i.e.: version, branch, ...).
+        '''
+        from pyspeedtin.stats import STATISTICS
+        if statistic not in STATISTICS:
+            raise ValueError('Expected statistic to be one of: %s. Found: %s' % (STATISTICS, statistic))
+
+        self._api = api
+        self.cpus = list(cpus) if cpus is not None else get_available_cpus()
+        if not self.cpus:
+            raise ValueError('At least one cpu is required.')
+        self.statistic = statistic
+        self._measure_kwargs = dict(
+            warmup=warmup, repeat=repeat, min_time=min_time, disable_gc=disable_gc)
+        self._measurement_kwargs = kwargs
+
+    def run(self, benchmarks):
+        '''
+        :param list(callable|tuple(str, callable)) benchmarks:
+            The benchmarks to run (if only the callable is given, its __name__ is used as the
+            benchmark name).
+
+        :return list(RunResult):
+            The results in the same order of the benchmarks.
+
+        :throws RuntimeError:
+            If some benchmark failed (after the results of the others are added).
+        '''
+        benchmarks = [
+            benchmark if isinstance(benchmark, tuple) else (benchmark.__name__, benchmark)
+            for benchmark in benchmarks]
+        for name, _func in benchmarks:
+            _check_benchmark_name(name)
+
+        context = multiprocessing.get_context('spawn')
+        results = [None] * len(benchmarks)
+        pending = deque(enumerate(benchmarks))
+        free_cpus = deque(self.cpus)
+
+        # Connection -> (index, name, cpu, process).
+        running = {}
+        try:
+            while pending or running:
+                while pending and free_cpus:
+                    index, (name, func) = pending.popleft()
+                    cpu = free_cpus.popleft()
+                    receive_conn, send_conn = context.Pipe(duplex=False)
+                    process = context.Process(
+                        target=_run_benchmark, args=(send_conn, func, cpu, self._measure_kwargs))
+                    process.start()
+                    send_conn.close()
+                    running[receive_conn] = (index, name, cpu, process)
+
+                for conn in wait(list(running)):
+                    index, name, cpu, process = running.pop(conn)
+                    try:
+                        error, summary, loops, pinned = conn.recv()
+                    except EOFError:
+                        process.join()
+                        error, summary, loops, pinned = (
+                            'Process exited with code: %s' % (process.exitcode,), None, None, False)
+                    conn.close()
+                    process.join()
+                    free_cpus.append(cpu)
+
+                    results[index] = result = RunResult(name, cpu, summary, loops, pinned, error)
+                    if error is None:
+                        self._add_measurement(result)
+        finally:
+            for conn, (_index, _name, _cpu, process) in running.items():
+                process.terminate()
+                process.join()
+                conn.close()
+
+        failed = [result for result in results if result.error is not None]
+        if failed:
+            raise RuntimeError('Error running benchmarks:\n%s' % (
+                '\n'.join('%s:\n%s' % (result.name, result.error) for result in failed)))
+        return results
+
+    def _add_measurement(self, result):
+        api = self._api
+        summary = result.summary
+        kwargs = self._measurement_kwargs.copy()
+        kwargs.setdefault(
+            'tag1', 'cpu=%s%s' % (result.cpu, '' if result.pinned else ' (not pinned)'))
+        kwargs.setdefault('tag2', 'samples=%s loops=%s stdev=%.3g' % (
+            summary['count'], result.loops, summary['stdev']))
+        api.add_benchmark(result.name)
+        api.add_measurement(result.name, summary[self.statistic], **kwargs)
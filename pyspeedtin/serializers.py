@@ -0,0 +1,130 @@
+'''
+The serializers used to save the contents of the local cache.
+
+i.e.:
+
+    serializer = get_serializer()
+    encoded = serializer.dumps({'name': 'create_10_users'})
+    serializer.loads(encoded)
+
+The name of the serializer is saved in the header of a bucket journal, so, a bucket can always
+be read back with the serializer it was written with (and it's rewritten with the default
+serializer on the first write).
+
+The 'json' serializer uses orjson if it's installed (the stdlib json otherwise) -- both write the
+same format, so, the contents saved by one are read by the other.
+
+Datetimes are saved as strings in the format expected by the server ('%Y-%m-%d %H:%M:%S.%f').
+
+Note: a serializer must encode an object in a single line (the journal has one record per line).
+'''
+import datetime
+import json
+import threading
+
+
+DEFAULT_SERIALIZER = 'json'
+
+
+def date_to_str(date):
+    if date.tzinfo is None:
+        # The same as date.strftime('%Y-%m-%d %H:%M:%S.%f') (but much faster).
+        return date.isoformat(' ', 'microseconds')
+    return date.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def default_convert(obj):
+    if obj.__class__ == datetime.datetime:
+        return date_to_str(obj)
+    raise TypeError("Type not serializable: %s" % (obj,))
+
+
+def json_dumps(obj):
+    return json.dumps(obj, default=default_convert)
+
+
+class StdlibJsonSerializer(object):
+
+    name = 'json'
+
+    def dumps(self, obj):
+        '''
+        :return bytes:
+        '''
+        return json_dumps(obj).encode('utf-8')
+
+    def loads(self, encoded):
+        '''
+        :param bytes encoded:
+        '''
+        return json.loads(encoded)
+
+
+class OrjsonSerializer(object):
+    '''
+    Note: differently from the stdlib json, nan/infinity are saved as null.
+    '''
+
+    name = 'json'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        # Datetimes are passed to default_convert (orjson would save them in the RFC 3339 format).
+        self._option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return self._dumps(obj, default=default_convert, option=self._option)
+
+    def loads(self, encoded):
+        return self._loads(encoded)
+
+
+def _create_json_serializer():
+    try:
+        return OrjsonSerializer()
+    except ImportError:
+        return StdlibJsonSerializer()
+
+
+# serializer name -> callable which creates it (may raise ImportError if not available).
+_factories = {'json': _create_json_serializer}
+
+# serializer name -> serializer (already created).
+_serializers = {}
+_lock = threading.Lock()
+
+
+def register_serializer(name, factory):
+    '''
+    :param str name:
+        The name saved in the header of the buckets written with the serializer.
+
+    :param callable factory:
+        Creates the serializer: an object with a `name` and `dumps(obj) -> bytes` and
+        `loads(bytes) -> obj` methods.
+    '''
+    with _lock:
+        _factories[name] = factory
+        _serializers.pop(name, None)
+
+
+def get_serializer(name=DEFAULT_SERIALIZER):
+    '''
+    :raise ValueError:
+        If there's no serializer with the given name (or it's not available in this environment).
+    '''
+    serializer = _serializers.get(name)
+    if serializer is None:
+        with _lock:
+            try:
+                factory = _factories[name]
+            except KeyError:
+                raise ValueError('Unexpected serializer: %s' % (name,))
+            try:
+                serializer = factory()
+            except ImportError:
+                raise ValueError('The serializer: %s is not available.' % (name,))
+            _serializers[name] = serializer
+    return serializer
@@ -0,0 +1,288 @@
+'''
+A ShardSpool lets many processes add data to the same bucket without contending on the bucket
+mutex: each process appends to its own shard file (in `<data_dir>/<bucket>.shards`) and the
+shards are only merged in the bucket when committing.
+
+I.e.:
+
+    spool = ShardSpool(data_dir, 'measurement')
+    spool.add(data)  # A single append to the shard of this process.
+    ...
+    spool.merge_into(local_cache)  # Merges the shard of this process and orphan shards.
+
+While a process is alive it holds a lock on its shard (so, other processes don't touch it). A
+shard whose lock can be acquired belongs to a process which finished (or crashed) and is merged
+by whoever commits next. The shard of the current process is also rotated (so that it can be
+merged) when committing or when it grows over SHARD_MAX_BYTES.
+
+Shards may be compressed (gzip or zstd): each add() is flushed to the compressed stream, so, the
+shard of a process which crashed can still be merged (up to its last complete record).
+
+Note: a shard is removed right after its contents are added to the bucket, so, if the process
+is killed exactly between both, its contents are added again in the next merge (which may
+upload some item twice -- the same that happens with items posted but not marked as saved in
+a commit).
+'''
+import os
+import threading
+import uuid
+import weakref
+
+from pyspeedtin.compression import get_codec, get_codec_from_extension
+from pyspeedtin.local_cache import content_digest
+from pyspeedtin.serializers import get_serializer
+from pyspeedtin.system_mutex import SystemMutex
+
+
+SHARD_EXTENSION = '.shard'
+
+# The shard of a process is rotated when it has at least this number of bytes.
+SHARD_MAX_BYTES = 4 * 1024 * 1024
+
+
+def _shard_lock_name(shard_name):
+    return shard_name + '.lock'
+
+
+def _get_shard_codec(filename):
+    '''
+    :return GzipCodec|ZstdCodec|NoneType|bool:
+        The codec used to compress the shard (None if it's not compressed or False if the file is
+        not a shard).
+    '''
+    if filename.endswith(SHARD_EXTENSION):
+        return None
+    name, extension = os.path.splitext(filename)
+    if name.endswith(SHARD_EXTENSION):
+        codec = get_codec_from_extension(extension)
+        if codec is not None:
+            return codec
+    return False
+
+
+def has_shards(data_dir, bucket_name):
+    '''
+    :return bool:
+        True if there's some shard of the bucket still not merged (of a live process or not).
+    '''
+    try:
+        filenames = os.listdir(os.path.join(data_dir, bucket_name + '.shards'))
+    except OSError:
+        return False
+    for filename in filenames:
+        try:
+            if _get_shard_codec(filename) is not False:
+                return True
+        except ValueError:
+            return True  # Compressed with a codec not available here.
+    return False
+
+
+# The spools of this process (so, a forked process drops the shards of its parent).
+_spools = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for spool in list(_spools):
+        # The lock may have been held by some thread of the parent when it forked.
+        spool._lock = threading.Lock()
+        spool._abandon_parent_shard()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class ShardSpool(object):
+
+    def __init__(self, data_dir, bucket_name, compression=None):
+        '''
+        :param str compression:
+            If given, the shards of this process are compressed with it ('gzip' or 'zstd' -- see:
+            pyspeedtin.compression). Shards compressed or not are merged either way.
+        '''
+        self.bucket_name = bucket_name
+        self._codec = get_codec(compression) if compression else None
+        self.shards_dir = os.path.join(data_dir, bucket_name + '.shards')
+        self._lock = threading.Lock()
+
+        # The shard currently opened for writing (and its state).
+        self._shard_name = None
+        self._shard_fd = None
+        self._shard_mutex = None
+        self._shard_size = 0
+        self._shard_pid = None
+        self._shard_stream = None
+
+        # Digests of the data written to the current shard (so, the same data isn't written
+        # twice -- note that as in LocalCache.add, data without a digest is never a duplicate).
+        self._digests = set()
+        _spools.add(self)
+
+    def add(self, data, rest_data=''):
+        line = self._encode(data, rest_data)
+        digest = content_digest(data)
+        with self._lock:
+            if digest is not None and digest in self._digests:
+                return
+            if self._shard_pid != os.getpid():
+                # First write (or a forked process which must not write to the parent shard).
+                self._open_shard()
+            if self._shard_stream is not None:
+                os.write(self._shard_fd, self._shard_stream.write(line))
+            else:
+                os.write(self._shard_fd, line)
+            # Note: the uncompressed size (so, the memory needed to merge a shard is bounded).
+            self._shard_size += len(line)
+            if digest is not None:
+                self._digests.add(digest)
+            if self._shard_size >= SHARD_MAX_BYTES:
+                self._close_shard()
+
+    def rotate(self):
+        '''
+        Closes the shard of this process (so, it can be merged) -- a new one is created in the
+        next add().
+        '''
+        with self._lock:
+            self._close_shard()
+
+    def merge_into(self, local_cache, stats=None):
+        '''
+        Adds the contents of the shard of this process and of the orphan shards to the bucket and
+        removes them.
+
+        :param CommitStats stats:
+            If given, the size of the shards merged is added to it.
+
+        :return int:
+            The number of shards merged.
+        '''
+        self.rotate()
+        return self._collect_orphans(
+            lambda items: local_cache.add_many(self.bucket_name, items), stats)
+
+    def discard_orphans(self):
+        '''
+        Removes the shards of processes which are no longer alive without merging them.
+        '''
+        self.rotate()
+        return self._collect_orphans(lambda items: None)
+
+    def _collect_orphans(self, consume, stats=None):
+        try:
+            shard_names = sorted(os.listdir(self.shards_dir))
+        except OSError:
+            return 0
+
+        collected = 0
+        for shard_name in shard_names:
+            try:
+                codec = _get_shard_codec(shard_name)
+            except ValueError:
+                continue  # Compressed with a codec not available here (merged by someone else).
+            if codec is False:
+                continue  # Not a shard.
+
+            mutex = SystemMutex(_shard_lock_name(shard_name), self.shards_dir, remove_on_release=True)
+            if not mutex.get_mutex_aquired():
+                continue  # Its process is still alive.
+            try:
+                shard_file = os.path.join(self.shards_dir, shard_name)
+                try:
+                    with open(shard_file, 'rb') as stream:
+                        contents = stream.read()
+                except (IOError, OSError):
+                    continue  # Already collected by someone else.
+
+                size = len(contents)
+                if codec is not None:
+                    contents = codec.decompress(contents)
+                if stats is not None:
+                    stats.add_spool(len(contents), size)
+
+                consume(self._decode(contents))
+                os.remove(shard_file)
+                collected += 1
+            finally:
+                mutex.release_mutex()
+        return collected
+
+    def _open_shard(self):
+        if not os.path.isdir(self.shards_dir):
+            try:
+                os.makedirs(self.shards_dir)
+            except OSError:
+                pass  # Created by some other process in the meanwhile.
+
+        if self._shard_pid is not None:
+            # A forked process (without os.register_at_fork).
+            self._abandon_parent_shard()
+
+        shard_name = '%s-%s%s' % (os.getpid(), uuid.uuid4().hex, SHARD_EXTENSION)
+        if self._codec is not None:
+            shard_name += self._codec.extension
+
+        # The lock is acquired before the shard is created so that it's never seen as an orphan.
+        mutex = SystemMutex(_shard_lock_name(shard_name), self.shards_dir, remove_on_release=True)
+        if not mutex.get_mutex_aquired():
+            raise RuntimeError('Unable to lock shard: %s' % (shard_name,))
+
+        self._shard_fd = os.open(
+            os.path.join(self.shards_dir, shard_name),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        self._shard_name = shard_name
+        self._shard_mutex = mutex
+        self._shard_size = 0
+        self._shard_pid = os.getpid()
+        self._shard_stream = self._codec.create_stream() if self._codec is not None else None
+
+    def _abandon_parent_shard(self):
+        '''
+        Called in a forked process: the shard of the parent is dropped without unlocking or
+        removing it (the parent still writes to it).
+        '''
+        if self._shard_pid is not None and self._shard_pid != os.getpid():
+            try:
+                os.close(self._shard_fd)
+            except OSError:
+                pass
+            self._shard_mutex.abandon_mutex()
+            self._shard_name = self._shard_fd = self._shard_mutex = self._shard_pid = None
+            self._shard_stream = None
+            self._shard_size = 0
+            self._digests = set()
+
+    def _close_shard(self):
+        if self._shard_pid != os.getpid():
+            return
+        if self._shard_stream is not None:
+            os.write(self._shard_fd, self._shard_stream.finish())
+        os.close(self._shard_fd)
+        self._shard_mutex.release_mutex()
+        self._shard_name = self._shard_fd = self._shard_mutex = self._shard_pid = None
+        self._shard_stream = None
+        self._shard_size = 0
+        self._digests = set()
+
+    def _encode(self, data, rest_data):
+        record = {'d': data, 'r': rest_data}
+        if data.__class__ == tuple:
+            # Restored as a tuple (so, the semantics of LocalCache.add are kept).
+            record['t'] = 1
+        # Note: shards are always json (so, orphan shards of any process can be merged).
+        return get_serializer('json').dumps(record) + b'\n'
+
+    def _decode(self, contents):
+        items = []
+        loads = get_serializer('json').loads
+        lines = contents.split(b'\n')
+        # Note: the last line is either empty or a record whose write was interrupted.
+        for line in lines[:-1]:
+            if line:
+                record = loads(line)
+                data = record['d']
+                if record.get('t'):
+                    data = tuple(data)
+                items.append((data, record['r']))
+        return items
@@ -0,0 +1,284 @@
+'''
+A LocalCache backend which keeps all the buckets in a sqlite database (in WAL mode) in the data
+dir.
+
+i.e.:
+
+    local_cache = LocalCache(data_dir, backend='sqlite')
+
+Each item is a row indexed by bucket, content digest and whether it has rest data, so, adding
+some data, changing its rest data or removing it is a single row change and getting the data
+without rest data is an indexed query. Adding data doesn't need the system mutex (sqlite itself
+synchronizes writers and readers don't block writers), only iterating over a bucket to change it
+still holds it (so that 2 processes don't commit the same data) and read only sessions don't
+need it at all.
+
+Buckets previously saved by the JournalBackend in the same data dir are imported to the database
+the first time they're accessed (and the bucket file is renamed to <bucket>.migrated).
+'''
+from contextlib import contextmanager
+import hashlib
+import os
+import sqlite3
+import threading
+
+from pyspeedtin.local_cache import _HandleData, _Journal, _get_mutex_name, content_digest
+from pyspeedtin.serializers import get_serializer
+from pyspeedtin.system_mutex import timed_acquire_mutex
+
+
+DB_FILENAME = 'cache.sqlite3'
+
+# Seconds to wait for some other connection which is writing to the database.
+BUSY_TIMEOUT = 10
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bucket TEXT NOT NULL,
+    digest TEXT,
+    data TEXT NOT NULL,
+    rest_data TEXT NOT NULL,
+    has_rest_data INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_digest ON records (bucket, digest);
+CREATE INDEX IF NOT EXISTS records_pending ON records (bucket, has_rest_data, id);
+
+CREATE TABLE IF NOT EXISTS migrated (
+    bucket TEXT NOT NULL,
+    contents_digest TEXT NOT NULL,
+    PRIMARY KEY (bucket, contents_digest)
+);
+'''
+
+# The connections inherited from the parent in a forked process: they're kept alive (closing them
+# could change the database with locks which belong to the parent) but are never used.
+_inherited_connections = []
+
+_INSERT = 'INSERT INTO records (bucket, digest, data, rest_data, has_rest_data) VALUES (?, ?, ?, ?, ?)'
+
+
+def _dumps(obj):
+    # Note: the contents are saved as json text (with the fastest json serializer available).
+    return get_serializer('json').dumps(obj).decode('utf-8')
+
+
+def _loads(encoded):
+    return get_serializer('json').loads(encoded)
+
+
+def _to_row(bucket_name, data, rest_data):
+    encoded = _dumps(data)
+    # The digest is from what's actually saved (i.e.: tuples are saved as lists).
+    return (
+        bucket_name,
+        content_digest(_loads(encoded)),
+        encoded,
+        _dumps(rest_data),
+        int(bool(rest_data)),
+    )
+
+
+class _SqliteBucket(object):
+    '''
+    A session to iterate over the contents of a bucket.
+
+    Changes done through the handles are kept in memory and are written in a single transaction
+    when the session exits (even if it exits with an exception) or whenever `checkpoint_interval`
+    changes are pending.
+    '''
+
+    def __init__(self, backend, bucket_name, checkpoint_interval=None, pending_only=False, read_only=False):
+        self._backend = backend
+        self._bucket_name = bucket_name
+        self._checkpoint_interval = checkpoint_interval
+        self._pending_only = pending_only
+        self._read_only = read_only
+        self._mutex_handle = None
+        self._entered = False
+
+        # List(tuple(sql, params)) to be executed on flush.
+        self._pending = []
+
+    def __enter__(self, *args, **kwargs):
+        # Note: the migration acquires the bucket mutex itself (so, it must be done before).
+        self._backend._migrate(self._bucket_name)
+        if not self._read_only:
+            self._mutex_handle = mutex_handle = self._backend._acquire_mutex(self._bucket_name)
+            mutex_handle.__enter__()
+        self._entered = True
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        try:
+            self.flush()
+        finally:
+            self._entered = False
+            if self._mutex_handle is not None:
+                self._mutex_handle.__exit__()
+                self._mutex_handle = None
+
+    def __iter__(self):
+        assert self._entered
+        backend = self._backend
+
+        if self._pending_only:
+            sql = 'SELECT id, data, rest_data FROM records WHERE bucket = ? AND has_rest_data = 0 ORDER BY id'
+        else:
+            sql = 'SELECT id, data, rest_data FROM records WHERE bucket = ? ORDER BY id'
+
+        for record_id, data, rest_data in backend._connection().execute(sql, (self._bucket_name,)).fetchall():
+            handle_data = {'rest_data': _loads(rest_data), 'data': _loads(data)}
+            yield _HandleData(handle_data, self, record_id)
+
+    def flush(self):
+        '''
+        Writes the changes done so far.
+        '''
+        if not self._pending:
+            return
+        with self._backend._transaction() as connection:
+            for sql, params in self._pending:
+                connection.execute(sql, params)
+        self._pending = []
+
+    def _on_set_rest_data(self, handle):
+        rest_data = handle.rest_data
+        self._pending.append((
+            'UPDATE records SET rest_data = ?, has_rest_data = ? WHERE id = ?',
+            (_dumps(rest_data), int(bool(rest_data)), handle._record_id)))
+        self._on_change()
+
+    def _on_remove(self, handle):
+        self._pending.append(('DELETE FROM records WHERE id = ?', (handle._record_id,)))
+        self._on_change()
+
+    def _on_change(self):
+        checkpoint_interval = self._checkpoint_interval
+        if checkpoint_interval and len(self._pending) >= checkpoint_interval:
+            self.flush()
+
+
+class SqliteBackend(object):
+
+    # Adding data doesn't need the bucket mutex (so, a ShardSpool isn't needed).
+    concurrent_writes = True
+
+    def __init__(self, data_dir):
+        self._data_dir = data_dir
+        self._db_file = os.path.join(data_dir, DB_FILENAME)
+        self._local = threading.local()
+
+        # The buckets already checked for migration from the journal files.
+        self._migrated = set()
+
+    def add(self, bucket_name, data, rest_data=''):
+        self.add_many(bucket_name, [(data, rest_data)])
+
+    def add_many(self, bucket_name, items):
+        self._migrate(bucket_name)
+        with self._transaction() as connection:
+            for data, rest_data in items:
+                # Don't add duplicate data
+                digest = content_digest(data)
+                if digest is not None and connection.execute(
+                        'SELECT 1 FROM records WHERE bucket = ? AND digest = ? LIMIT 1',
+                        (bucket_name, digest)).fetchone():
+                    continue
+                connection.execute(_INSERT, _to_row(bucket_name, data, rest_data))
+
+    def merge(self, bucket_name, items):
+        self._migrate(bucket_name)
+        with self._transaction() as connection:
+            for data, rest_data in items:
+                digest = content_digest(data)
+                row = None
+                if digest is not None:
+                    row = connection.execute(
+                        'SELECT id, rest_data FROM records WHERE bucket = ? AND digest = ? ORDER BY id LIMIT 1',
+                        (bucket_name, digest)).fetchone()
+                if row is None:
+                    connection.execute(_INSERT, _to_row(bucket_name, data, rest_data))
+                elif _loads(row[1]) != rest_data:
+                    connection.execute(
+                        'UPDATE records SET rest_data = ?, has_rest_data = ? WHERE id = ?',
+                        (_dumps(rest_data), int(bool(rest_data)), row[0]))
+
+    def clear(self, bucket_name):
+        self._migrate(bucket_name)
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM records WHERE bucket = ?', (bucket_name,))
+
+    def count(self, bucket_name):
+        self._migrate(bucket_name)
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM records WHERE bucket = ?', (bucket_name,)).fetchone()[0]
+
+    def load(self, bucket_name, checkpoint_interval=None, pending_only=False, read_only=False):
+        return _SqliteBucket(self, bucket_name, checkpoint_interval, pending_only, read_only)
+
+    def _acquire_mutex(self, bucket_name, shared=False):
+        return timed_acquire_mutex(
+            _get_mutex_name(bucket_name), lock_dir=self._data_dir, shared=shared)
+
+    def _connection(self):
+        # sqlite connections can't be shared among threads nor with a forked process.
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid != os.getpid():
+            _inherited_connections.append(connection)
+            connection = None
+        if connection is None:
+            connection = sqlite3.connect(self._db_file, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    def _migrate(self, bucket_name):
+        '''
+        Imports the contents of a bucket saved by the JournalBackend (if any).
+        '''
+        if bucket_name in self._migrated:
+            return
+
+        contents_file = os.path.join(self._data_dir, bucket_name)
+        if os.path.exists(contents_file):
+            with self._acquire_mutex(bucket_name):
+                if os.path.exists(contents_file):
+                    with open(contents_file, 'rb') as stream:
+                        contents_digest = hashlib.sha1(stream.read()).hexdigest()
+
+                    with self._transaction() as connection:
+                        # If the rename below failed in a previous migration it's already there.
+                        if not connection.execute(
+                                'SELECT 1 FROM migrated WHERE bucket = ? AND contents_digest = ?',
+                                (bucket_name, contents_digest)).fetchone():
+                            journal = _Journal(contents_file).read()
+                            connection.executemany(_INSERT, [
+                                _to_row(bucket_name, handle_data['data'], handle_data['rest_data'])
+                                for handle_data in journal.records.values()])
+                            connection.execute(
+                                'INSERT INTO migrated (bucket, contents_digest) VALUES (?, ?)',
+                                (bucket_name, contents_digest))
+
+                    os.replace(contents_file, contents_file + '.migrated')
+                    try:
+                        os.remove(contents_file + '.index')
+                    except OSError:
+                        pass
+
+        self._migrated.add(bucket_name)
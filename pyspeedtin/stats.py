@@ -0,0 +1,110 @@
+'''
+Summary statistics for the samples of a benchmark.
+
+i.e.:
+
+    summary = summarize([0.12, 0.11, 0.13])
+    summary['median'], summary['stdev']
+
+The samples may be a list, an array('d') or (if numpy is available) a numpy array -- if numpy is
+available the statistics are computed with it.
+'''
+from array import array
+import math
+
+
+# The statistics which may be used as the value of a measurement.
+STATISTICS = ('min', 'max', 'median', 'mean', 'stdev', 'p95', 'mad')
+
+_numpy = None
+
+
+def _get_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy
+
+
+def to_array(samples):
+    '''
+    :return array('d'):
+        The samples as an array of doubles (which is kept as is if it's already one).
+    '''
+    if isinstance(samples, array) and samples.typecode == 'd':
+        return samples
+    return array('d', samples)
+
+
+def _median(sorted_samples):
+    n = len(sorted_samples)
+    middle = n // 2
+    if n % 2:
+        return sorted_samples[middle]
+    return (sorted_samples[middle - 1] + sorted_samples[middle]) / 2.0
+
+
+def _percentile(sorted_samples, percentile):
+    # Linear interpolation between the closest ranks (the same as the numpy default).
+    position = (len(sorted_samples) - 1) * percentile / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(sorted_samples) - 1)
+    fraction = position - lower
+    return sorted_samples[lower] + (sorted_samples[upper] - sorted_samples[lower]) * fraction
+
+
+def _summarize_numpy(numpy, samples):
+    samples = numpy.sort(numpy.asarray(samples, dtype=numpy.float64))
+    n = len(samples)
+    median = float(numpy.median(samples))
+    return {
+        'count': n,
+        'min': float(samples[0]),
+        'max': float(samples[-1]),
+        'median': median,
+        'mean': float(numpy.mean(samples)),
+        'stdev': float(numpy.std(samples, ddof=1)) if n > 1 else 0.0,
+        'p95': float(numpy.percentile(samples, 95)),
+        'mad': float(numpy.median(numpy.abs(samples - median))),
+    }
+
+
+def summarize(samples):
+    '''
+    :param list(float)|array('d')|numpy.ndarray samples:
+        Must have at least one sample.
+
+    :return dict(str, float):
+        The 'count', 'min', 'max', 'median', 'mean', 'stdev' (sample standard deviation: 0 if
+        there's only one sample), 'p95' (95th percentile) and 'mad' (median absolute deviation)
+        of the samples.
+    '''
+    if not len(samples):
+        raise ValueError('At least one sample is required.')
+
+    numpy = _get_numpy()
+    if numpy:
+        return _summarize_numpy(numpy, samples)
+
+    sorted_samples = sorted(samples)
+    n = len(sorted_samples)
+    mean = math.fsum(sorted_samples) / n
+    stdev = 0.0
+    if n > 1:
+        stdev = math.sqrt(math.fsum((x - mean) ** 2 for x in sorted_samples) / (n - 1))
+    median = _median(sorted_samples)
+
+    return {
+        'count': n,
+        'min': sorted_samples[0],
+        'max': sorted_samples[-1],
+        'median': median,
+        'mean': mean,
+        'stdev': stdev,
+        'p95': _percentile(sorted_samples, 95),
+        'mad': _median(sorted(abs(x - median) for x in sorted_samples)),
+    }
@@ -20,11 +20,19 @@ Or to keep trying to get the mutex until a given timeout elapses:
         # Do something without any racing condition with other processes
         ...
 
+By default the lock file is created in the temp dir (so, the name is global for the machine),
+but a `lock_dir` may be given to scope it (i.e.: to the data dir of a project). A mutex may also
+be acquired as `shared=True` (a reader lock): any number of processes may hold it in shared mode
+at the same time, but not while some process holds it in exclusive mode (on Windows shared locks
+are not available and it's always exclusive).
+
 '''
 
+import random
 import re
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import weakref
@@ -47,9 +55,11 @@ if sys.platform == 'win32':
 
     class SystemMutex(object):
 
-        def __init__(self, mutex_name):
+        def __init__(self, mutex_name, lock_dir=None, shared=False, remove_on_release=None):
+            # Note: shared is not supported on Windows (the mutex is always exclusive) and the
+            # lock file is always removed on release.
             check_valid_mutex_name(mutex_name)
-            filename = os.path.join(tempfile.gettempdir(), mutex_name)
+            filename = os.path.join(lock_dir or tempfile.gettempdir(), mutex_name)
             try:
                 os.unlink(filename)
             except:
@@ -95,18 +105,34 @@ if sys.platform == 'win32':
         def release_mutex(self):
             self._release_mutex()
 
+        def abandon_mutex(self):
+            # Note: there's no fork on Windows.
+            self.release_mutex()
+
 else:  # Linux
     import os
     import fcntl  # @UnresolvedImport
 
     class SystemMutex(object):
 
-        def __init__(self, mutex_name):
+        def __init__(self, mutex_name, lock_dir=None, shared=False, remove_on_release=None):
             check_valid_mutex_name(mutex_name)
-            filename = os.path.join(tempfile.gettempdir(), mutex_name)
+            filename = os.path.join(lock_dir or tempfile.gettempdir(), mutex_name)
+
+            # The lock file may only be removed when it's certain that no one else holds a lock
+            # on it (otherwise a new process could lock a new file with the same name while
+            # someone still holds the lock on the removed one). That's only the case for an
+            # exclusive lock and by default lock files in a lock_dir are kept.
+            if shared:
+                remove_on_release = False
+            elif remove_on_release is None:
+                remove_on_release = lock_dir is None
             try:
-                handle = open(filename, 'w')
-                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                handle = open(filename, 'a')
+                fcntl.flock(handle, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+                if os.fstat(handle.fileno()).st_ino != os.stat(filename).st_ino:
+                    # The file was removed by the previous owner after we opened it.
+                    raise RuntimeError('Lock file removed: %s' % (filename,))
             except:
                 self._release_mutex = NULL
                 self._acquired = False
@@ -119,6 +145,14 @@ else:  # Linux
                     # Note: can't use self here!
                     if not getattr(release_mutex, 'called', False):
                         release_mutex.called = True
+                        if remove_on_release:
+                            try:
+                                # Removing is pretty much optional (but let's do it to keep the
+                                # filesystem cleaner). Note: it's removed while still locked so
+                                # that whoever locks it afterwards notices it was removed.
+                                os.unlink(filename)
+                            except:
+                                pass
                         try:
                             fcntl.flock(handle, fcntl.LOCK_UN)
                         except:
@@ -127,10 +161,15 @@ else:  # Linux
                             handle.close()
                         except:
                             traceback.print_exc()
+
+                def abandon_mutex():
+                    # Note: closing the file doesn't release the lock while the file
+                    # description is still open in some other process (i.e.: the parent of a
+                    # forked process), so, the lock file is kept and it's not unlocked.
+                    if not getattr(release_mutex, 'called', False):
+                        release_mutex.called = True
                         try:
-                            # Removing is pretty much optional (but let's do it to keep the
-                            # filesystem cleaner).
-                            os.unlink(filename)
+                            handle.close()
                         except:
                             pass
 
@@ -138,6 +177,7 @@ else:  # Linux
                 self._ref = weakref.ref(self, release_mutex)
 
                 self._release_mutex = release_mutex
+                self._abandon_mutex = abandon_mutex
                 self._acquired = True
 
         def get_mutex_aquired(self):
@@ -146,11 +186,20 @@ else:  # Linux
         def release_mutex(self):
             self._release_mutex()
 
+        def abandon_mutex(self):
+            '''
+            To be called in a forked process with a mutex acquired by the parent: the mutex is
+            dropped in this process without releasing it (so, the parent still holds it).
+            '''
+            if self._acquired:
+                self._abandon_mutex()
+
 
 class _MutexHandle(object):
 
     def __init__(self, system_mutex):
         self._system_mutex = system_mutex
+        self.wait_time = 0.0
 
     def __enter__(self, *args, **kwargs):
         return self
@@ -159,15 +208,80 @@ class _MutexHandle(object):
         self._system_mutex.release_mutex()
 
 
-try:
-    xrange  # @UndefinedVariable
-except:
-    xrange = range
+# Sleep times (in seconds) between attempts to get a mutex: the first retry is done quickly and
+# the time doubles on each new attempt up to the max.
+_MIN_RETRY_SLEEP = 0.0001
+_MAX_RETRY_SLEEP = 0.01
 
 
-def timed_acquire_mutex(mutex_name, attempts=20, sleep_time=.5):
+class LockWaitStats(object):
     '''
-    Acquires the mutex given its name, a number of attempts and a time to sleep between each attempt.
+    Time spent waiting to acquire a given mutex (in this process).
+    '''
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __repr__(self):
+        return '<LockWaitStats acquired=%s contended=%s total_wait=%.6fs max_wait=%.6fs>' % (
+            self.acquired, self.contended, self.total_wait, self.max_wait)
+
+
+_lock_wait_stats = {}
+_lock_wait_stats_lock = threading.Lock()
+
+
+def get_lock_wait_stats():
+    '''
+    :return dict(str, LockWaitStats):
+        The time spent waiting for each mutex acquired with timed_acquire_mutex in this process.
+    '''
+    with _lock_wait_stats_lock:
+        ret = {}
+        for mutex_name, stats in _lock_wait_stats.items():
+            copy = ret[mutex_name] = LockWaitStats()
+            copy.__dict__.update(stats.__dict__)
+        return ret
+
+
+def reset_lock_wait_stats():
+    with _lock_wait_stats_lock:
+        _lock_wait_stats.clear()
+
+
+def _on_mutex_acquired(mutex_name, wait_time, attempts):
+    with _lock_wait_stats_lock:
+        stats = _lock_wait_stats.get(mutex_name)
+        if stats is None:
+            stats = _lock_wait_stats[mutex_name] = LockWaitStats()
+        stats.acquired += 1
+        if attempts > 1:
+            stats.contended += 1
+        stats.total_wait += wait_time
+        if wait_time > stats.max_wait:
+            stats.max_wait = wait_time
+
+
+def timed_acquire_mutex(mutex_name, attempts=20, sleep_time=.5, timeout=None, lock_dir=None, shared=False):
+    '''
+    Acquires the mutex given its name waiting at most the given timeout (by default
+    `attempts * sleep_time`, kept for backward compatibility).
+
+    :param str lock_dir:
+        The directory of the lock file (by default the temp dir).
+
+    :param bool shared:
+        If True, the mutex is acquired in shared mode (see: SystemMutex).
+
+    While the mutex is held by someone else, new attempts are done with a short sleep between
+    them (starting at 0.1 ms and doubling up to 10 ms), so, the mutex is usually acquired
+    shortly after it's released.
+
+    The time spent waiting is available in the returned handle (`wait_time`) and in
+    get_lock_wait_stats().
 
     :throws RuntimeError if it was not possible to get the mutex in the given time.
 
@@ -177,14 +291,26 @@ def timed_acquire_mutex(mutex_name, attempts=20, sleep_time=.5):
         # Do something without any racing condition with other processes
         ...
     '''
-    for _i in xrange(attempts):
-        mutex = SystemMutex(mutex_name)
-        if not mutex.get_mutex_aquired():
-            time.sleep(sleep_time)
-            mutex = None
-        else:
-            return _MutexHandle(mutex)
-    else:
-        raise RuntimeError(
-            'Could not get mutex: %s after: %s secs.' %
-            (mutex_name, attempts * sleep_time))
+    if timeout is None:
+        timeout = attempts * sleep_time
+
+    start = time.time()
+    retry_sleep = _MIN_RETRY_SLEEP
+    attempt = 0
+    while True:
+        attempt += 1
+        mutex = SystemMutex(mutex_name, lock_dir, shared)
+        if mutex.get_mutex_aquired():
+            handle = _MutexHandle(mutex)
+            handle.wait_time = time.time() - start
+            _on_mutex_acquired(mutex_name, handle.wait_time, attempt)
+            return handle
+        mutex = None
+
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            raise RuntimeError('Could not get mutex: %s after: %s secs.' % (mutex_name, timeout))
+
+        # Note: the jitter prevents waiting processes from retrying all at the same time.
+        time.sleep(min(remaining, retry_sleep * (0.5 + random.random())))
+        retry_sleep = min(retry_sleep * 2, _MAX_RETRY_SLEEP)
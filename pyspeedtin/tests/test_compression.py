@@ -0,0 +1,47 @@
+import pytest
+
+from pyspeedtin.compression import CommitStats, choose_request_encoding, get_codec, \
+    is_codec_available
+
+
+def test_gzip_codec():
+    import gzip
+    codec = get_codec('gzip')
+    contents = b'{"benchmark": "create_10_users", "value": 1.5}\n' * 100
+    compressed = codec.compress(contents)
+    assert len(compressed) < len(contents)
+    assert gzip.decompress(compressed) == contents
+    assert codec.decompress(compressed) == contents
+
+    stream = codec.create_stream()
+    written = [stream.write(('line %s\n' % (i,)).encode('utf-8')) for i in range(3)]
+    # Each write may be decompressed even if the stream was not finished.
+    assert codec.decompress(b''.join(written[:2])) == b'line 0\nline 1\n'
+    assert gzip.decompress(b''.join(written) + stream.finish()) == b'line 0\nline 1\nline 2\n'
+
+    # The corrupt end (i.e.: an interrupted write) is discarded.
+    partial = b''.join(written[:2])
+    assert codec.decompress(partial + b'\xff' * 10 + written[2]) == b'line 0\nline 1\n'
+
+    with pytest.raises(ValueError):
+        get_codec('unknown')
+
+
+def test_choose_request_encoding():
+    assert choose_request_encoding(None) is None
+    assert choose_request_encoding('') is None
+    assert choose_request_encoding('br, deflate') is None
+    assert choose_request_encoding('GZip, br') == 'gzip'
+    assert choose_request_encoding('gzip;q=0') is None
+    if is_codec_available('zstd'):
+        assert choose_request_encoding('gzip, zstd') == 'zstd'
+    else:
+        assert choose_request_encoding('gzip, zstd') == 'gzip'
+
+
+def test_commit_stats():
+    stats = CommitStats()
+    stats.add_request(100, 40)
+    stats.add_request(50, 50)
+    assert stats.saved_bytes == 60
+    assert str(stats) == 'Uploaded 2 request(s): 90 bytes (150 uncompressed). Saved: 60 bytes.'
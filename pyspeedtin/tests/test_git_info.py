@@ -0,0 +1,100 @@
+import datetime
+import os
+import subprocess
+
+import pytest
+
+from pyspeedtin import git_info
+
+
+def _git(repo, *args):
+    env = os.environ.copy()
+    env.update({
+        'GIT_AUTHOR_NAME': 'Tester', 'GIT_AUTHOR_EMAIL': 'tester@example.com',
+        'GIT_COMMITTER_NAME': 'Tester', 'GIT_COMMITTER_EMAIL': 'tester@example.com',
+    })
+    return subprocess.check_output(('git',) + args, cwd=repo, env=env).strip().decode('utf-8')
+
+
+def _expected(repo):
+    return (
+        _git(repo, 'rev-parse', 'HEAD'),
+        _git(repo, 'rev-parse', '--abbrev-ref', 'HEAD'),
+        datetime.datetime.utcfromtimestamp(int(_git(repo, 'log', '-1', '--format=%ct'))),
+    )
+
+
+def _commit(repo, date):
+    env_date = '%s +0000' % (date,)
+    os.environ['GIT_COMMITTER_DATE'] = env_date
+    try:
+        _git(repo, 'commit', '--allow-empty', '-m', 'commit at %s' % (date,))
+    finally:
+        del os.environ['GIT_COMMITTER_DATE']
+
+
+@pytest.fixture
+def repo(tmpdir):
+    try:
+        _git(str(tmpdir), 'init', '-q', '-b', 'main')
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip('git not available.')
+    repo = str(tmpdir)
+    _commit(repo, 1500000000)
+    git_info.clear_cache()
+    return repo
+
+
+def test_git_info(repo, monkeypatch):
+    subdir = os.path.join(repo, 'sub')
+    os.mkdir(subdir)
+
+    runs = []
+    original_run_git = git_info._run_git
+
+    def run_git(*args):
+        runs.append(args)
+        return original_run_git(*args)
+
+    monkeypatch.setattr(git_info, '_run_git', run_git)
+
+    # Loose refs and objects: git is not run.
+    assert git_info.get_commit_id_branch_and_date(subdir) == _expected(repo)
+    assert git_info.get_commit_id_branch_and_date(subdir)[2] == datetime.datetime(2017, 7, 14, 2, 40)
+    assert runs == []
+
+    # A new commit is noticed.
+    _commit(repo, 1600000000)
+    assert git_info.get_commit_id_branch_and_date(repo) == _expected(repo)
+
+    # Packed refs and objects: git is run only to get the date.
+    _git(repo, 'gc', '-q')
+    _commit(repo, 1700000000)
+    _git(repo, 'pack-refs', '--all')
+    _git(repo, 'gc', '-q')
+    assert git_info.get_commit_id_branch_and_date(repo) == _expected(repo)
+    assert len(runs) == 1
+
+    # Cached.
+    assert git_info.get_commit_id_branch_and_date(repo) == _expected(repo)
+    assert len(runs) == 1
+
+    # Detached HEAD.
+    _git(repo, 'checkout', '-q', '--detach', 'HEAD~1')
+    assert git_info.get_commit_id_branch_and_date(repo) == _expected(repo)
+    assert git_info.get_commit_id_branch_and_date(repo)[1] == 'HEAD'
+
+
+def test_git_info_worktree(repo, tmpdir):
+    worktree = str(tmpdir.join('worktree'))
+    _git(repo, 'worktree', 'add', '-q', '-b', 'other', worktree)
+    assert os.path.isfile(os.path.join(worktree, '.git'))
+    _commit(worktree, 1600000000)
+
+    assert git_info.get_commit_id_branch_and_date(worktree) == _expected(worktree)
+    assert git_info.get_commit_id_branch_and_date(repo) == _expected(repo)
+
+
+def test_git_info_not_a_repo(tmpdir):
+    with pytest.raises(OSError):
+        git_info.get_commit_id_branch_and_date(str(tmpdir.join('does_not_exist')))
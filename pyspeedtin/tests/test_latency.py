@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+
+from pyspeedtin.latency import LatencyRecorder, LogHistogram
+
+
+def test_log_histogram():
+    histogram = LogHistogram()
+    for value in range(1, 1001):
+        histogram.record(value * 1000)
+
+    assert histogram.total == 1000
+    for percentile, expected in ((50, 500000), (95, 950000), (99, 990000)):
+        assert abs(histogram.percentile(percentile) - expected) / expected < 0.016
+
+    other = LogHistogram()
+    other.record(10 ** 9)
+    histogram.merge(other)
+    assert histogram.total == 1001
+    assert abs(histogram.percentile(100) - 10 ** 9) / 10 ** 9 < 0.016
+
+    with pytest.raises(ValueError):
+        LogHistogram().percentile(50)
+
+
+class _ApiMock(object):
+
+    def __init__(self):
+        self.benchmarks = []
+        self.measurements = []
+
+    def add_benchmark(self, name):
+        self.benchmarks.append(name)
+
+    def add_measurement(self, benchmark_id, value, **kwargs):
+        self.measurements.append((benchmark_id, value, kwargs))
+
+
+def test_latency_recorder():
+    api = _ApiMock()
+    recorder = LatencyRecorder(api, interval=None, percentiles=(50, 99), version='1.0')
+
+    @recorder.timed('func')
+    def func(value):
+        return value
+
+    def run():
+        for i in range(100):
+            assert func(i) == i
+            with recorder.section('section'):
+                pass
+
+    threads = [threading.Thread(target=run) for _i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    histograms = recorder.aggregate()
+    assert histograms['func'].total == 300
+    assert histograms['section'].total == 300
+    assert api.benchmarks == ['func p50', 'func p99', 'section p50', 'section p99']
+    assert [m[0] for m in api.measurements] == api.benchmarks
+    benchmark_id, value, kwargs = api.measurements[0]
+    assert 0 < value < 0.1
+    assert kwargs == {'version': '1.0', 'tag1': 'count=300'}
+
+    # Only what's recorded after the last aggregation is added.
+    del api.measurements[:]
+    func(1)
+    recorder.close()
+    assert [m[0] for m in api.measurements] == ['func p50', 'func p99']
+
+    with pytest.raises(ValueError):
+        recorder.timed('a' * 47)
+    recorder.timed('a' * 46)
+
+    # The longest percentile suffix is considered.
+    recorder = LatencyRecorder(api, interval=None, percentiles=(50, 99.9))
+    assert recorder.get_max_name_size() == 44
+    with pytest.raises(ValueError):
+        recorder.section('a' * 46)
+    recorder.section('a' * 44)
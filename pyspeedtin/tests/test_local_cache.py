@@ -1,8 +1,12 @@
+import os
+
 from pyspeedtin.local_cache import LocalCache
+import pytest
 
-def test_local_cache(tmpdir):
+@pytest.mark.parametrize('backend', ['journal', 'sqlite'])
+def test_local_cache(tmpdir, backend):
     print(tmpdir)
-    local_cache = LocalCache(str(tmpdir))
+    local_cache = LocalCache(str(tmpdir), backend=backend)
     local_cache.add('benchmark', {'name': 'bench1'})
     local_cache.add('benchmark', {'name': 'bench1'}) # Ignore this one (don't add duplicate data)
     local_cache.add('benchmark', {'name': 'bench2'})
@@ -42,3 +46,482 @@ def test_local_cache(tmpdir):
         for i, handle in enumerate(benchmark_data):
             data_found.append(handle.data)
     assert data_found == [{'name': 'bench2'}]
+
+
+def test_local_cache_appends_to_journal(tmpdir):
+    local_cache = LocalCache(str(tmpdir))
+    local_cache.add('measurement', ['bench1', {'value': 1}])
+    contents_file = tmpdir.join('measurement')
+    initial = contents_file.read_binary()
+
+    local_cache.add('measurement', ['bench1', {'value': 2}])
+    contents = contents_file.read_binary()
+    # The previous contents are kept as is (the new one is just appended).
+    assert contents.startswith(initial)
+    assert len(contents.splitlines()) == 3  # header + 2 records
+
+    with local_cache.load('measurement') as measurement_data:
+        for handle in measurement_data:
+            if handle.data[1]['value'] == 1:
+                handle.remove()
+            else:
+                handle.set_rest_data({'id': 2})
+
+    # Changes are also appended.
+    assert contents_file.read_binary().startswith(contents)
+
+    with local_cache.load('measurement') as measurement_data:
+        found = [(handle.data, handle.rest_data) for handle in measurement_data]
+    assert found == [(['bench1', {'value': 2}], {'id': 2})]
+
+
+def test_local_cache_reads_old_format(tmpdir):
+    import json
+    tmpdir.join('benchmark').write(json.dumps([
+        {'rest_data': {'id': 1}, 'data': {'name': 'bench1'}},
+        {'rest_data': '', 'data': {'name': 'bench2'}},
+    ]))
+    local_cache = LocalCache(str(tmpdir))
+    local_cache.add('benchmark', {'name': 'bench2'})  # Duplicate (ignored)
+    local_cache.add('benchmark', {'name': 'bench3'})
+
+    with local_cache.load('benchmark') as benchmark_data:
+        found = [(handle.data, handle.rest_data) for handle in benchmark_data]
+    assert found == [
+        ({'name': 'bench1'}, {'id': 1}),
+        ({'name': 'bench2'}, ''),
+        ({'name': 'bench3'}, ''),
+    ]
+    # Converted to the journal format on the first write.
+    assert not tmpdir.join('benchmark').read().startswith('[')
+
+
+def test_local_cache_reads_journal_v1(tmpdir):
+    import json
+    contents_file = tmpdir.join('benchmark')
+    contents_file.write('\n'.join([
+        json.dumps({'journal': 1, 'generation': 'g1'}),
+        json.dumps({'o': 'a', 'i': 0, 'd': {'name': 'bench1'}, 'r': {'id': 1}}),
+        '',
+    ]))
+    local_cache = LocalCache(str(tmpdir))
+    assert local_cache.count('benchmark') == 1
+    local_cache.add('benchmark', {'name': 'bench2'})
+
+    with local_cache.load('benchmark') as benchmark_data:
+        found = [(handle.data, handle.rest_data) for handle in benchmark_data]
+    assert found == [({'name': 'bench1'}, {'id': 1}), ({'name': 'bench2'}, '')]
+
+    # Rewritten in the current format on the first write.
+    header = json.loads(contents_file.read().splitlines()[0])
+    assert header['journal'] == 2
+    assert header['serializer'] == 'json'
+
+
+def test_local_cache_migrates_serializer(tmpdir, monkeypatch):
+    import json
+    from pyspeedtin import serializers
+
+    class OtherSerializer(serializers.StdlibJsonSerializer):
+        name = 'other'
+
+    monkeypatch.setitem(serializers._factories, 'other', OtherSerializer)
+    local_cache = LocalCache(str(tmpdir), serializer='other')
+    local_cache.add('benchmark', {'name': 'bench1'})
+    contents_file = tmpdir.join('benchmark')
+    assert json.loads(contents_file.read().splitlines()[0])['serializer'] == 'other'
+
+    # Read with the serializer in the header and rewritten with the default one on the first write.
+    local_cache = LocalCache(str(tmpdir))
+    local_cache.add('benchmark', {'name': 'bench2'})
+    assert json.loads(contents_file.read().splitlines()[0])['serializer'] == 'json'
+    with local_cache.load('benchmark') as benchmark_data:
+        assert [handle.data['name'] for handle in benchmark_data] == ['bench1', 'bench2']
+
+
+def test_local_cache_compact(tmpdir):
+    local_cache = LocalCache(str(tmpdir), compact_min_dead=4)
+    for i in range(6):
+        local_cache.add('measurement', ['bench1', {'value': i}])
+
+    with local_cache.load('measurement') as measurement_data:
+        for handle in measurement_data:
+            if handle.data[1]['value'] < 5:
+                handle.remove()
+
+    # 5 removed (10 dead records) > 1 live record: compacted.
+    assert len(tmpdir.join('measurement').read_binary().splitlines()) == 2
+
+    local_cache.add('measurement', ['bench1', {'value': 6}])
+    with local_cache.load('measurement') as measurement_data:
+        found = [handle.data for handle in measurement_data]
+    assert found == [['bench1', {'value': 5}], ['bench1', {'value': 6}]]
+
+
+def test_local_cache_flush_on_exit(tmpdir):
+    local_cache = LocalCache(str(tmpdir))
+    for i in range(3):
+        local_cache.add('measurement', ['bench1', {'value': i}])
+    contents_file = tmpdir.join('measurement')
+    initial = contents_file.read_binary()
+
+    class _Error(Exception):
+        pass
+
+    try:
+        with local_cache.load('measurement') as measurement_data:
+            for handle in measurement_data:
+                if handle.data[1]['value'] == 2:
+                    raise _Error()
+                handle.remove()
+                # Nothing written while the session is active.
+                assert contents_file.read_binary() == initial
+    except _Error:
+        pass
+
+    # Changes done before the error are written when the session exits.
+    with local_cache.load('measurement') as measurement_data:
+        found = [handle.data for handle in measurement_data]
+    assert found == [['bench1', {'value': 2}]]
+
+
+def test_local_cache_checkpoint_interval(tmpdir):
+    local_cache = LocalCache(str(tmpdir))
+    for i in range(4):
+        local_cache.add('measurement', ['bench1', {'value': i}])
+    contents_file = tmpdir.join('measurement')
+
+    sizes = []
+    with local_cache.load('measurement', checkpoint_interval=2) as measurement_data:
+        for handle in measurement_data:
+            handle.remove()
+            sizes.append(len(contents_file.read_binary().splitlines()))
+    assert sizes == [5, 7, 7, 9]
+
+
+def test_local_cache_interrupted_write(tmpdir):
+    local_cache = LocalCache(str(tmpdir))
+    local_cache.add('measurement', ['bench1', {'value': 1}])
+    contents_file = tmpdir.join('measurement')
+    contents_file.write_binary(contents_file.read_binary() + b'{"o": "a", "i": 1, "d": ["ben')
+
+    local_cache.add('measurement', ['bench1', {'value': 2}])
+    with local_cache.load('measurement') as measurement_data:
+        found = [handle.data for handle in measurement_data]
+    assert found == [['bench1', {'value': 1}], ['bench1', {'value': 2}]]
+    assert not [f for f in tmpdir.listdir() if f.basename.endswith('.tmp')]
+
+
+def test_content_digest():
+    from pyspeedtin.local_cache import content_digest
+    assert content_digest({'a': [1, True]}) == content_digest({'a': [1.0, 1]})
+    assert content_digest({'a': 1}) != content_digest({'a': '1'})
+    # Never equal to what's loaded from json.
+    assert content_digest(('bench1', 1)) is None
+    assert content_digest({'a': float('nan')}) is None
+
+
+def test_local_cache_index(tmpdir, monkeypatch):
+    from pyspeedtin import local_cache as local_cache_module
+    monkeypatch.setattr(local_cache_module, 'INDEX_SAVE_MIN_RECORDS', 3)
+
+    local_cache = LocalCache(str(tmpdir))
+    for i in range(3):
+        local_cache.add('benchmark', {'name': 'bench%s' % (i,)})
+    assert tmpdir.join('benchmark.index').exists()
+
+    # Some other process adds to the bucket: the index must be updated with its changes.
+    other_local_cache = LocalCache(str(tmpdir))
+    other_local_cache.add('benchmark', {'name': 'bench3'})
+    with other_local_cache.load('benchmark') as benchmark_data:
+        for handle in benchmark_data:
+            if handle.data['name'] == 'bench0':
+                handle.remove()
+
+    for i in range(5):
+        local_cache.add('benchmark', {'name': 'bench%s' % (i,)})
+
+    with local_cache.load('benchmark') as benchmark_data:
+        found = [handle.data['name'] for handle in benchmark_data]
+    assert found == ['bench1', 'bench2', 'bench3', 'bench0', 'bench4']
+
+    # A corrupt index is just rebuilt.
+    tmpdir.join('benchmark.index').write('corrupt')
+    local_cache = LocalCache(str(tmpdir))
+    local_cache.add('benchmark', {'name': 'bench1'})
+    with local_cache.load('benchmark') as benchmark_data:
+        assert len(list(benchmark_data)) == 5
+
+    local_cache.clear('benchmark')
+    assert not tmpdir.join('benchmark.index').exists()
+
+
+def test_local_cache_count_from_index_summary(tmpdir, monkeypatch):
+    from pyspeedtin import local_cache as local_cache_module
+    monkeypatch.setattr(local_cache_module, 'INDEX_SAVE_MIN_RECORDS', 3)
+
+    local_cache = LocalCache(str(tmpdir))
+    for i in range(4):
+        local_cache.add('benchmark', {'name': 'bench%s' % (i,)})
+    with local_cache.load('benchmark') as benchmark_data:
+        for handle in benchmark_data:
+            if handle.data['name'] == 'bench0':
+                handle.remove()
+
+    # Only the summary of the index (and the records after its offset) is read.
+    other_local_cache = LocalCache(str(tmpdir))
+    monkeypatch.setattr(other_local_cache._backend, '_load_index', None)
+    assert other_local_cache.count('benchmark') == 3
+
+    # An index saved in a single line (by a previous version) is still loaded.
+    index = local_cache_module.JournalBackend(str(tmpdir))._load_index('benchmark')
+    contents = index.to_json()
+    contents['digests'] = index.digests_to_json()
+    del contents['live_records']
+    import json
+    tmpdir.join('benchmark.index').write(json.dumps(contents))
+    local_cache = LocalCache(str(tmpdir))
+    assert local_cache.count('benchmark') == 3
+    local_cache.add('benchmark', {'name': 'bench1'})  # Duplicate (found in the index).
+    assert local_cache.count('benchmark') == 3
+
+
+def test_local_cache_index_after_compact(tmpdir):
+    local_cache = LocalCache(str(tmpdir), compact_min_dead=2)
+    for i in range(4):
+        local_cache.add('benchmark', {'name': 'bench%s' % (i,)})
+
+    # Compacted by some other process (the generation changes).
+    other_local_cache = LocalCache(str(tmpdir), compact_min_dead=2)
+    with other_local_cache.load('benchmark') as benchmark_data:
+        for handle in benchmark_data:
+            if handle.data['name'] != 'bench3':
+                handle.remove()
+
+    local_cache.add('benchmark', {'name': 'bench0'})
+    local_cache.add('benchmark', {'name': 'bench3'})
+    with local_cache.load('benchmark') as benchmark_data:
+        found = [handle.data['name'] for handle in benchmark_data]
+    assert found == ['bench3', 'bench0']
+
+
+@pytest.mark.parametrize('backend', ['journal', 'sqlite'])
+def test_local_cache_pending_only(tmpdir, backend):
+    local_cache = LocalCache(str(tmpdir), backend=backend)
+    local_cache.add('benchmark', {'name': 'bench1'}, {'id': 1})
+    local_cache.add('benchmark', {'name': 'bench2'})
+    local_cache.add('benchmark', {'name': 'bench2'})  # Duplicate (ignored)
+    local_cache.add('measurement', ('bench1', {'value': 1}))
+    local_cache.add('measurement', ('bench1', {'value': 1}))  # Tuples are never duplicates.
+
+    with local_cache.load('benchmark', pending_only=True) as benchmark_data:
+        found = [handle.data for handle in benchmark_data]
+    assert found == [{'name': 'bench2'}]
+
+    with local_cache.load('measurement') as measurement_data:
+        assert len(list(measurement_data)) == 2
+
+    local_cache.clear('measurement')
+    with local_cache.load('measurement') as measurement_data:
+        assert len(list(measurement_data)) == 0
+
+
+def test_local_cache_sqlite_checkpoint_interval(tmpdir):
+    import sqlite3
+    local_cache = LocalCache(str(tmpdir), backend='sqlite')
+    for i in range(4):
+        local_cache.add('measurement', ['bench1', {'value': i}])
+
+    def count():
+        connection = sqlite3.connect(str(tmpdir.join('cache.sqlite3')))
+        try:
+            return connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        finally:
+            connection.close()
+
+    counts = []
+    with local_cache.load('measurement', checkpoint_interval=2) as measurement_data:
+        for handle in measurement_data:
+            handle.remove()
+            counts.append(count())
+    assert counts == [4, 2, 2, 0]
+
+
+def test_local_cache_sqlite_migration(tmpdir):
+    local_cache = LocalCache(str(tmpdir))
+    local_cache.add('benchmark', {'name': 'bench1'}, {'id': 1})
+    local_cache.add('benchmark', {'name': 'bench2'})
+
+    local_cache = LocalCache(str(tmpdir), backend='sqlite')
+    local_cache.add('benchmark', {'name': 'bench2'})  # Duplicate (ignored)
+    local_cache.add('benchmark', {'name': 'bench3'})
+    assert not tmpdir.join('benchmark').exists()
+    assert tmpdir.join('benchmark.migrated').exists()
+
+    with local_cache.load('benchmark') as benchmark_data:
+        found = [(handle.data, handle.rest_data) for handle in benchmark_data]
+    assert found == [
+        ({'name': 'bench1'}, {'id': 1}),
+        ({'name': 'bench2'}, ''),
+        ({'name': 'bench3'}, ''),
+    ]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Requires os.fork.')
+def test_local_cache_sqlite_fork(tmpdir):
+    local_cache = LocalCache(str(tmpdir), backend='sqlite')
+    local_cache.add('benchmark', {'name': 'bench1'})
+    connection = local_cache._backend._connection()
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The child must not use the connection of the parent.
+        try:
+            local_cache.add('benchmark', {'name': 'bench2'})
+            ok = local_cache._backend._connection() is not connection
+            os.write(write_fd, b'1' if ok else b'0')
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    assert os.read(read_fd, 1) == b'1'
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+
+    assert local_cache._backend._connection() is connection
+    with local_cache.load('benchmark', read_only=True) as benchmark_data:
+        assert [handle.data['name'] for handle in benchmark_data] == ['bench1', 'bench2']
+
+
+def test_local_cache_sqlite_migration_on_load(tmpdir):
+    local_cache = LocalCache(str(tmpdir))
+    local_cache.add('benchmark', {'name': 'bench1'}, {'id': 1})
+    local_cache.add('benchmark', {'name': 'bench2'})
+
+    # The first access is a session holding the bucket mutex.
+    local_cache = LocalCache(str(tmpdir), backend='sqlite')
+    with local_cache.load('benchmark', pending_only=True) as benchmark_data:
+        found = [handle.data for handle in benchmark_data]
+    assert found == [{'name': 'bench2'}]
+    assert tmpdir.join('benchmark.migrated').exists()
+
+
+@pytest.mark.parametrize('backend', ['journal', 'sqlite'])
+def test_local_cache_add_many(tmpdir, backend):
+    local_cache = LocalCache(str(tmpdir), backend=backend)
+    local_cache.add('benchmark', {'name': 'bench1'})
+    local_cache.add_many('benchmark', [
+        ({'name': 'bench1'}, {'id': 1}),  # Duplicate (ignored)
+        ({'name': 'bench2'}, {'id': 2}),
+        ({'name': 'bench2'}, {'id': 2}),  # Duplicate (ignored)
+        ({'name': 'bench3'}, ''),
+    ])
+    with local_cache.load('benchmark') as benchmark_data:
+        found = [(handle.data, handle.rest_data) for handle in benchmark_data]
+    assert found == [
+        ({'name': 'bench1'}, ''),
+        ({'name': 'bench2'}, {'id': 2}),
+        ({'name': 'bench3'}, ''),
+    ]
+
+
+@pytest.mark.parametrize('backend', ['journal', 'sqlite'])
+def test_local_cache_read_only(tmpdir, backend):
+    local_cache = LocalCache(str(tmpdir), backend=backend)
+    local_cache.add('benchmark', {'name': 'bench1'})
+
+    with local_cache.load('benchmark', read_only=True) as benchmark_data:
+        # Other readers aren't blocked.
+        with local_cache.load('benchmark', read_only=True) as benchmark_data2:
+            assert [handle.data for handle in benchmark_data2] == [{'name': 'bench1'}]
+
+        for handle in benchmark_data:
+            with pytest.raises(RuntimeError):
+                handle.set_rest_data('something')
+            with pytest.raises(RuntimeError):
+                handle.remove()
+
+    with local_cache.load('benchmark') as benchmark_data:
+        assert [handle.rest_data for handle in benchmark_data] == ['']
+
+
+def test_local_cache_in_memory(tmpdir, monkeypatch):
+    from pyspeedtin.local_cache import _Journal
+
+    reads = []
+    original_read = _Journal.read
+
+    def read(self, *args, **kwargs):
+        reads.append(self.contents_file)
+        return original_read(self, *args, **kwargs)
+
+    monkeypatch.setattr(_Journal, 'read', read)
+
+    def load_names(local_cache):
+        with local_cache.load('benchmark', read_only=True) as benchmark_data:
+            return [handle.data['name'] for handle in benchmark_data]
+
+    local_cache = LocalCache(str(tmpdir))
+    local_cache.add('benchmark', {'name': 'bench0'})
+    local_cache.add('benchmark', {'name': 'bench1'})
+    assert load_names(local_cache) == ['bench0', 'bench1']
+    del reads[:]
+
+    # Nothing changed: the file isn't read again.
+    assert load_names(local_cache) == ['bench0', 'bench1']
+    local_cache.add('benchmark', {'name': 'bench2'})
+    local_cache.add('benchmark', {'name': 'bench0'})
+    assert load_names(local_cache) == ['bench0', 'bench1', 'bench2']
+    assert reads == []
+
+    # Changes from other processes are seen.
+    other_local_cache = LocalCache(str(tmpdir), compact_min_dead=1)
+    other_local_cache.add('benchmark', {'name': 'bench3'})
+    assert load_names(local_cache) == ['bench0', 'bench1', 'bench2', 'bench3']
+
+    with other_local_cache.load('benchmark') as benchmark_data:
+        for handle in benchmark_data:
+            if handle.data['name'] != 'bench3':
+                handle.remove()
+    assert load_names(local_cache) == ['bench3']
+
+
+def test_local_cache_in_memory_max_records(tmpdir):
+    local_cache = LocalCache(str(tmpdir), max_cached_records=3)
+    local_cache.add_many('benchmark', [({'name': 'bench%s' % (i,)}, '') for i in range(2)])
+    local_cache.add_many('other', [({'name': 'other%s' % (i,)}, '') for i in range(2)])
+
+    for bucket_name in ('benchmark', 'other'):
+        with local_cache.load(bucket_name, read_only=True) as bucket_data:
+            assert len(list(bucket_data)) == 2
+
+    # Only the records of the bucket most recently used are kept.
+    cache = local_cache._backend._cache
+    assert cache['benchmark'].records is None
+    assert len(cache['other'].records) == 2
+
+
+@pytest.mark.parametrize('backend', ['journal', 'sqlite'])
+def test_local_cache_count(tmpdir, backend, monkeypatch):
+    from pyspeedtin import local_cache as local_cache_module
+    monkeypatch.setattr(local_cache_module, 'INDEX_SAVE_MIN_RECORDS', 3)
+
+    local_cache = LocalCache(str(tmpdir), backend=backend)
+    assert local_cache.count('measurement') == 0
+    local_cache.add_many('measurement', [(('bench', i), '') for i in range(5)])
+    with local_cache.load('measurement') as measurement_data:
+        next(iter(measurement_data)).remove()
+
+    # A new process (which doesn't have it in memory) only reads what's not in the saved index.
+    applied = []
+    original_apply = local_cache_module._Journal._apply
+
+    def _apply(self, record, update_index=True):
+        applied.append(record)
+        return original_apply(self, record, update_index)
+
+    monkeypatch.setattr(local_cache_module._Journal, '_apply', _apply)
+    assert LocalCache(str(tmpdir), backend=backend).count('measurement') == 4
+    if backend == 'journal':
+        # Counted from the summary of the index and the tail of the journal (nothing is applied).
+        assert applied == []
@@ -0,0 +1,24 @@
+from pyspeedtin.memory import measure_memory
+
+
+_kept = []
+
+
+def _allocate():
+    _kept.append([object() for _i in range(1000)])
+    # Temporary memory (only in the peak).
+    temporary = bytearray(10 * 1024 * 1024)
+    del temporary
+
+
+def test_measure_memory():
+    result = measure_memory(_allocate, top_n=3)
+    assert result.peak_bytes >= 10 * 1024 * 1024
+    assert result.allocations >= 1000
+    assert result.rss_delta_bytes is not None
+
+    assert 1 <= len(result.top_allocations) <= 3
+    location, size, count = result.top_allocations[0]
+    assert location.startswith(__file__.replace('.pyc', '.py'))
+    assert count >= 1000
+    assert result.format_top_allocations().startswith('#1: ')
@@ -1,3 +1,4 @@
+import os
 from pyspeedtin import PySpeedTinApi
 import pytest
 import json
@@ -5,9 +6,10 @@ from pyspeedtin.local_cache import json_dumps
 
 class _Result(object):
     
-    def __init__(self, status_code, text):
+    def __init__(self, status_code, text, headers=None):
         self.status_code = status_code
         self.text = text
+        self.headers = headers or {}
         
     def json(self):
         return json.loads(self.text)
@@ -30,19 +32,26 @@ class PostMock():
         raise AssertionError('Unexpected url: %s and json: %s' % (url, json))
         
 class GetMock():
+
+    def __init__(self):
+        self.calls = 0
+        self.benchmarks = [{'id': 0, 'name': 'create_10_users'}, {'id': 1, 'name': 'select_100_users'}]
     
     def __call__(self, url, headers, **kwargs):
+        self.calls += 1
         if url == 'https://www.speedtin.com/api/projects/6546546/benchmarks':
-            return _Result(200, json.dumps([{'id': 0, 'name': 'create_10_users'}, {'id': 1, 'name': 'select_100_users'}]))
+            return _Result(200, json.dumps(self.benchmarks))
         
         raise AssertionError('Unexpected url: %s' % (url,))
 
-@pytest.fixture
-def api():
-    api = PySpeedTinApi('dummy_auth_key', 6546546)
+@pytest.fixture(params=['journal', 'sqlite'])
+def api(request, tmpdir, monkeypatch):
+    monkeypatch.setattr(PySpeedTinApi, '_data_dir', lambda self: str(tmpdir))
+    api = PySpeedTinApi('dummy_auth_key', 6546546, cache_backend=request.param)
     
     api.post = PostMock()
     api.get = GetMock()
+    api.retry_policy.sleep = lambda delay: None
     
     return api
 
@@ -71,3 +80,776 @@ def test_common_case(api):
     )
     
     api.commit()
+
+
+def _add_measurements(api, count, benchmark_id='create_10_users'):
+    for i in range(count):
+        api.add_measurement(
+            benchmark_id=benchmark_id,
+            value=i,
+            version='2.2',
+            released=True,
+            branch='master',
+            commit_id='commit_id',
+            commit_date=api.curr_date(),
+        )
+
+
+def _pending_payloads(api):
+    from pyspeedtin.run_context import RunContexts
+    run_contexts = RunContexts(api._local_cache)
+    run_contexts.load()
+    with api._local_cache.load('measurement') as measurement_data:
+        return [run_contexts.get_payload(handle.data) for handle in measurement_data]
+
+
+def _pending_measurements(api):
+    return [json['value'] for _benchmark_id, json in _pending_payloads(api)]
+
+
+def test_commit_max_workers(api, capsys):
+    import random
+    import time
+
+    post = api.post
+
+    def post_with_delay(url, json, headers, **kwargs):
+        time.sleep(random.random() * 0.01)
+        if json.get('value') == 7:
+            return _Result(500, 'Internal error')
+        return post(url, json, headers, **kwargs)
+
+    api.post = post_with_delay
+    api.add_benchmark('create_10_users')
+    _add_measurements(api, 20)
+
+    with pytest.raises(RuntimeError):
+        api.commit(max_workers=4)
+
+    # Items submitted before the error was found are still saved (the others are kept for the
+    # next commit).
+    saved = capsys.readouterr().out.count('Saved measurement')
+    pending = _pending_measurements(api)
+    assert pending[0] == 7
+    assert saved >= 7
+    assert saved + len(pending) == 20
+
+    api.post = post
+    api.commit(max_workers=4)
+    assert _pending_measurements(api) == []
+
+
+def test_commit_async(api, capsys):
+    import asyncio
+
+    post = api.post
+    get = api.get
+    in_flight = [0]
+    max_in_flight = [0]
+
+    async def async_post(url, json, headers, **kwargs):
+        in_flight[0] += 1
+        max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        try:
+            await asyncio.sleep(0.001)
+            return post(url, json, headers, **kwargs)
+        finally:
+            in_flight[0] -= 1
+
+    async def async_get(url, headers, **kwargs):
+        return get(url, headers, **kwargs)
+
+    api.async_post = async_post
+    api.async_get = async_get
+    api.get.benchmarks = []  # Benchmarks must be created.
+    api.add_benchmark('create_10_users')
+    api.add_benchmark('select_100_users')
+    _add_measurements(api, 10, 'create_10_users')
+    _add_measurements(api, 10, 'select_100_users')
+
+    stats = asyncio.run(api.commit_async(concurrency=4))
+    assert stats.requests == 22
+    assert max_in_flight[0] == 4
+    assert _pending_measurements(api) == []
+    out = capsys.readouterr().out
+    assert out.count('Saved benchmark') == 2
+    assert out.count('Saved measurement') == 20
+
+
+def test_retry_transient_failures(api):
+    post = api.post
+    responses = [
+        ConnectionRefusedError('Connection refused'),
+        _Result(503, 'Unavailable'),
+        _Result(429, 'Too many requests', {'Retry-After': '7'}),
+    ]
+
+    def flaky_post(url, json, headers, **kwargs):
+        if responses:
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return post(url, json, headers, **kwargs)
+
+    delays = []
+    api.post = flaky_post
+    api.retry_policy.sleep = delays.append
+    api.add_benchmark('create_10_users')
+    _add_measurements(api, 2)
+    api.commit()
+
+    assert _pending_measurements(api) == []
+    assert len(delays) == 3
+    assert delays[2] == 7  # From Retry-After
+    assert delays[0] <= api.retry_policy.backoff_factor
+    assert delays[1] <= api.retry_policy.backoff_factor * 2
+
+
+def test_retry_not_idempotent(api):
+    import requests
+
+    posted = []
+
+    def post_timing_out(url, json, headers, **kwargs):
+        posted.append(url)
+        raise requests.ReadTimeout('Read timed out.')
+
+    # The server may have created it already: a POST is not sent again after a read timeout.
+    api.post = post_timing_out
+    api.get.benchmarks = []
+    api.add_benchmark('create_10_users')
+    with pytest.raises(requests.ReadTimeout):
+        api.commit()
+    assert len(posted) == 1
+
+    # But it's sent again if it surely didn't reach the server.
+    def post_not_connected(url, json, headers, **kwargs):
+        posted.append(url)
+        if len(posted) == 2:
+            raise requests.ConnectTimeout('Connect timed out.')
+        return PostMock()(url, json, headers)
+
+    api.post = post_not_connected
+    api.commit()
+    assert len(posted) == 3
+
+    # A GET is always retried.
+    get = api.get
+    gets = []
+
+    def get_timing_out(url, headers, **kwargs):
+        gets.append(url)
+        if len(gets) == 1:
+            raise requests.ReadTimeout('Read timed out.')
+        return get(url, headers, **kwargs)
+
+    api.get = get_timing_out
+    assert api.sync_benchmarks()
+    assert len(gets) == 2
+
+
+def test_retry_gives_up(api):
+
+    def post(url, json, headers, **kwargs):
+        return _Result(502, 'Bad gateway')
+
+    api.post = post
+    api.get.benchmarks = []
+    api.retry_policy.max_retries = 2
+    api.add_benchmark('create_10_users')
+    with pytest.raises(RuntimeError) as e:
+        api.commit()
+    assert '502' in str(e.value)
+
+
+def test_benchmark_ids_from_local_cache(api, capsys):
+    api.get.benchmarks = []
+    api.add_benchmark('create_10_users')
+    api.add_benchmark('select_100_users')
+    _add_measurements(api, 3, 'create_10_users')
+    _add_measurements(api, 3, 'select_100_users')
+    api.commit()
+
+    # The benchmarks are requested once to check which ones must be created and the ones created
+    # are in the local cache (so, no need to get them from the server again for the measurements).
+    assert api.get.calls == 1
+    assert capsys.readouterr().out.count('Saved benchmark') == 2
+    assert _pending_measurements(api) == []
+
+    api.add_benchmark('create_10_users')
+    _add_measurements(api, 3, 'create_10_users')
+    api.commit()
+    assert api.get.calls == 1
+
+
+def test_benchmarks_already_in_server(api, capsys):
+    # Fresh local cache but the benchmarks already exist in the server: they're not created again.
+    def post(url, json, headers, **kwargs):
+        assert url.endswith('/measurements'), 'Unexpected post to: %s' % (url,)
+        return _Result(201, json_dumps({'id': 0}))
+
+    api.post = post
+    api.add_benchmark('create_10_users')
+    api.add_benchmark('select_100_users')
+    _add_measurements(api, 2, 'select_100_users')
+    api.commit(max_workers=2)
+
+    assert api.get.calls == 1
+    assert 'Saved benchmark' not in capsys.readouterr().out
+    with api._local_cache.load('benchmark') as benchmark_data:
+        found = [handle.rest_data for handle in benchmark_data]
+    assert found == api.get.benchmarks
+    assert _pending_measurements(api) == []
+
+
+def test_benchmark_ids_from_server(api):
+    # Benchmarks created in some other machine (not in the local cache).
+    _add_measurements(api, 3, 'create_10_users')
+    _add_measurements(api, 3, 'select_100_users')
+    api.commit()
+    assert api.get.calls == 1
+    assert _pending_measurements(api) == []
+
+    with api._local_cache.load('benchmark') as benchmark_data:
+        found = [(handle.data, handle.rest_data) for handle in benchmark_data]
+    assert found == [
+        ({'name': 'create_10_users'}, {'id': 0, 'name': 'create_10_users'}),
+        ({'name': 'select_100_users'}, {'id': 1, 'name': 'select_100_users'}),
+    ]
+
+    _add_measurements(api, 3, 'create_10_users')
+    api.commit()
+    assert api.get.calls == 1
+
+
+def test_benchmark_ids_not_found(api):
+    _add_measurements(api, 3, 'unknown_benchmark')
+    with pytest.raises(ValueError):
+        api.commit()
+    assert api.get.calls == 1
+
+
+class _CatalogServer(object):
+    '''
+    Stand-in for the benchmarks list of the server (supporting conditional requests).
+    '''
+
+    def __init__(self, benchmarks):
+        self.benchmarks = benchmarks
+        self.etag = '"v1"'
+        self.requests = []
+
+    def __call__(self, url, headers, **kwargs):
+        assert url == 'https://www.speedtin.com/api/projects/6546546/benchmarks'
+        self.requests.append(headers)
+        if headers.get('If-None-Match') == self.etag:
+            return _NotModified()
+        return _Result(200, json.dumps(self.benchmarks), {'ETag': self.etag})
+
+
+class _NotModified(object):
+    status_code = 304
+    text = ''
+
+    def json(self):
+        raise AssertionError('A 304 should not be parsed.')
+
+
+def test_benchmarks_conditional_sync(api, monkeypatch):
+    server = _CatalogServer([{'id': 0, 'name': 'create_10_users'}])
+    api.get = server
+
+    assert api.sync_benchmarks()
+    assert 'If-None-Match' not in server.requests[-1]
+
+    merges = []
+    merge = api._local_cache.merge
+    monkeypatch.setattr(api._local_cache, 'merge', lambda *args: merges.append(args) or merge(*args))
+
+    # Not modified: nothing is parsed nor written.
+    assert not api.sync_benchmarks()
+    assert server.requests[-1]['If-None-Match'] == '"v1"'
+    assert merges == []
+
+    _add_measurements(api, 2, 'create_10_users')
+    api.commit()
+    assert len(server.requests) == 2  # The name is already in the local cache.
+
+    server.benchmarks.append({'id': 1, 'name': 'select_100_users'})
+    server.etag = '"v2"'
+    _add_measurements(api, 2, 'select_100_users')
+    api.commit()
+    assert server.requests[-1]['If-None-Match'] == '"v1"'
+    # The benchmarks and the sync state (besides the run contexts of the measurements).
+    assert len([args for args in merges if args[0] != 'run_context']) == 2
+    assert _pending_measurements(api) == []
+
+    with api._local_cache.load('benchmark') as benchmark_data:
+        found = [handle.rest_data for handle in benchmark_data]
+    assert found == server.benchmarks
+
+
+def test_sharded_spool(tmpdir, monkeypatch):
+    monkeypatch.setattr(PySpeedTinApi, '_data_dir', lambda self: str(tmpdir))
+    api = PySpeedTinApi('dummy_auth_key', 6546546, sharded_spool=True)
+    api.post = PostMock()
+    api.get = GetMock()
+
+    api.add_benchmark('create_10_users')
+    _add_measurements(api, 3)
+    assert _pending_measurements(api) == []
+
+    posted = []
+    post = api.post
+
+    def post_and_track(url, json, headers, **kwargs):
+        posted.append(json.get('value'))
+        return post(url, json, headers, **kwargs)
+
+    api.post = post_and_track
+    api.commit()
+    assert posted == [0, 1, 2]
+    assert _pending_measurements(api) == []
+    assert os.listdir(api._measurement_spool.shards_dir) == []
+
+
+def test_background_flush(api):
+    import threading
+    import time
+
+    api.add_benchmark('create_10_users')
+    posted = []
+    post = api.post
+    release_post = threading.Event()
+
+    def post_and_track(url, json, headers, **kwargs):
+        if 'measurements' in url:
+            release_post.wait(5)
+            posted.append(json.get('value'))
+        return post(url, json, headers, **kwargs)
+
+    api.post = post_and_track
+    flusher = api.start_background_flush(max_items=3, max_interval=60, max_pending=4)
+
+    # Backpressure: at most 4 measurements are pending while the posts are blocked.
+    added = threading.Event()
+
+    def add_measurements():
+        _add_measurements(api, 10)
+        added.set()
+
+    adder = threading.Thread(target=add_measurements)
+    adder.start()
+    assert not added.wait(0.2)
+    assert len(flusher._queue) + flusher._in_flight == 4
+
+    release_post.set()
+    adder.join(5)
+    assert added.is_set()
+
+    assert api.flush(timeout=5)
+    assert posted == list(range(10))
+    assert _pending_measurements(api) == []
+
+    # The time trigger.
+    flusher.max_interval = 0.05
+    _add_measurements(api, 1)
+    initial_time = time.time()
+    while len(posted) < 11:
+        assert time.time() - initial_time < 5
+        time.sleep(0.01)
+
+    _add_measurements(api, 2)
+    api.close()
+    assert posted == list(range(10)) + [0, 0, 1]
+    with pytest.raises(RuntimeError):
+        flusher.add(('create_10_users', {}))
+
+
+def test_background_flush_retry(api):
+    api.add_benchmark('create_10_users')
+    post = api.post
+    fail = [True]
+
+    def post_failing(url, json, headers, **kwargs):
+        if 'measurements' in url and fail[0]:
+            raise AssertionError('Server unavailable')
+        return post(url, json, headers, **kwargs)
+
+    api.post = post_failing
+    flusher = api.start_background_flush(max_items=100, max_interval=60)
+    _add_measurements(api, 2)
+    assert not api.flush(timeout=5)
+    assert flusher.last_error is not None
+    assert _pending_measurements(api) == [0, 1]
+
+    # Nothing new was added, but what failed is committed in the next flush.
+    fail[0] = False
+    assert api.flush(timeout=5)
+    assert flusher.last_error is None
+    assert _pending_measurements(api) == []
+    api.close()
+
+
+def test_background_flush_backpressure(api):
+    import threading
+
+    api.add_benchmark('create_10_users')
+    post = api.post
+    available = threading.Event()
+
+    def post_unavailable(url, json, headers, **kwargs):
+        if 'measurements' in url and not available.is_set():
+            return _Result(503, '')
+        return post(url, json, headers, **kwargs)
+
+    api.post = post_unavailable
+    api.retry_policy.max_retries = 0
+    api.start_background_flush(max_items=5, max_interval=60, max_pending=10)
+
+    # While the server is down, what's in the local cache also counts as pending.
+    added = threading.Event()
+
+    def add_measurements():
+        _add_measurements(api, 30)
+        added.set()
+
+    adder = threading.Thread(target=add_measurements)
+    adder.start()
+    assert not added.wait(0.3)
+    assert api._local_cache.count('measurement') <= 10
+
+    available.set()
+    assert api.flush(timeout=5)
+    adder.join(5)
+    assert added.is_set()
+    api.close()
+    assert _pending_measurements(api) == []
+
+
+def test_background_flush_close_not_stored(api, capsys):
+    api.start_background_flush(max_items=100, max_interval=60)
+    _add_measurements(api, 2)
+
+    def store_failing(items):
+        raise IOError('Disk full')
+
+    api._store_measurements = store_failing
+    api.close()
+    assert '2 measurement(s) could not be saved in the local cache' in capsys.readouterr().err
+
+
+def test_measure(api):
+    import time
+    result = api.measure('create_10_users', lambda: time.sleep(0.001), repeat=3, min_time=0.005)
+
+    assert _pending_measurements(api) == [result.summary['min']]
+    [(benchmark_id, json)] = _pending_payloads(api)
+    assert benchmark_id == 'create_10_users'
+    assert json['tag1'] == 'samples=3 loops=%s' % (result.loops,)
+    assert json['tag2'].startswith('stdev=')
+
+    with api._local_cache.load('benchmark') as benchmark_data:
+        assert [handle.data for handle in benchmark_data] == [{'name': 'create_10_users'}]
+
+    with pytest.raises(ValueError):
+        api.measure('create_10_users', lambda: None, statistic='p50')
+
+
+def test_timed(api):
+    @api.timed('create_users')
+    def create_users():
+        pass
+
+    create_users()
+    with api.section('create_users'):
+        pass
+    api.close()
+
+    with api._local_cache.load('benchmark') as benchmark_data:
+        assert [handle.data['name'] for handle in benchmark_data] == [
+            'create_users p50', 'create_users p95', 'create_users p99']
+    assert len(_pending_measurements(api)) == 3
+
+
+def test_add_samples(api):
+    from array import array
+
+    samples = [0.5, 0.1, 0.2, 0.3, 0.4]
+    summary = api.add_samples(
+        'create_10_users', samples, extra_statistics=('p95',), store_samples=True)
+    assert summary['median'] == 0.3
+
+    measurements = _pending_payloads(api)
+    assert [(benchmark_id, json['value']) for benchmark_id, json in measurements] == [
+        ('create_10_users', 0.3), ('create_10_users p95', summary['p95'])]
+    assert measurements[0][1]['tag1'] == 'samples=5'
+
+    with open(summary['samples_file'], 'rb') as stream:
+        stored = array('d')
+        stored.frombytes(stream.read())
+    assert list(stored) == samples
+
+    with pytest.raises(ValueError):
+        api.add_samples('create_10_users', samples, statistic='p50')
+
+    # Nothing is added if some benchmark name is too long.
+    with pytest.raises(ValueError):
+        api.add_samples('a' * 45, samples, extra_statistics=('p95', 'stdev'))
+    assert len(_pending_payloads(api)) == 2
+
+
+def test_measure_memory(api):
+    result = api.measure_memory('create_10_users', lambda: bytearray(1024 * 1024), top_n=2)
+    assert result.peak_bytes >= 1024 * 1024
+    assert os.path.exists(result.report_file)
+
+    measurements = dict(
+        (benchmark_id, json['value']) for benchmark_id, json in _pending_payloads(api))
+    assert measurements['create_10_users peak_bytes'] == result.peak_bytes
+    assert measurements['create_10_users allocations'] == result.allocations
+    assert measurements['create_10_users rss_bytes'] == result.rss_delta_bytes
+
+    with pytest.raises(ValueError):
+        api.measure_memory('a' * 40, lambda: None)
+
+
+def test_leftover_warning(api, tmpdir, monkeypatch, capsys):
+    _add_measurements(api, 3)
+    capsys.readouterr()
+
+    api = PySpeedTinApi('dummy_auth_key', 6546546, cache_backend=api._local_cache._backend)
+    err = capsys.readouterr().err
+    assert 'In a previous call 3 measurement(s) were not properly saved.' in err
+    assert 'commit_id' not in err  # The measurements themselves are not printed.
+
+    # The HTTP session is only created when needed.
+    assert api._session is None
+    assert api.post.__self__ is api._session
+    api.close()
+    assert api._session is None
+
+
+def test_session_default_timeout(monkeypatch):
+    from requests.adapters import HTTPAdapter
+    from pyspeedtin.transport import DEFAULT_TIMEOUT, create_session
+
+    timeouts = []
+
+    def send(self, request, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        raise AssertionError('Not really sent.')
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    session = create_session()
+    for kwargs in ({}, {'timeout': 1}):
+        with pytest.raises(AssertionError):
+            session.get('https://www.speedtin.com/api', **kwargs)
+    assert timeouts == [DEFAULT_TIMEOUT, 1]
+    session.close()
+
+
+def test_run_context(api):
+    post = api.post
+    posted = []
+
+    def post_and_collect(url, json, headers, **kwargs):
+        if url.endswith('/measurements'):
+            posted.append(json)
+        return post(url, json, headers, **kwargs)
+
+    api.post = post_and_collect
+    commit_date = api.curr_date()
+    for value in (1, 2):
+        api.add_measurement(
+            'create_10_users', value, version='2.2', released=True, branch='master',
+            commit_id='commit_id', commit_date=commit_date, machine_name='machine')
+    api.add_measurement('create_10_users', 3, version='2.3', machine_name='machine')
+
+    # Measurements saved by previous versions (with the full json) must still be committed.
+    old_json = {
+        'value': 4, 'version': '2.1', 'released': False, 'branch': '', 'os': 'linux',
+        'commit_id': '', 'commit_date': '', 'machine_name': 'machine', 'tag1': '', 'tag2': ''}
+    api._local_cache.add('measurement', ('create_10_users', old_json))
+
+    # Only one run context is saved for the measurements with the same fields.
+    with api._local_cache.load('run_context') as run_context_data:
+        assert len(list(run_context_data)) == 2
+    with api._local_cache.load('measurement') as measurement_data:
+        measurements = [handle.data for handle in measurement_data]
+    assert [len(data) for data in measurements] == [3, 3, 3, 2]
+    assert measurements[0][2] == measurements[1][2] != measurements[2][2]
+
+    api.commit()
+    assert posted[0] == {
+        'value': 1, 'version': '2.2', 'released': True, 'branch': 'master', 'os': posted[0]['os'],
+        'commit_id': 'commit_id', 'commit_date': api.date_to_str(commit_date),
+        'machine_name': 'machine', 'tag1': '', 'tag2': ''}
+    assert [(json['value'], json['version']) for json in posted] == [
+        (1, '2.2'), (2, '2.2'), (3, '2.3'), (4, '2.1')]
+    assert _pending_measurements(api) == []
+
+
+def test_run_context_tags(api):
+    for i in range(30):
+        api.add_samples('create_10_users', [0.1] * (i + 1), version='2.2', machine_name='machine')
+    api.add_measurement('create_10_users', 1, version='2.2', machine_name='machine')
+
+    # The tags (which change for each measurement) are kept in the measurement.
+    with api._local_cache.load('run_context', read_only=True) as run_context_data:
+        assert len(list(run_context_data)) == 1
+    measurements = _pending_payloads(api)
+    assert [json['tag1'] for _benchmark_id, json in measurements] == [
+        'samples=%s' % (i + 1,) for i in range(30)] + ['']
+    assert measurements[-1][1]['tag2'] == ''
+
+
+def test_run_context_fields(api):
+    class S(str):
+        pass
+
+    api.add_measurement('create_10_users', 1.0, branch=S('master'), version=(2, 2), machine_name='machine')
+    api.add_measurement('create_10_users', float('nan'), version='2.2', machine_name='machine')
+    measurements = _pending_payloads(api)
+    assert [(json['branch'], json['version']) for _benchmark_id, json in measurements] == [
+        ('master', [2, 2]), ('', '2.2')]
+
+
+def _run_context_count(api):
+    with api._local_cache.load('run_context', read_only=True) as run_context_data:
+        return len(list(run_context_data))
+
+
+def test_run_context_prune(api, tmpdir, monkeypatch):
+    from pyspeedtin import run_context
+
+    _add_measurements(api, 2)
+    api.commit()
+    assert _run_context_count(api) == 2  # Recently registered (may still be used).
+
+    # Old run contexts are removed when no measurement is pending.
+    monkeypatch.setattr(run_context, 'RUN_CONTEXT_MAX_AGE', -1)
+    monkeypatch.setattr(run_context, 'RUN_CONTEXT_REFRESH_INTERVAL', -1)
+    _add_measurements(api, 1)
+    assert run_context.prune_run_contexts(api._local_cache) == 0  # A measurement is pending.
+    assert _run_context_count(api) == 3
+
+    api._local_cache.clear('measurement')
+    from pyspeedtin.shard_spool import ShardSpool
+    spool = ShardSpool(api._local_cache._data_dir, 'measurement')
+    spool.add(('create_10_users', 1, 'context_id'))
+    assert run_context.prune_run_contexts(api._local_cache) == 0  # Not merged yet.
+    spool.discard_orphans()
+
+    api.add_measurement('create_10_users', 1, machine_name='machine')
+    api.commit()
+    assert _run_context_count(api) == 0
+
+    # A run context still in use is registered again.
+    api.add_measurement('create_10_users', 2, machine_name='machine')
+    assert _run_context_count(api) == 1
+    api.commit()
+    assert _pending_measurements(api) == []
+
+    # Also removed with clear_previous.
+    _add_measurements(api, 3)
+    api = PySpeedTinApi(
+        'dummy_auth_key', 6546546, clear_previous=True, cache_backend=api._local_cache._backend)
+    assert _run_context_count(api) == 0
+
+
+def test_run_context_size(api):
+    from pyspeedtin.local_cache import json_dumps
+    from pyspeedtin.run_context import RunContext
+
+    fields = ('2.2', True, 'master', 'linux', 'a' * 40, api.curr_date(), 'machine', '', '')
+    run_context = RunContext(*fields)
+    assert RunContext(*fields) == run_context
+    assert RunContext(*fields[:-1] + ('tag2',)) != run_context
+    with pytest.raises(AttributeError):
+        run_context.version = '2.3'
+
+    full = json_dumps(('create_10_users', run_context.create_payload(1.5)))
+    normalized = json_dumps(('create_10_users', 1.5, run_context.id))
+    assert len(normalized) * 4 < len(full)
+
+
+def test_compressed_requests(api, capsys):
+    import gzip
+
+    get = api.get
+    posted = []
+    rejected = []  # The first compressed request is rejected.
+
+    def get_accepting_gzip(url, headers, **kwargs):
+        r = get(url, headers, **kwargs)
+        r.headers['Accept-Encoding'] = 'gzip'
+        return r
+
+    def post_compressed(url, headers, json=None, data=None, **kwargs):
+        if data is not None:
+            assert headers['Content-Encoding'] == 'gzip'
+            json = globals()['json'].loads(gzip.decompress(data))
+        posted.append((url, json, data is not None))
+        if data is not None and not rejected:
+            rejected.append(url)
+            return _Result(415, '')
+        return PostMock()(url, json, headers)
+
+    get.benchmarks = []  # The benchmark must be created.
+    api.get = get_accepting_gzip
+    api.post = post_compressed
+    api.add_benchmark('create_10_users')
+    _add_measurements(api, 2)
+    stats = api.commit()
+
+    # The benchmark is posted before the server is probed (when the benchmarks are requested).
+    assert [(json['value'] if 'value' in json else json, compressed) for _url, json, compressed in posted] == [
+        ({'name': 'create_10_users'}, False),
+        (0, True),
+        (0, False),  # 415: sent again without compression (and the next ones too).
+        (1, False),
+    ]
+    assert stats.requests == 3
+    assert 'Uploaded 3 request(s)' in capsys.readouterr().out
+
+    # The probe is not done again.
+    del posted[:]
+    get.calls = 0
+    _add_measurements(api, 3)
+    stats = api.commit()
+    assert get.calls == 0
+    assert [compressed for _url, _json, compressed in posted] == [True, True, True]
+    assert stats.request_bytes < stats.request_uncompressed_bytes
+    assert _pending_measurements(api) == []
+
+
+def test_compressed_requests_probe(api):
+    api.compress_requests = True
+    _add_measurements(api, 1)
+    api.commit()
+    assert api.get.calls == 1  # Probed (and the server doesn't accept compressed requests).
+
+    _add_measurements(api, 1)
+    api.commit()
+    assert api.get.calls == 1
+
+
+def test_compressed_requests_not_modified(api):
+    server = _CatalogServer([{'id': 0, 'name': 'create_10_users'}])
+
+    def get_accepting_gzip(url, headers, **kwargs):
+        r = server(url, headers, **kwargs)
+        if r.status_code == 200:
+            r.headers['Accept-Encoding'] = 'gzip'
+        return r
+
+    api.get = get_accepting_gzip
+    assert api.sync_benchmarks()
+    assert api._get_request_encoding() == 'gzip'
+
+    # A 304 without the Accept-Encoding keeps the content coding from the last sync.
+    assert not api.sync_benchmarks()
+    assert server.requests[-1]['If-None-Match'] == '"v1"'
+    assert api._get_request_encoding() == 'gzip'
@@ -0,0 +1,53 @@
+import functools
+import time
+
+import pytest
+
+from pyspeedtin.runner import BenchmarkRunner, get_available_cpus
+
+
+class _ApiMock(object):
+
+    def __init__(self):
+        self.benchmarks = []
+        self.measurements = []
+
+    def add_benchmark(self, name):
+        self.benchmarks.append(name)
+
+    def add_measurement(self, benchmark_id, value, **kwargs):
+        self.measurements.append((benchmark_id, value, kwargs))
+
+
+def test_benchmark_runner():
+    api = _ApiMock()
+    runner = BenchmarkRunner(api, repeat=2, min_time=0.001, version='1.0')
+    results = runner.run([
+        ('sleep_1ms', functools.partial(time.sleep, 0.001)),
+        ('sleep_2ms', functools.partial(time.sleep, 0.002)),
+        time.perf_counter,
+    ])
+
+    assert [result.name for result in results] == ['sleep_1ms', 'sleep_2ms', 'perf_counter']
+    assert sorted(api.benchmarks) == ['perf_counter', 'sleep_1ms', 'sleep_2ms']
+    cpus = get_available_cpus()
+    for result in results:
+        assert result.error is None
+        assert result.cpu in cpus
+
+    measurements = dict((m[0], m) for m in api.measurements)
+    assert 0.001 <= measurements['sleep_1ms'][1] < 0.002
+    _benchmark_id, _value, kwargs = measurements['sleep_2ms']
+    assert kwargs['version'] == '1.0'
+    assert kwargs['tag1'].startswith('cpu=')
+    assert kwargs['tag2'].startswith('samples=2 ')
+
+
+def test_benchmark_runner_error():
+    api = _ApiMock()
+    runner = BenchmarkRunner(api, repeat=1, min_time=0.001)
+    with pytest.raises(RuntimeError) as e:
+        runner.run([('fail', functools.partial(int, 'not an int')), time.perf_counter])
+
+    assert 'ValueError' in str(e.value)
+    assert api.benchmarks == ['perf_counter']
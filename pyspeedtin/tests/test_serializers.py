@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+from pyspeedtin.serializers import OrjsonSerializer, StdlibJsonSerializer, date_to_str, \
+    get_serializer
+
+
+def _create_serializers():
+    serializers = [StdlibJsonSerializer()]
+    try:
+        serializers.append(OrjsonSerializer())
+    except ImportError:
+        pass
+    return serializers
+
+
+def test_date_to_str():
+    date = datetime.datetime(2015, 10, 11, 15, 30, 39)
+    assert date_to_str(date) == date.strftime('%Y-%m-%d %H:%M:%S.%f') == '2015-10-11 15:30:39.000000'
+    date = date.replace(microsecond=123)
+    assert date_to_str(date) == date.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+@pytest.mark.parametrize('serializer', _create_serializers(), ids=lambda s: s.__class__.__name__)
+def test_serializer(serializer):
+    obj = {
+        'o': 'a',
+        'i': 1,
+        'd': ('bench1', 1.5, 'c\nd', u'\xe1'),
+        'r': {'commit_date': datetime.datetime(2015, 10, 11, 15, 30, 39, 10)},
+    }
+    encoded = serializer.dumps(obj)
+    assert b'\n' not in encoded
+
+    expected = {
+        'o': 'a',
+        'i': 1,
+        'd': ['bench1', 1.5, 'c\nd', u'\xe1'],
+        'r': {'commit_date': '2015-10-11 15:30:39.000010'},
+    }
+    assert serializer.loads(encoded) == expected
+    # The contents written by any json serializer are read by the others.
+    for other in _create_serializers():
+        assert other.loads(encoded) == expected
+
+    with pytest.raises(TypeError):
+        serializer.dumps({'a': object()})
+
+
+def test_get_serializer():
+    assert get_serializer().name == 'json'
+    assert get_serializer('json') is get_serializer()
+    with pytest.raises(ValueError):
+        get_serializer('unknown')
@@ -0,0 +1,132 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from pyspeedtin.local_cache import LocalCache
+from pyspeedtin.shard_spool import ShardSpool
+
+
+def _bucket_contents(local_cache, bucket_name):
+    with local_cache.load(bucket_name, read_only=True) as bucket_data:
+        return [handle.data for handle in bucket_data]
+
+
+def test_shard_spool(tmpdir):
+    data_dir = str(tmpdir)
+    local_cache = LocalCache(data_dir)
+
+    spool1 = ShardSpool(data_dir, 'measurement')
+    spool2 = ShardSpool(data_dir, 'measurement')
+    spool1.add(('bench1', {'value': 1}))
+    spool1.add(('bench1', {'value': 1}))  # Tuples are never duplicates (as in LocalCache.add).
+    spool1.add({'name': 'a'})
+    spool1.add({'name': 'a'})  # Duplicate (not written again).
+    spool2.add(('bench2', {'value': 2}))
+
+    # Nothing is written to the bucket itself.
+    assert _bucket_contents(local_cache, 'measurement') == []
+
+    # The shard of spool1 is still being written, so, only the one from spool2 is merged.
+    assert spool2.merge_into(local_cache) == 1
+    assert _bucket_contents(local_cache, 'measurement') == [['bench2', {'value': 2}]]
+
+    assert spool1.merge_into(local_cache) == 1
+    assert _bucket_contents(local_cache, 'measurement') == [
+        ['bench2', {'value': 2}],
+        ['bench1', {'value': 1}],
+        ['bench1', {'value': 1}],
+        {'name': 'a'},
+    ]
+    assert os.listdir(spool1.shards_dir) == []
+
+    # New data goes to a new shard.
+    spool1.add({'name': 'a'})
+    assert spool1.merge_into(local_cache) == 1
+    assert len(_bucket_contents(local_cache, 'measurement')) == 4
+
+
+def test_shard_spool_orphan(tmpdir):
+    data_dir = str(tmpdir)
+    local_cache = LocalCache(data_dir)
+
+    # A process which is killed without committing (and whose last write was interrupted).
+    code = '''
+import os
+from pyspeedtin.shard_spool import ShardSpool
+spool = ShardSpool(%r, 'measurement')
+spool.add(('bench1', {'value': 1}))
+os.write(spool._shard_fd, b'{"d": ["bench1", {"val')
+os._exit(1)
+''' % (data_dir,)
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert subprocess.call([sys.executable, '-c', code], env=env) == 1
+
+    spool = ShardSpool(data_dir, 'measurement')
+    assert spool.merge_into(local_cache) == 1
+    assert _bucket_contents(local_cache, 'measurement') == [['bench1', {'value': 1}]]
+    assert os.listdir(spool.shards_dir) == []
+
+
+def test_shard_spool_compressed(tmpdir):
+    from pyspeedtin.compression import CommitStats
+
+    data_dir = str(tmpdir)
+    local_cache = LocalCache(data_dir)
+
+    spool = ShardSpool(data_dir, 'measurement', compression='gzip')
+    for i in range(100):
+        spool.add(('bench1', i, 'context_id'))
+    [shard_name] = [name for name in os.listdir(spool.shards_dir) if not name.endswith('.lock')]
+    assert shard_name.endswith('.shard.gz')
+
+    # A process which is killed (so, the compressed stream is not finished and the last write
+    # was interrupted) can still be merged.
+    stream = spool._codec.create_stream()
+    contents = b''.join(stream.write(spool._encode(('bench1', i, 'context_id'), '')) for i in range(100))
+    interrupted = stream.write(spool._encode(('bench1', 100, 'context_id' * 100), ''))
+    with open(os.path.join(spool.shards_dir, '1-orphan.shard.gz'), 'wb') as stream:
+        stream.write(contents + interrupted[:len(interrupted) // 2])
+
+    stats = CommitStats()
+    assert spool.merge_into(local_cache, stats) == 2
+    assert _bucket_contents(local_cache, 'measurement') == (
+        [['bench1', i, 'context_id'] for i in range(100)] * 2)
+    assert stats.spool_bytes < stats.spool_uncompressed_bytes
+    assert os.listdir(spool.shards_dir) == []
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Requires os.fork.')
+def test_shard_spool_fork(tmpdir):
+    data_dir = str(tmpdir)
+    local_cache = LocalCache(data_dir)
+
+    spool = ShardSpool(data_dir, 'measurement')
+    spool.add(('parent', 1))
+
+    pid = os.fork()
+    if pid == 0:
+        # The child writes to its own shard (and drops the shard of the parent without unlocking
+        # or removing it).
+        try:
+            spool.add(('child', 1))
+            spool.rotate()
+            del spool
+            import gc
+            gc.collect()
+        finally:
+            os._exit(0)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    # The shard of the parent is still locked (so, only the shard of the child is merged).
+    other = ShardSpool(data_dir, 'measurement')
+    assert other._collect_orphans(lambda items: local_cache.add_many('measurement', items)) == 1
+    assert _bucket_contents(local_cache, 'measurement') == [['child', 1]]
+
+    # The parent keeps on writing to its shard.
+    spool.add(('parent', 2))
+    assert spool.merge_into(local_cache) == 1
+    assert _bucket_contents(local_cache, 'measurement') == [
+        ['child', 1], ['parent', 1], ['parent', 2]]
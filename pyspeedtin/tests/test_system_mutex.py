@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from pyspeedtin.system_mutex import get_lock_wait_stats, reset_lock_wait_stats, \
+    timed_acquire_mutex
+
+
+def test_timed_acquire_mutex_wakes_up_on_release():
+    reset_lock_wait_stats()
+    mutex_name = 'pyspeedtin_test_mutex_wake_up'
+    acquired = threading.Event()
+
+    def hold_mutex():
+        with timed_acquire_mutex(mutex_name):
+            acquired.set()
+            time.sleep(0.05)
+
+    t = threading.Thread(target=hold_mutex)
+    t.start()
+    try:
+        acquired.wait(5)
+        with timed_acquire_mutex(mutex_name) as handle:
+            # The previous implementation would wait for at least 0.5s.
+            assert 0.02 < handle.wait_time < 0.3
+    finally:
+        t.join()
+
+    stats = get_lock_wait_stats()[mutex_name]
+    assert stats.acquired == 2
+    assert stats.contended == 1
+    assert stats.max_wait == handle.wait_time
+
+
+def test_timed_acquire_mutex_timeout():
+    mutex_name = 'pyspeedtin_test_mutex_timeout'
+    with timed_acquire_mutex(mutex_name):
+        initial_time = time.time()
+        with pytest.raises(RuntimeError):
+            timed_acquire_mutex(mutex_name, timeout=0.1)
+        assert time.time() - initial_time < 1
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='Shared locks are not available on Windows.')
+def test_timed_acquire_mutex_shared(tmpdir):
+    lock_dir = str(tmpdir)
+    mutex_name = 'bucket.lock'
+    with timed_acquire_mutex(mutex_name, lock_dir=lock_dir, shared=True):
+        # Readers don't block each other...
+        with timed_acquire_mutex(mutex_name, lock_dir=lock_dir, shared=True, timeout=0.1):
+            pass
+
+        # ... but block writers.
+        with pytest.raises(RuntimeError):
+            timed_acquire_mutex(mutex_name, lock_dir=lock_dir, timeout=0.1)
+
+    with timed_acquire_mutex(mutex_name, lock_dir=lock_dir, timeout=0.1):
+        with pytest.raises(RuntimeError):
+            timed_acquire_mutex(mutex_name, lock_dir=lock_dir, shared=True, timeout=0.1)
+
+    # Lock files in a lock dir are kept (removing them isn't safe with shared locks).
+    assert os.path.exists(os.path.join(lock_dir, mutex_name))
+
+    # The same name in another lock dir is a different mutex.
+    other_lock_dir = str(tmpdir.mkdir('other'))
+    with timed_acquire_mutex(mutex_name, lock_dir=lock_dir):
+        with timed_acquire_mutex(mutex_name, lock_dir=other_lock_dir, timeout=0.1):
+            pass
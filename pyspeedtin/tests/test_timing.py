@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+from array import array
+
+from pyspeedtin.stats import summarize, to_array
+from pyspeedtin.timing import calibrate_loops, measure
+
+
+def test_summarize():
+    summary = summarize([3.0, 1.0, 2.0, 4.0])
+    assert summary['count'] == 4
+    assert summary['min'] == 1.0
+    assert summary['max'] == 4.0
+    assert summary['median'] == 2.5
+    assert summary['mean'] == 2.5
+    assert abs(summary['stdev'] - 1.2909944) < 1e-6
+
+    assert summary['p95'] == 3.85
+    assert summary['mad'] == 1.0
+
+    assert summarize([1.0])['stdev'] == 0.0
+    with pytest.raises(ValueError):
+        summarize([])
+
+
+def test_to_array():
+    samples = array('d', [1.0, 2.0])
+    assert to_array(samples) is samples
+    assert to_array([1, 2]) == samples
+    assert summarize(samples)['median'] == 1.5
+
+
+def test_calibrate_loops():
+    assert calibrate_loops(lambda: time.sleep(0.002), min_time=0.01) in (2, 5)
+    assert calibrate_loops(lambda: time.sleep(0.02), min_time=0.01) == 1
+
+
+def test_measure():
+    calls = []
+
+    def func():
+        calls.append(1)
+        time.sleep(0.001)
+
+    result = measure(func, warmup=1, repeat=3, loops=4)
+    assert len(calls) == 16
+    assert result.loops == 4
+    assert len(result.samples) == 3
+    assert 0.001 <= result.summary['min'] < 0.01
+    assert result.overhead >= 0
+
+    # The overhead of the loop is subtracted (so, a function which does nothing is close to 0).
+    result = measure(lambda: None, repeat=3, min_time=0.01)
+    assert result.loops > 1000
+    assert result.summary['min'] < 1e-6
@@ -0,0 +1,123 @@
+'''
+A timing harness (similar to timeit) to measure how long a function takes.
+
+i.e.:
+
+    result = measure(func, repeat=5, min_time=0.2)
+    result.summary['min']  # Seconds per call.
+
+The number of calls done in each sample (loops) is calibrated so that each sample takes at least
+`min_time` seconds and the time of the loop itself (measured calling a function which does
+nothing) is subtracted from each sample.
+'''
+import gc
+import itertools
+import time
+
+from pyspeedtin.stats import summarize
+
+
+if hasattr(time, 'perf_counter_ns'):
+
+    def _timer():
+        return time.perf_counter_ns() / 1e9
+
+else:
+    _timer = time.perf_counter
+
+
+def _noop():
+    pass
+
+
+def _time_loops(func, loops):
+    '''
+    :return float:
+        The seconds taken to call func `loops` times.
+    '''
+    it = itertools.repeat(None, loops)
+    timer = _timer
+    start = timer()
+    for _ in it:
+        func()
+    return timer() - start
+
+
+class TimingResult(object):
+
+    def __init__(self, samples, loops, overhead):
+        # Seconds per call in each sample (already without the overhead).
+        self.samples = samples
+
+        # The number of calls in each sample.
+        self.loops = loops
+
+        # The overhead (in seconds) per call which was subtracted from each sample.
+        self.overhead = overhead
+
+        self.summary = summarize(samples)
+
+    def __repr__(self):
+        return '<TimingResult min=%.9fs median=%.9fs samples=%s loops=%s>' % (
+            self.summary['min'], self.summary['median'], len(self.samples), self.loops)
+
+
+def calibrate_loops(func, min_time=0.2):
+    '''
+    :return int:
+        The number of calls to func (1, 2, 5, 10, 20, 50, ...) needed to take at least
+        `min_time` seconds.
+    '''
+    i = 1
+    while True:
+        for j in (1, 2, 5):
+            loops = i * j
+            if _time_loops(func, loops) >= min_time:
+                return loops
+        i *= 10
+
+
+def measure(func, warmup=1, repeat=5, min_time=0.2, disable_gc=True, loops=None):
+    '''
+    :param callable func:
+        The function to be measured (called without arguments).
+
+    :param int warmup:
+        The number of samples taken and discarded before the actual samples.
+
+    :param int repeat:
+        The number of samples.
+
+    :param float min_time:
+        The minimum time of each sample (used to calibrate the number of loops).
+
+    :param bool disable_gc:
+        If True, the garbage collector is disabled while measuring.
+
+    :param int loops:
+        The number of calls in each sample (if given, no calibration is done).
+
+    :return TimingResult:
+    '''
+    if repeat < 1:
+        raise ValueError('repeat must be at least 1.')
+
+    gc_enabled = gc.isenabled()
+    if disable_gc:
+        gc.disable()
+    try:
+        if loops is None:
+            loops = calibrate_loops(func, min_time)
+
+        for _i in range(warmup):
+            _time_loops(func, loops)
+
+        samples = [_time_loops(func, loops) for _i in range(repeat)]
+
+        # Note: the min is used as noise only makes the loop slower.
+        overhead = min(_time_loops(_noop, loops) for _i in range(repeat)) / loops
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return TimingResult([max(0.0, sample / loops - overhead) for sample in samples], loops, overhead)
@@ -0,0 +1,203 @@
+'''
+Helpers for the HTTP requests done to the server: a requests.Session which keeps the connections
+alive (so, each request doesn't need a new TCP/TLS handshake) and a retry policy for transient
+failures (connection errors and 429/5xx responses).
+
+i.e.:
+
+    session = create_session(pool_maxsize=16)
+    r = RetryPolicy().call(session.post, url, json=json)
+'''
+import datetime
+from email.utils import parsedate_to_datetime
+import random
+import sys
+import time
+
+
+DEFAULT_POOL_MAXSIZE = 16
+
+# The (connect, read) timeout in seconds of the requests done without an explicit timeout (so, a
+# server which stops responding raises a requests.Timeout, which is retried, instead of blocking
+# the commit forever).
+DEFAULT_TIMEOUT = (10, 60)
+
+
+def create_session(pool_maxsize=DEFAULT_POOL_MAXSIZE, timeout=DEFAULT_TIMEOUT):
+    '''
+    :param int pool_maxsize:
+        The maximum number of connections kept alive to the server (should be at least the number
+        of threads doing requests concurrently).
+
+    :param tuple(float, float) timeout:
+        The (connect, read) timeout used in the requests which don't pass a timeout.
+    '''
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class _TimeoutHTTPAdapter(HTTPAdapter):
+
+        def send(self, request, timeout=None, **kwargs):
+            if timeout is None:
+                timeout = self.default_timeout
+            return HTTPAdapter.send(self, request, timeout=timeout, **kwargs)
+
+    session = requests.Session()
+    adapter = _TimeoutHTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    adapter.default_timeout = timeout
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _get_retryable_exceptions():
+    exceptions = [ConnectionError, TimeoutError]
+    try:
+        import requests
+    except ImportError:
+        pass
+    else:
+        exceptions.extend([requests.ConnectionError, requests.Timeout])
+    return tuple(exceptions)
+
+
+def _is_not_sent_error(exception):
+    '''
+    :return bool:
+        True if the request failed before being sent (the connection couldn't be established),
+        so, the server surely didn't receive it.
+    '''
+    if isinstance(exception, ConnectionRefusedError):
+        return True
+    try:
+        import requests
+        from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+    except ImportError:
+        return False
+
+    if isinstance(exception, requests.ConnectTimeout):
+        return True
+    if isinstance(exception, requests.ConnectionError) and exception.args:
+        # i.e.: MaxRetryError(reason=NewConnectionError(...)) for a connection refused.
+        reason = getattr(exception.args[0], 'reason', exception.args[0])
+        return isinstance(reason, (ConnectTimeoutError, NewConnectionError, ConnectionRefusedError))
+    return False
+
+
+class RetryPolicy(object):
+    '''
+    Retries requests which fail with a connection error or a 429/5xx status using an exponential
+    backoff with jitter (or the time in the Retry-After header if given by the server).
+
+    Requests which are not idempotent (the POSTs which create benchmarks and measurements) are
+    only retried after an exception if the request was surely not sent (i.e.: connection refused
+    or connect timeout): after a read timeout or a connection reset the server may have already
+    created the item, so, retrying it could create a duplicate.
+    '''
+
+    def __init__(
+        self,
+        max_retries=5,
+        backoff_factor=0.5,
+        max_backoff=30,
+        max_retry_after=120,
+        retry_statuses=(429, 500, 502, 503, 504),
+        sleep=time.sleep,
+    ):
+        '''
+        :param int max_retries:
+            The maximum number of retries for a request (0 means no retries).
+
+        :param float backoff_factor:
+            The delay before retry n (0-based) is a random value up to
+            `backoff_factor * 2 ** n` (limited to `max_backoff`).
+
+        :param float max_retry_after:
+            The maximum delay accepted from a Retry-After header.
+        '''
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = frozenset(retry_statuses)
+        self.sleep = sleep
+        self._retryable_exceptions = None
+
+    @property
+    def retryable_exceptions(self):
+        if self._retryable_exceptions is None:
+            self._retryable_exceptions = _get_retryable_exceptions()
+        return self._retryable_exceptions
+
+    def should_retry_exception(self, exception, idempotent=True):
+        if not isinstance(exception, self.retryable_exceptions):
+            return False
+        return idempotent or _is_not_sent_error(exception)
+
+    def should_retry_response(self, response):
+        return response.status_code in self.retry_statuses
+
+    def get_delay(self, attempt, response=None):
+        '''
+        :param int attempt:
+            0 for the first retry, 1 for the second, ...
+
+        :param response:
+            The response which should be retried (None if it failed with an exception).
+        '''
+        if response is not None:
+            retry_after = _parse_retry_after(getattr(response, 'headers', None))
+            if retry_after is not None:
+                return min(retry_after, self.max_retry_after)
+
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+
+    def call(self, request, url, idempotent=True, **kwargs):
+        '''
+        Calls request(url, **kwargs) (i.e.: session.post) retrying it as needed.
+
+        :param bool idempotent:
+            If False (i.e.: a POST), exceptions are only retried if the request was not sent.
+
+        :return:
+            The last response (which may still have a 429/5xx status if all the retries failed).
+        '''
+        attempt = 0
+        while True:
+            try:
+                response = request(url, **kwargs)
+            except self.retryable_exceptions as e:
+                if attempt >= self.max_retries or not self.should_retry_exception(e, idempotent):
+                    raise
+                delay = self.get_delay(attempt)
+                reason = str(e)
+            else:
+                if attempt >= self.max_retries or not self.should_retry_response(response):
+                    return response
+                delay = self.get_delay(attempt, response)
+                reason = 'status: %s' % (response.status_code,)
+
+            sys.stderr.write('Retrying request to: %s in %.2fs (%s).\n' % (url, delay, reason))
+            self.sleep(delay)
+            attempt += 1
+
+
+def _parse_retry_after(headers):
+    if not headers:
+        return None
+
+    retry_after = headers.get('Retry-After')
+    if not retry_after:
+        return None
+
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+
+    try:
+        date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
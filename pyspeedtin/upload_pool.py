@@ -0,0 +1,91 @@
+'''
+To use, create an UploadPool and use map_in_order() to call some function for many items (i.e.:
+to post them to the server) while handling the results in the current thread in the same order
+of the items.
+
+I.e.:
+
+    with UploadPool(max_workers=8) as pool:
+        pool.map_in_order(handles, post_handle, on_posted)
+'''
+from collections import deque
+import sys
+
+
+class UploadPool(object):
+
+    def __init__(self, max_workers=1, max_in_flight=None):
+        '''
+        :param int max_workers:
+            The number of threads used to call the function (if <= 1 everything is done in the
+            current thread).
+
+        :param int max_in_flight:
+            The maximum number of items submitted to the threads and still not handled (by default
+            twice the number of workers).
+        '''
+        self.max_workers = max_workers
+        if max_in_flight is None:
+            max_in_flight = max_workers * 2
+        self.max_in_flight = max(max_in_flight, max_workers, 1)
+        self._executor = None
+
+    def __enter__(self):
+        if self.max_workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(self.max_workers)
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def map_in_order(self, items, func, on_result):
+        '''
+        Calls func(item) for each item and on_result(item, result) in the current thread, in the
+        same order of the items.
+
+        If some item fails (or getting the next item fails), no new items are submitted but the
+        results of the ones already submitted are still handled and then the first error is
+        raised (the other errors are printed to stderr).
+        '''
+        executor = self._executor
+        if executor is None:
+            for item in items:
+                on_result(item, func(item))
+            return
+
+        in_flight = deque()
+        errors = []
+        items = iter(items)
+        while True:
+            while not errors and len(in_flight) < self.max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    errors.append(e)
+                    break
+                in_flight.append((item, executor.submit(func, item)))
+
+            if not in_flight:
+                break
+
+            item, future = in_flight.popleft()
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+
+            try:
+                on_result(item, result)
+            except Exception as e:
+                errors.append(e)
+
+        if errors:
+            for e in errors[1:]:
+                sys.stderr.write('Error (after a previous error): %s\n' % (e,))
+            raise errors[0]